@@ -0,0 +1,105 @@
+"""
+Запуск набора бенчмарков и сравнение с эталоном
+
+    python -m benchmarks                     # все наборы, быстрые размеры
+    python -m benchmarks --suites crypto     # только шифрование
+    python -m benchmarks --full              # 10k/1M/10M строк в БД и т.д.
+    python -m benchmarks --save-baseline     # записать результат как эталон
+
+Результаты пишутся в --output (JSON). Если есть эталон (--baseline), каждый
+показатель сравнивается с ним, и при ухудшении больше --tolerance процесс
+завершается с кодом 1.
+"""
+import argparse
+import json
+import platform
+import sys
+from datetime import datetime
+from pathlib import Path
+from benchmarks import crypto_benchmark, network_benchmark, storage_benchmark
+
+BENCHMARKS_DIR = Path(__file__).parent
+
+SUITES = {
+    'storage': lambda full, seconds: storage_benchmark.run(
+        [10000, 1000000, 10000000] if full else [10000], seconds),
+    'crypto': lambda full, seconds: crypto_benchmark.run(
+        [100, 1000, 10000, 100000, 1000000] if full else [100, 1000, 10000, 100000], seconds),
+    'network': lambda full, seconds: network_benchmark.run(
+        [100, 10000, 100000] if full else [100, 10000], 20000 if full else 5000),
+}
+
+
+def compare(results: list, baseline: list, tolerance: float) -> list:
+    """
+    Показатели, ухудшившиеся относительно эталона больше чем на tolerance
+    """
+    reference = {item['name']: item for item in baseline}
+    regressions = []
+    for item in results:
+        base = reference.get(item['name'])
+        if not base or not base['value']:
+            continue
+        change = (item['value'] - base['value']) / base['value']
+        if not item['higher_is_better']:
+            change = -change
+        item['baseline'] = base['value']
+        item['change'] = change
+        if change < -tolerance:
+            regressions.append(item)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Secure Messenger benchmark suite")
+    parser.add_argument('--suites', nargs='+', choices=sorted(SUITES), default=sorted(SUITES))
+    parser.add_argument('--full', action='store_true', help='Use the large problem sizes')
+    parser.add_argument('--seconds', type=float, default=1.0, help='Time per throughput test')
+    parser.add_argument('--output', default=str(BENCHMARKS_DIR / 'results.json'))
+    parser.add_argument('--baseline', default=str(BENCHMARKS_DIR / 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown before a result counts as a regression')
+    args = parser.parse_args()
+
+    results = []
+    for suite in args.suites:
+        print(f"Running {suite} benchmarks...")
+        results += SUITES[suite](args.full, args.seconds)
+
+    baseline_path = Path(args.baseline)
+    regressions = []
+    if baseline_path.exists() and not args.save_baseline:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+
+    print(f"\n{'benchmark':<45} {'value':>12} {'unit':<6} {'baseline':>12} {'change':>8}")
+    for item in results:
+        line = f"{item['name']:<45} {item['value']:>12.2f} {item['unit']:<6}"
+        if 'baseline' in item:
+            flag = ' !' if item in regressions else ''
+            line += f" {item['baseline']:>12.2f} {item['change'] * 100:>+7.1f}%{flag}"
+        print(line)
+
+    report = {
+        'created': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.save_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {baseline_path}")
+    elif regressions:
+        print(f"{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Общие функции бенчмарков
+
+Результат измерения - словарь, который сохраняется в JSON и сравнивается
+с эталоном:
+
+    {'name': 'crypto.encrypt_session.1000', 'value': 52000.0,
+     'unit': 'ops/s', 'higher_is_better': True}
+"""
+import time
+from typing import Callable
+
+
+def result(name: str, value: float, unit: str, higher_is_better: bool = True) -> dict:
+    return {
+        'name': name,
+        'value': value,
+        'unit': unit,
+        'higher_is_better': higher_is_better,
+    }
+
+
+def percentile(values, fraction):
+    """
+    Перцентиль по отсортированному списку
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def ops_per_second(operation: Callable, seconds: float, batch: int = 10) -> float:
+    """
+    Сколько раз в секунду выполняется operation (не меньше одной пачки)
+    """
+    operation()  # прогрев: кэши, ленивые импорты
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        for _ in range(batch):
+            operation()
+        count += batch
+        if time.perf_counter() >= deadline:
+            break
+    return count / (time.perf_counter() - started)
+
+
+def latencies_ms(operation: Callable, repeat: int) -> list:
+    """
+    Отсортированные времена выполнения operation в миллисекундах
+    """
+    operation()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        operation()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings
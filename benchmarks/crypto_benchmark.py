@@ -0,0 +1,60 @@
+"""
+Скорость шифрования и расшифровки сообщений
+
+Гибридный конверт (RSA на каждое сообщение) и сеансовый AES-GCM конверт на
+разных размерах сообщения. Ключи генерируются во временном каталоге.
+
+    python -m benchmarks.crypto_benchmark --sizes 100 1000 10000 100000
+"""
+import argparse
+import tempfile
+from pathlib import Path
+from benchmarks.common import ops_per_second, result
+from crypto.encryption import CryptoManager
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+
+def run(sizes=DEFAULT_SIZES, seconds: float = 1.0) -> list:
+    results = []
+    with tempfile.TemporaryDirectory() as keys_dir:
+        crypto = CryptoManager(Path(keys_dir))
+        crypto.generate_keys()
+        public_key_pem = crypto.get_public_key_pem()
+
+        for size in sizes:
+            message = 'x' * size
+            hybrid = crypto.encrypt_message(message, public_key_pem, binary=True)
+            session = crypto.encrypt_session_message(message, public_key_pem, binary=True)
+
+            results += [
+                result(f'crypto.encrypt_message.{size}', ops_per_second(
+                    lambda: crypto.encrypt_message(message, public_key_pem, binary=True), seconds
+                ), 'ops/s'),
+                result(f'crypto.decrypt_message.{size}', ops_per_second(
+                    lambda: crypto.decrypt_message(hybrid), seconds
+                ), 'ops/s'),
+                result(f'crypto.encrypt_session.{size}', ops_per_second(
+                    lambda: crypto.encrypt_session_message(message, public_key_pem, binary=True),
+                    seconds, batch=100
+                ), 'ops/s'),
+                result(f'crypto.decrypt_session.{size}', ops_per_second(
+                    lambda: crypto.decrypt_message(session), seconds, batch=100
+                ), 'ops/s'),
+            ]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message encryption benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Message sizes in bytes')
+    parser.add_argument('--seconds', type=float, default=1.0, help='Time per measurement')
+    args = parser.parse_args()
+
+    for item in run(args.sizes, args.seconds):
+        print(f"{item['name']:<40} {item['value']:>12.0f} {item['unit']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Сравнение JSON и бинарного формата конверта
+
+Измеряет размер кадра и скорость упаковки/разбора конверта вместе с кадром
+протокола, без самой криптографии (поля заполняются случайными байтами).
+
+    python -m benchmarks.envelope_benchmark --sizes 100 1000 10000 100000
+"""
+import argparse
+import base64
+import os
+import time
+from crypto.envelope import KIND_SESSION, FIELDS, decode_envelope, encode_envelope
+from network.protocol import FrameDecoder, encode_frame
+
+
+def make_fields(size: int) -> dict:
+    return {
+        'session_id': os.urandom(16),
+        'encrypted_key': os.urandom(256),
+        'nonce': os.urandom(12),
+        'encrypted_message': os.urandom(size + 16),
+    }
+
+
+def json_roundtrip(fields: dict):
+    encrypted_data = {name: base64.b64encode(value).decode() for name, value in fields.items()}
+    frame = encode_frame({'type': 'message', 'from': 'a', 'to': 'b', 'data': encrypted_data})
+    message = FrameDecoder().feed(frame)[0]
+    decoded = {name: base64.b64decode(message['data'][name]) for name in FIELDS[KIND_SESSION]}
+    return frame, decoded
+
+
+def binary_roundtrip(fields: dict):
+    envelope = encode_envelope(KIND_SESSION, fields)
+    frame = encode_frame({'type': 'message', 'from': 'a', 'to': 'b', 'data': envelope})
+    message = FrameDecoder().feed(frame)[0]
+    decoded = decode_envelope(message['data'])[1]
+    return frame, decoded
+
+
+def measure(roundtrip, fields: dict, seconds: float) -> tuple:
+    frame, _ = roundtrip(fields)
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            roundtrip(fields)
+        count += 100
+    elapsed = time.perf_counter() - started
+    return len(frame), count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Envelope format benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='Plaintext sizes in bytes')
+    parser.add_argument('--seconds', type=float, default=1.0, help='Time per measurement')
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'json bytes':>11} {'bin bytes':>10} {'saved':>6} "
+          f"{'json ops/s':>11} {'bin ops/s':>10}")
+    for size in args.sizes:
+        fields = make_fields(size)
+        json_size, json_rate = measure(json_roundtrip, fields, args.seconds)
+        binary_size, binary_rate = measure(binary_roundtrip, fields, args.seconds)
+        saved = 100.0 * (json_size - binary_size) / json_size
+        print(f"{size:>8} {json_size:>11} {binary_size:>10} {saved:>5.1f}% "
+              f"{json_rate:>11.0f} {binary_rate:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
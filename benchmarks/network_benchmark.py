@@ -0,0 +1,114 @@
+"""
+Отправка и прием через MessageClient по loopback
+
+relay сервер запускается в отдельном процессе, два MessageClient без P2P
+обмениваются бинарными сообщениями. Измеряется пропускная способность
+(сообщения подряд без ожидания) и задержка доставки одного сообщения.
+
+    python -m benchmarks.network_benchmark --sizes 100 10000 --messages 20000
+"""
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+from benchmarks.common import percentile, result
+from benchmarks.relay_benchmark import _run_relay
+from network.client import MessageClient
+
+DEFAULT_SIZES = [100, 10000]
+
+# Сколько ждать доставки всех сообщений
+RECEIVE_TIMEOUT = 60.0
+
+
+class Receiver:
+    def __init__(self):
+        self.expected = 0
+        self.received = 0
+        self.latencies = []
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def reset(self, expected: int):
+        with self._lock:
+            self.expected = expected
+            self.received = 0
+            self.latencies = []
+            self.done.clear()
+
+    def on_message(self, message: dict):
+        now = time.perf_counter()
+        with self._lock:
+            self.latencies.append(now - message['sent_at'])
+            self.received += 1
+            if self.received >= self.expected:
+                self.done.set()
+
+
+def run(sizes=DEFAULT_SIZES, messages: int = 20000, latency_samples: int = 500) -> list:
+    port_queue = multiprocessing.Queue()
+    relay = multiprocessing.Process(target=_run_relay, args=(port_queue,), daemon=True)
+    relay.start()
+    port = port_queue.get(timeout=10)
+
+    receiver = Receiver()
+    sender_client = MessageClient('bench-sender', '127.0.0.1', port, use_p2p=False)
+    receiver_client = MessageClient('bench-receiver', '127.0.0.1', port, use_p2p=False)
+    receiver_client.set_message_callback(receiver.on_message)
+    results = []
+    try:
+        if not (receiver_client.connect() and sender_client.connect()):
+            raise RuntimeError("Could not connect to the benchmark relay")
+        # Даем серверу обработать регистрации
+        time.sleep(0.2)
+
+        for size in sizes:
+            payload = os.urandom(size)
+
+            receiver.reset(messages)
+            started = time.perf_counter()
+            for _ in range(messages):
+                sender_client.send_message('bench-receiver', payload, try_p2p=False,
+                                           headers={'sent_at': time.perf_counter()})
+            if not receiver.done.wait(RECEIVE_TIMEOUT):
+                raise RuntimeError(f"Only {receiver.received} of {messages} messages arrived")
+            elapsed = time.perf_counter() - started
+            results.append(result(f'network.relay_throughput.{size}', messages / elapsed, 'msg/s'))
+
+            # Задержка без очередей: следующее сообщение после доставки предыдущего
+            timings = []
+            for _ in range(latency_samples):
+                receiver.reset(1)
+                sender_client.send_message('bench-receiver', payload, try_p2p=False,
+                                           headers={'sent_at': time.perf_counter()})
+                if not receiver.done.wait(RECEIVE_TIMEOUT):
+                    raise RuntimeError("Latency probe was not delivered")
+                timings.append(receiver.latencies[0] * 1000)
+            timings.sort()
+            results += [
+                result(f'network.relay_latency_p50.{size}', percentile(timings, 0.5), 'ms', False),
+                result(f'network.relay_latency_p99.{size}', percentile(timings, 0.99), 'ms', False),
+            ]
+    finally:
+        sender_client.disconnect()
+        receiver_client.disconnect()
+        relay.terminate()
+        relay.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MessageClient loopback benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Payload sizes in bytes')
+    parser.add_argument('--messages', type=int, default=20000,
+                        help='Messages per throughput run')
+    args = parser.parse_args()
+
+    for item in run(args.sizes, args.messages):
+        print(f"{item['name']:<40} {item['value']:>12.2f} {item['unit']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Нагрузочный тест relay сервера
+
+Запускает network.relay_server в отдельном процессе, подключает N клиентов
+и гоняет сообщения по кольцу (клиент i пишет клиенту i+1). Выводит пропускную
+способность (сообщений/сек) и задержку пересылки p50/p99. Без --rate клиенты
+пишут с максимальной скоростью, и задержка включает время в очередях.
+
+    python -m benchmarks.relay_benchmark --clients 1000 --messages 100
+"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+from benchmarks.common import percentile
+from network.protocol import FrameDecoder, encode_frame
+from network.relay_server import RelayServer, _raise_open_files_limit
+
+
+def _run_relay(port_queue):
+    async def serve():
+        server = RelayServer('127.0.0.1', 0)
+        await server.start()
+        port_queue.put(server.port)
+        await server.serve_forever()
+
+    _raise_open_files_limit()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+class BenchClient:
+    def __init__(self, peer_id: str, expected: int):
+        self.peer_id = peer_id
+        self.expected = expected
+        self.received = 0
+        self.latencies = []
+        self.done = asyncio.Event()
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, port: int):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        self.writer.write(encode_frame({'type': 'register', 'peer_id': self.peer_id}))
+        await self.writer.drain()
+
+    async def receive(self):
+        decoder = FrameDecoder()
+        while self.received < self.expected:
+            data = await self.reader.read(65536)
+            if not data:
+                break
+            now = time.perf_counter()
+            for message in decoder.feed(data):
+                if message.get('type') != 'message':
+                    continue
+                self.latencies.append(now - message['data']['sent_at'])
+                self.received += 1
+        self.done.set()
+
+    async def send(self, to_peer_id: str, count: int, payload: str, rate: float):
+        interval = 1.0 / rate if rate else 0.0
+        for _ in range(count):
+            message = {
+                'type': 'message',
+                'from': self.peer_id,
+                'to': to_peer_id,
+                'data': {'sent_at': time.perf_counter(), 'payload': payload},
+            }
+            self.writer.write(encode_frame(message))
+            await self.writer.drain()
+            if interval:
+                await asyncio.sleep(interval)
+
+
+async def run_benchmark(port: int, clients: int, messages: int, size: int,
+                        rate: float = 0.0) -> dict:
+    payload = 'x' * size
+    peers = [BenchClient(f'bench-{i}', messages) for i in range(clients)]
+
+    # Подключаемся пачками, чтобы не переполнить backlog сервера
+    for start in range(0, clients, 500):
+        await asyncio.gather(*(peer.connect(port) for peer in peers[start:start + 500]))
+    # Даем серверу обработать регистрации
+    await asyncio.sleep(0.5)
+
+    receivers = [asyncio.create_task(peer.receive()) for peer in peers]
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        peer.send(peers[(i + 1) % clients].peer_id, messages, payload, rate)
+        for i, peer in enumerate(peers)
+    ))
+    await asyncio.gather(*receivers)
+    elapsed = time.perf_counter() - started
+
+    for peer in peers:
+        peer.writer.close()
+
+    latencies = sorted(latency for peer in peers for latency in peer.latencies)
+    total = len(latencies)
+    return {
+        'clients': clients,
+        'messages': total,
+        'seconds': elapsed,
+        'messages_per_sec': total / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay server benchmark")
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='Messages sent by each client')
+    parser.add_argument('--size', type=int, default=512, help='Payload size in bytes')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='Messages per second per client (0 = as fast as possible)')
+    args = parser.parse_args()
+
+    _raise_open_files_limit()
+    port_queue = multiprocessing.Queue()
+    relay = multiprocessing.Process(target=_run_relay, args=(port_queue,), daemon=True)
+    relay.start()
+    try:
+        port = port_queue.get(timeout=10)
+        result = asyncio.run(run_benchmark(port, args.clients, args.messages, args.size,
+                                           args.rate))
+    finally:
+        relay.terminate()
+        relay.join()
+
+    print(f"clients:       {result['clients']}")
+    print(f"messages:      {result['messages']}")
+    print(f"throughput:    {result['messages_per_sec']:.0f} msg/s")
+    print(f"latency p50:   {result['p50_ms']:.2f} ms")
+    print(f"latency p99:   {result['p99_ms']:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Скорость записи и чтения истории в DatabaseManager
+
+Для каждого размера БД (--rows) создается временная база с историей из
+нескольких пиров, затем измеряются save_message (сразу и с фоновой записью)
+и get_message_history: последняя страница и страница из середины истории.
+
+    python -m benchmarks.storage_benchmark --rows 10000 1000000 10000000
+
+10 млн строк заполняются несколько минут и занимают несколько ГБ на диске.
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from benchmarks.common import latencies_ms, ops_per_second, percentile, result
+from storage.database import DatabaseManager, Message, message_cursor
+
+DEFAULT_ROWS = [10000]
+
+PEERS = 10
+FILL_BATCH = 50000
+MESSAGE_TEXT = 'benchmark message with some ordinary words in it '
+
+
+def fill(db: DatabaseManager, rows: int):
+    """
+    Заполнение истории пакетными вставками (со всеми триггерами БД)
+    """
+    for i in range(PEERS):
+        db.add_peer(f'peer-{i}', 'public key')
+    started = datetime.utcnow() - timedelta(seconds=rows)
+    for start in range(0, rows, FILL_BATCH):
+        batch = [{
+            'peer_id': f'peer-{n % PEERS}',
+            'content': f'{MESSAGE_TEXT}{n}',
+            'timestamp': started + timedelta(seconds=n),
+            'direction': 'received' if n % 2 else 'sent',
+        } for n in range(start, min(rows, start + FILL_BATCH))]
+        with db.engine.begin() as connection:
+            connection.execute(insert(Message.__table__), batch)
+
+
+def run(rows_list=DEFAULT_ROWS, seconds: float = 1.0, repeat: int = 200) -> list:
+    results = []
+    for rows in rows_list:
+        with tempfile.TemporaryDirectory() as data_dir:
+            db_path = os.path.join(data_dir, 'messages.db')
+            db = DatabaseManager(db_path)
+            fill(db, rows)
+
+            results.append(result(f'storage.save_message.{rows}', ops_per_second(
+                lambda: db.save_message('peer-0', MESSAGE_TEXT, 'sent'), seconds
+            ), 'ops/s'))
+
+            # Середина истории пира - страница по курсору, а не по OFFSET
+            history = db.get_message_history('peer-1', limit=rows // PEERS // 2 or 1)
+            middle = message_cursor(history[-1]) if history else None
+            latest = latencies_ms(lambda: db.get_message_history('peer-1', limit=50), repeat)
+            deep = latencies_ms(
+                lambda: db.get_message_history('peer-1', limit=50, before=middle), repeat
+            )
+            results += [
+                result(f'storage.history_latest_p50.{rows}', percentile(latest, 0.5), 'ms', False),
+                result(f'storage.history_deep_p50.{rows}', percentile(deep, 0.5), 'ms', False),
+            ]
+            db.close()
+
+            # Фоновая запись: время включает сброс очереди в БД
+            db = DatabaseManager(db_path, write_behind=True)
+            count = 0
+            started = time.perf_counter()
+            deadline = started + seconds
+            while time.perf_counter() < deadline:
+                for _ in range(100):
+                    db.save_message('peer-2', MESSAGE_TEXT, 'sent')
+                count += 100
+            db.flush()
+            elapsed = time.perf_counter() - started
+            results.append(result(f'storage.save_message_write_behind.{rows}',
+                                  count / elapsed, 'ops/s'))
+            db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message storage benchmark")
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS,
+                        help='History sizes to test')
+    parser.add_argument('--seconds', type=float, default=1.0, help='Time per throughput test')
+    args = parser.parse_args()
+
+    for item in run(args.rows, args.seconds):
+        print(f"{item['name']:<45} {item['value']:>12.2f} {item['unit']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,17 +5,41 @@ import click
 import json
 import base64
 from pathlib import Path
-from config.settings import DATA_DIR, KEYS_DIR, DB_PATH
+from datetime import datetime, timedelta
+from config.settings import (DATA_DIR, KEYS_DIR, DB_PATH, DEFAULT_HOST, DEFAULT_PORT,
+                             DECRYPT_WORKERS, DECRYPT_QUEUE_SIZE, DB_WRITE_BEHIND,
+                             DEDUP_WINDOW, DEDUP_CACHE_SIZE)
 from crypto.encryption import CryptoManager
 from storage.database import DatabaseManager
 from network.client import MessageClient
+from network.file_transfer import FileTransferManager, FILE_KINDS
+from network.protocol import new_message_id
+from storage.backup import export_backup, import_backup, BackupError, ENCRYPTED_MAGIC
+from utils.pipeline import OrderedPipeline
+from utils.dedup import DedupFilter
 
 class MessengerApp:
-    def __init__(self, peer_id: str):
+    def __init__(self, peer_id: str, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
         self.peer_id = peer_id
         self.crypto_manager = CryptoManager(KEYS_DIR)
-        self.db_manager = DatabaseManager(DB_PATH)
-        self.client = MessageClient(peer_id)
+        self.db_manager = DatabaseManager(DB_PATH, write_behind=DB_WRITE_BEHIND)
+        self.client = MessageClient(peer_id, host, port)
+        self._peer_keys = {}  # peer_id -> PEM публичного ключа (bytes)
+        self.incoming_callback = None
+        
+        # Одно сообщение может прийти и по P2P, и через relay
+        self.dedup = DedupFilter(DEDUP_WINDOW, DEDUP_CACHE_SIZE)
+        
+        # Расшифровка и сохранение входящих вне потока приема сокета
+        self.inbox = OrderedPipeline(
+            self._decrypt_incoming,
+            self._deliver_incoming,
+            workers=DECRYPT_WORKERS,
+            max_pending=DECRYPT_QUEUE_SIZE
+        )
+        
+        # Передача файлов идет через тот же конвейер входящих
+        self.transfers = FileTransferManager(self.crypto_manager, self._send_transfer_message)
         
         # Инициализация
         self._initialize()
@@ -27,6 +51,9 @@ class MessengerApp:
             print("Generating new keys...")
             self.crypto_manager.generate_keys()
             
+        self._load_recent_message_ids()
+        self.inbox.start()
+            
         # Подключение к серверу с поддержкой P2P
         if not self.client.connect(crypto_manager=self.crypto_manager):
             print("Warning: Could not connect to server")
@@ -39,42 +66,151 @@ class MessengerApp:
         # Установка callback для сообщений
         self.client.set_message_callback(self._handle_incoming_message)
         
+        # Сброс кэшей при смене ключа пира
+        self.db_manager.set_key_change_callback(self._handle_key_change)
+        
+        # Фоновый перенос старой истории в архив
+        self.db_manager.start_compaction()
+        
+        # Продолжение прерванных приемов файлов
+        self.transfers.load_incomplete()
+        if self.client.connected:
+            self.transfers.request_resume()
+        # Повторные запросы для приемов, остановившихся по ходу работы
+        self.transfers.start_watchdog()
+        
+    def _load_recent_message_ids(self):
+        """Заполнение фильтра дубликатов сообщениями, принятыми до перезапуска"""
+        now = datetime.utcnow()
+        since = now - timedelta(seconds=DEDUP_WINDOW)
+        for peer_id, message_id, timestamp in self.db_manager.get_recent_message_ids(since):
+            self.dedup.add((peer_id, message_id), (now - timestamp).total_seconds())
+            
+    def _handle_key_change(self, peer_id, old_public_key):
+        """Сброс закэшированного ключа пира"""
+        self._peer_keys.pop(peer_id, None)
+        self.crypto_manager.invalidate_public_key(old_public_key.encode())
+        
+    def _get_peer_public_key(self, peer_id: str):
+        """Публичный ключ пира в PEM (bytes) или None"""
+        public_key = self._peer_keys.get(peer_id)
+        if public_key is None:
+            peer = self.db_manager.get_peer(peer_id)
+            if not peer:
+                return None
+            public_key = peer.public_key.encode()
+            self._peer_keys[peer_id] = public_key
+        return public_key
+        
+    def set_incoming_callback(self, callback):
+        """
+        Установка callback для расшифрованных входящих сообщений
+        callback(sender_id, message) вызывается из потока доставки
+        """
+        self.incoming_callback = callback
+        
     def _handle_incoming_message(self, message_data):
-        """Обработка входящего сообщения"""
-        if message_data.get('type') == 'message':
+        """Обработка входящего сообщения (поток приема: только постановка в очередь)"""
+        if message_data.get('type') in ('message', 'p2p_message'):
             sender_id = message_data.get('from')
-            encrypted_data = message_data.get('data')
-            
-            try:
-                # Расшифровка сообщения
-                decrypted_message = self.crypto_manager.decrypt_message(encrypted_data)
-                
-                # Сохранение в БД
-                self.db_manager.save_message(sender_id, decrypted_message, 'received')
+            message_id = message_data.get('message_id')
+            # Дубликат отбрасывается до расшифровки и записи в БД; копия,
+            # пришедшая другим путем, пока первая в очереди, тоже
+            if message_id and self.dedup.seen((sender_id, message_id)):
+                return
+            # P2P сообщения приходят в потоке цикла событий P2P: ожидание
+            # места в очереди остановило бы прием и таймеры всех пиров
+            timeout = 0 if message_data.get('type') == 'p2p_message' else None
+            if not self.inbox.submit(sender_id, message_data, timeout):
+                print(f"Incoming queue full, dropped message from {sender_id}")
+                # Повторная доставка этого сообщения не должна считаться дубликатом
+                self._forget_message_id(sender_id, message_data)
                 
-                print(f"\n[{sender_id}] {decrypted_message}")
-                print("messenger> ", end='', flush=True)
+    def _forget_message_id(self, sender_id, message_data):
+        """Снятие отметки о приеме с необработанного сообщения"""
+        message_id = message_data.get('message_id')
+        if message_id:
+            self.dedup.discard((sender_id, message_id))
                 
-            except Exception as e:
-                print(f"Error decrypting message: {e}")
+    def _decrypt_incoming(self, message_data):
+        """Расшифровка входящего сообщения (потоки пула)"""
+        if message_data.get('kind') in FILE_KINDS:
+            return self.transfers.prepare(message_data)
+        return self.crypto_manager.decrypt_message(message_data.get('data'))
+        
+    def _deliver_incoming(self, sender_id, message_data, decrypted_message, error):
+        """Сохранение и показ сообщения (по порядку для каждого отправителя)"""
+        if error is not None:
+            print(f"Error decrypting message: {error}")
+            self._forget_message_id(sender_id, message_data)
+            return
+            
+        if message_data.get('kind') in FILE_KINDS:
+            self.transfers.deliver(sender_id, message_data, decrypted_message)
+            return
+            
+        # Сохранение в БД (уникальный индекс отсекает повторы старше окна фильтра)
+        saved = self.db_manager.save_message(
+            sender_id, decrypted_message, 'received', message_data.get('message_id')
+        )
+        if saved is None and not self.db_manager.write_queue:
+            return
+            
+        if self.incoming_callback:
+            self.incoming_callback(sender_id, decrypted_message)
+        else:
+            print(f"\n[{sender_id}] {decrypted_message}")
+            print("messenger> ", end='', flush=True)
+            
+    def shutdown(self):
+        """Отключение от сети и обработка уже принятых сообщений"""
+        self.client.disconnect()
+        self.inbox.stop()
+        self.transfers.close()
+        self.db_manager.close()
+        
+    def _send_transfer_message(self, peer_id, data, headers):
+        """Отправка сообщения передачи файла"""
+        return self.client.send_message(peer_id, data, headers=headers)
+        
+    def send_file(self, recipient_id: str, path: str):
+        """Отправка файла"""
+        recipient_public_key = self._get_peer_public_key(recipient_id)
+        if recipient_public_key is None:
+            print(f"Unknown peer: {recipient_id}")
+            return False
+            
+        try:
+            file_id = self.transfers.send_file(recipient_id, recipient_public_key, path)
+        except Exception as e:
+            print(f"Error sending file: {e}")
+            return False
+            
+        if file_id is None:
+            print("Failed to send file")
+            return False
+        return True
                 
     def send_message(self, recipient_id: str, message: str):
         """Отправка сообщения"""
         # Получаем публичный ключ получателя
-        peer = self.db_manager.get_peer(recipient_id)
-        if not peer:
+        recipient_public_key = self._get_peer_public_key(recipient_id)
+        if recipient_public_key is None:
             print(f"Unknown peer: {recipient_id}")
             return False
             
         try:
             # Шифруем сообщение
-            recipient_public_key = peer.public_key.encode()
-            encrypted_data = self.crypto_manager.encrypt_message(message, recipient_public_key)
+            encrypted_data = self.crypto_manager.encrypt_session_message(
+                message, recipient_public_key, binary=True
+            )
             
             # Отправляем через сеть
-            if self.client.send_message(recipient_id, encrypted_data):
+            message_id = new_message_id()
+            if self.client.send_message(recipient_id, encrypted_data,
+                                        headers={'message_id': message_id}):
                 # Сохраняем в БД
-                self.db_manager.save_message(recipient_id, message, 'sent')
+                self.db_manager.save_message(recipient_id, message, 'sent', message_id)
                 return True
             else:
                 print("Failed to send message")
@@ -84,6 +220,39 @@ class MessengerApp:
             print(f"Error encrypting message: {e}")
             return False
             
+    def broadcast_message(self, recipient_ids, message: str):
+        """Отправка одного сообщения нескольким пирам"""
+        recipients = []
+        public_keys = []
+        for recipient_id in dict.fromkeys(recipient_ids):
+            public_key = self._get_peer_public_key(recipient_id)
+            if public_key is None:
+                print(f"Unknown peer: {recipient_id}")
+                continue
+            recipients.append(recipient_id)
+            public_keys.append(public_key)
+            
+        if not recipients:
+            return []
+            
+        try:
+            # Тело шифруется один раз на всю группу
+            envelopes = self.crypto_manager.encrypt_for_many(message, public_keys, binary=True)
+        except Exception as e:
+            print(f"Error encrypting message: {e}")
+            return []
+            
+        delivered = []
+        for recipient_id, encrypted_data in zip(recipients, envelopes):
+            message_id = new_message_id()
+            if self.client.send_message(recipient_id, encrypted_data,
+                                        headers={'message_id': message_id}):
+                self.db_manager.save_message(recipient_id, message, 'sent', message_id)
+                delivered.append(recipient_id)
+            else:
+                print(f"Failed to send message to {recipient_id}")
+        return delivered
+        
     def add_peer(self, peer_id: str, public_key_pem: str):
         """Добавление нового пира"""
         self.db_manager.add_peer(peer_id, public_key_pem)
@@ -102,6 +271,67 @@ class MessengerApp:
             direction = "→" if msg.direction == 'sent' else "←"
             print(f"[{msg.timestamp.strftime('%H:%M:%S')}] {direction} {msg.content}")
             
+    def search_messages(self, query: str, peer_id: str = None, limit: int = 20):
+        """Полнотекстовый поиск по истории"""
+        results = self.db_manager.search_messages(query, peer_id=peer_id, limit=limit)
+        if not results:
+            print("No messages found")
+            return
+            
+        for result in results:
+            direction = "→" if result.direction == 'sent' else "←"
+            print(f"[{result.timestamp.strftime('%Y-%m-%d %H:%M')}] {result.peer_id} "
+                  f"{direction} {result.snippet}")
+            
+    def set_retention(self, peer_id: str, days):
+        """Срок хранения истории с пиром"""
+        self.db_manager.set_retention_policy(peer_id, days)
+        if days is None:
+            print(f"History with {peer_id} follows the global retention policy")
+        elif days == 0:
+            print(f"History with {peer_id} is kept forever")
+        else:
+            print(f"Messages with {peer_id} older than {days} days will be archived")
+            
+    def export_history(self, path: str, passphrase: str = None, include_keys: bool = False):
+        """Резервная копия истории (и ключей, если она зашифрована)"""
+        def progress(records, written):
+            print(f"\rExported {records} records, {written // 1024} KB", end='', flush=True)
+            
+        try:
+            messages = export_backup(
+                self.db_manager, path, passphrase,
+                keys_dir=KEYS_DIR if include_keys else None,
+                progress=progress
+            )
+        except BackupError as e:
+            print(f"Export failed: {e}")
+            return False
+        print(f"\n{messages} messages exported to {path}")
+        return True
+        
+    def import_history(self, path: str, passphrase: str = None, replace_keys: bool = False):
+        """Загрузка резервной копии"""
+        def progress(records, position, size):
+            percent = position * 100 // size if size else 100
+            print(f"\rImported {records} records ({percent}%)", end='', flush=True)
+            
+        try:
+            stats = import_backup(
+                self.db_manager, path, passphrase,
+                keys_dir=KEYS_DIR, replace_keys=replace_keys,
+                progress=progress
+            )
+        except BackupError as e:
+            print(f"\nImport failed: {e}")
+            return False
+        print(f"\nImported {stats['messages']} messages, {stats['peers']} new peers, "
+              f"{stats['keys']} key files")
+        if stats['keys']:
+            # Ключи читаются при запуске
+            print("Restart the messenger to use the imported keys")
+        return True
+        
     def list_peers(self):
         """Список всех пиров"""
         peers = self.db_manager.get_all_peers()
@@ -120,7 +350,10 @@ class MessengerApp:
 def cli(ctx, peer_id):
     """Secure Messenger CLI"""
     ctx.ensure_object(dict)
-    ctx.obj['app'] = MessengerApp(peer_id)
+    app = ctx.obj['app'] = MessengerApp(peer_id)
+    # Команда выполняется один раз: очередь фоновой записи в БД и
+    # состояние приемов должны быть сохранены до выхода процесса
+    ctx.call_on_close(app.shutdown)
 
 @cli.command()
 @click.argument('recipient_id')
@@ -132,6 +365,26 @@ def send(obj, recipient_id, message):
     if app.send_message(recipient_id, message):
         print("Message sent successfully")
 
+@cli.command()
+@click.argument('recipient_id')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.pass_obj
+def send_file(obj, recipient_id, path):
+    """Send a file to a peer"""
+    app = obj['app']
+    if app.send_file(recipient_id, path):
+        print("File sent successfully")
+
+@cli.command()
+@click.argument('message')
+@click.argument('recipient_ids', nargs=-1, required=True)
+@click.pass_obj
+def broadcast(obj, message, recipient_ids):
+    """Send one message to several peers"""
+    app = obj['app']
+    delivered = app.broadcast_message(recipient_ids, message)
+    print(f"Message sent to {len(delivered)} of {len(set(recipient_ids))} peers")
+
 @cli.command()
 @click.argument('peer_id')
 @click.pass_obj
@@ -140,6 +393,54 @@ def history(obj, peer_id):
     app = obj['app']
     app.show_history(peer_id)
 
+@cli.command()
+@click.argument('query')
+@click.option('--peer', 'peer_id', default=None, help='Search only the history with this peer')
+@click.option('--limit', default=20, show_default=True, help='Maximum number of results')
+@click.pass_obj
+def search(obj, query, peer_id, limit):
+    """Search message history"""
+    app = obj['app']
+    app.search_messages(query, peer_id, limit)
+
+@cli.command()
+@click.argument('peer_id')
+@click.argument('days', type=click.IntRange(min=0), required=False)
+@click.pass_obj
+def retention(obj, peer_id, days):
+    """Set how many days of history with a peer stay in the database
+    (0 keeps everything, omit DAYS to use the global setting)"""
+    app = obj['app']
+    app.set_retention(peer_id, days)
+
+@cli.command('export')
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--encrypt', is_flag=True, help='Encrypt the backup with a passphrase')
+@click.option('--include-keys', is_flag=True, help='Also back up your key pair (requires --encrypt)')
+@click.pass_obj
+def export_command(obj, path, encrypt, include_keys):
+    """Export peers and message history to a compressed backup"""
+    if include_keys and not encrypt:
+        raise click.UsageError("--include-keys requires --encrypt")
+    passphrase = None
+    if encrypt:
+        passphrase = click.prompt('Passphrase', hide_input=True, confirmation_prompt=True)
+    app = obj['app']
+    app.export_history(path, passphrase, include_keys)
+
+@cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--replace-keys', is_flag=True, help='Overwrite existing keys with the ones from the backup')
+@click.pass_obj
+def import_command(obj, path, replace_keys):
+    """Import peers and message history from a backup"""
+    passphrase = None
+    with open(path, 'rb') as f:
+        if f.read(len(ENCRYPTED_MAGIC)) == ENCRYPTED_MAGIC:
+            passphrase = click.prompt('Passphrase', hide_input=True)
+    app = obj['app']
+    app.import_history(path, passphrase, replace_keys)
+
 @cli.command()
 @click.pass_obj
 def peers(obj):
@@ -10,18 +10,65 @@ BASE_DIR = Path(__file__).parent.parent
 DATA_DIR = BASE_DIR / "data"
 DB_PATH = DATA_DIR / "messages.db"
 KEYS_DIR = DATA_DIR / "keys"
+DOWNLOADS_DIR = DATA_DIR / "downloads"
+ARCHIVE_DIR = DATA_DIR / "archive"
 
 # Создаем директории если их нет
 DATA_DIR.mkdir(exist_ok=True)
 KEYS_DIR.mkdir(exist_ok=True)
+DOWNLOADS_DIR.mkdir(exist_ok=True)
+ARCHIVE_DIR.mkdir(exist_ok=True)
 
 # Настройки сети
 DEFAULT_HOST = "localhost"
 DEFAULT_PORT = 8888
+P2P_SEND_TIMEOUT = 3.0  # сколько ждать подтверждения P2P доставки, потом relay
+P2P_WINDOW = 256  # максимум неподтвержденных UDP пакетов на пира
+P2P_CONNECT_TIMEOUT = 5.0  # сколько ждать подписанного ответа пира на пробу
+P2P_PROBE_INTERVAL = 0.25  # пауза между повторами пробы
+P2P_PUNCH_ATTEMPTS = 20  # серий пакетов hole punching (раз в 0.1 с)
+PEER_TABLE_SIZE = 4096  # адресов в таблице пиров, дальше вытесняются самые давние
+PEER_TTL = 300  # пир забывается после стольких секунд без пакетов
+PATH_PROBE_INTERVAL = 5.0  # пробы RTT и потерь путей к активным пирам
+PATH_PROBE_TIMEOUT = 2.0  # проба без ответа за это время - потеря
+PATH_HYSTERESIS = 0.2  # другой путь выбирается, если он лучше на 20%
+PATH_ACTIVE_WINDOW = 120  # пир активен столько секунд после отправки ему
+PATH_STATS_TTL = 600  # измерения путей к пиру забываются после стольких секунд без отправок
+STUN_TIMEOUT = 3.0  # общий таймаут опроса STUN серверов
+STUN_CACHE_PATH = DATA_DIR / "stun_cache.json"
+STUN_CACHE_TTL = 600  # сколько секунд доверять сохраненному внешнему адресу
 
 # Настройки шифрования
 KEY_SIZE = 2048  # для RSA
 SYMMETRIC_KEY_SIZE = 32  # 256 bits
+SESSION_REKEY_MESSAGES = 10000  # смена сеансового ключа после N сообщений
+SESSION_REKEY_INTERVAL = 3600  # или через час
+SESSION_CACHE_SIZE = 256  # входящих сеансовых ключей в памяти
+PUBLIC_KEY_CACHE_SIZE = 128  # разобранных публичных ключей получателей
+ATTACHMENT_CHUNK_SIZE = 16 * 1024  # размер фрагмента вложения
+ATTACHMENT_STALL_TIMEOUT = 10.0  # прием без новых фрагментов дольше - запрос продолжения
+
+# Обработка входящих сообщений
+DECRYPT_WORKERS = 4  # потоков расшифровки
+DECRYPT_QUEUE_SIZE = 1000  # максимум сообщений в очереди на расшифровку
+DEDUP_WINDOW = 600  # сколько секунд помнить идентификаторы принятых сообщений
+DEDUP_CACHE_SIZE = 100000  # но не больше стольких последних
+
+# База данных
+DB_WRITE_BEHIND = True  # пакетная запись сообщений в фоне
+DB_WRITE_BATCH_SIZE = 200  # сообщений в одной транзакции
+DB_WRITE_FLUSH_INTERVAL = 0.05  # или не реже чем раз в 50 мс
+DB_WRITE_RETRIES = 3  # попыток записи пачки, затем запись по одной строке
+DB_WRITE_RETRY_DELAY = 0.5  # пауза перед повтором, удваивается с каждой ошибкой
+DB_CACHE_SIZE_KB = 16384  # кэш страниц SQLite
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
+# Хранение истории
+RETENTION_DAYS = None  # сообщения старше N дней уходят в архив (None - хранить в БД)
+ARCHIVE_SEGMENT_SIZE = 64 * 1024 * 1024  # размер сегмента архива
+COMPACTION_INTERVAL = 3600  # запуск архивации раз в час
+COMPACTION_BATCH_SIZE = 1000  # сообщений в одной транзакции архивации
+VACUUM_PAGES = 2000  # страниц, освобождаемых за один проход
 
 # GUI настройки
 WINDOW_WIDTH = 1000
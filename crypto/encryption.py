@@ -5,8 +5,167 @@ from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives import padding as sym_padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidSignature
+from collections import OrderedDict
+import hashlib
 import os
 import base64
+import threading
+import time
+from crypto.envelope import (KIND_HYBRID, KIND_SESSION, STREAM_NONCE_PREFIX_SIZE,
+                             encode_envelope, decode_envelope, is_binary_envelope,
+                             encode_stream_header, decode_stream_header)
+from config.settings import (SESSION_REKEY_MESSAGES, SESSION_REKEY_INTERVAL, SESSION_CACHE_SIZE,
+                             PUBLIC_KEY_CACHE_SIZE, ATTACHMENT_CHUNK_SIZE)
+
+OAEP_PADDING = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+
+PSS_PADDING = padding.PSS(
+    mgf=padding.MGF1(hashes.SHA256()),
+    salt_length=padding.PSS.MAX_LENGTH
+)
+
+# Сколько последних номеров сообщений сеанса помнится для отсева повторов
+SESSION_REPLAY_WINDOW = 1024
+
+class ReplayError(ValueError):
+    """Сообщение сеанса с уже принятым или слишком старым nonce"""
+
+def key_fingerprint(public_key_pem: bytes) -> bytes:
+    """Отпечаток публичного ключа (SHA-256 от PEM)"""
+    return hashlib.sha256(public_key_pem.strip()).digest()
+
+class SessionKey:
+    """
+    Исходящий сеансовый ключ AES-GCM для одного получателя
+    
+    Ключ передается обернутым в RSA-OAEP в каждом сообщении сеанса, но
+    оборачивается один раз: отправитель не делает RSA на каждое сообщение,
+    а получатель - только на первое сообщение сеанса.
+    """
+    def __init__(self, recipient_public_key):
+        self.key = AESGCM.generate_key(bit_length=256)
+        self.aesgcm = AESGCM(self.key)
+        self.session_id = os.urandom(16)
+        self.encrypted_key = recipient_public_key.encrypt(self.key, OAEP_PADDING)
+        self.counter = 0
+        self.created_at = time.monotonic()
+        # base64 полей, не меняющихся в течение сеанса
+        self.session_id_b64 = base64.b64encode(self.session_id).decode()
+        self.encrypted_key_b64 = base64.b64encode(self.encrypted_key).decode()
+        
+    def expired(self) -> bool:
+        """Пора ли сменить ключ"""
+        return (self.counter >= SESSION_REKEY_MESSAGES or
+                time.monotonic() - self.created_at >= SESSION_REKEY_INTERVAL)
+        
+    def next_nonce(self) -> bytes:
+        """Следующий nonce: 96-битный счетчик сообщений сеанса"""
+        nonce = self.counter.to_bytes(12, 'big')
+        self.counter += 1
+        return nonce
+
+class IncomingSession:
+    """
+    Входящий сеансовый ключ и окно принятых номеров сообщений
+    
+    nonce сеанса - счетчик отправителя; сообщения могут прийти не по порядку
+    (P2P и relay), поэтому помнятся SESSION_REPLAY_WINDOW последних номеров
+    (как окно anti-replay в IPsec).
+    """
+    __slots__ = ('aesgcm', 'highest', 'window')
+    
+    def __init__(self, aesgcm: AESGCM):
+        self.aesgcm = aesgcm
+        self.highest = -1
+        self.window = 0  # бит i - принят номер highest - i
+        
+    def is_replay(self, counter: int) -> bool:
+        if counter > self.highest:
+            return False
+        offset = self.highest - counter
+        return offset >= SESSION_REPLAY_WINDOW or bool(self.window >> offset & 1)
+        
+    def accept(self, counter: int):
+        if counter > self.highest:
+            shift = counter - self.highest
+            self.window = (self.window << shift | 1) & ((1 << SESSION_REPLAY_WINDOW) - 1)
+            self.highest = counter
+        else:
+            self.window |= 1 << (self.highest - counter)
+
+class StreamCipher:
+    """
+    Пофрагментное шифрование потока AES-256-GCM (вложения, резервные копии)
+    
+    nonce = префикс потока (7) | номер фрагмента (4) | флаг (1). Номер не дает
+    переставить фрагменты, флаг последнего фрагмента - незаметно обрезать поток.
+    Каждый фрагмент расшифровывается независимо, поэтому передачу можно
+    продолжить с любого номера.
+    """
+    CHUNK = 0
+    FINAL = 1
+    METADATA = 2
+    METADATA_INDEX = 0xFFFFFFFF
+    
+    def __init__(self, key: bytes, nonce_prefix: bytes = None,
+                 chunk_size: int = ATTACHMENT_CHUNK_SIZE):
+        self.aesgcm = AESGCM(key)
+        self.nonce_prefix = bytes(nonce_prefix) if nonce_prefix else os.urandom(STREAM_NONCE_PREFIX_SIZE)
+        self.chunk_size = chunk_size
+        
+    def _nonce(self, index: int, flag: int) -> bytes:
+        return self.nonce_prefix + index.to_bytes(4, 'big') + bytes([flag])
+        
+    def encrypt_chunk(self, index: int, data: bytes, final: bool = False) -> bytes:
+        """Шифрование фрагмента с номером index"""
+        return self.aesgcm.encrypt(self._nonce(index, self.FINAL if final else self.CHUNK), data, None)
+        
+    def decrypt_chunk(self, index: int, data: bytes, final: bool = False) -> bytes:
+        """Расшифровка фрагмента с номером index"""
+        return self.aesgcm.decrypt(self._nonce(index, self.FINAL if final else self.CHUNK), data, None)
+        
+    def encrypt_metadata(self, data: bytes) -> bytes:
+        """Шифрование метаданных потока (имя файла, размер)"""
+        return self.aesgcm.encrypt(self._nonce(self.METADATA_INDEX, self.METADATA), data, None)
+        
+    def decrypt_metadata(self, data: bytes) -> bytes:
+        """Расшифровка метаданных потока"""
+        return self.aesgcm.decrypt(self._nonce(self.METADATA_INDEX, self.METADATA), data, None)
+
+def encrypt_chunks(fileobj, cipher: StreamCipher, start_index: int = 0):
+    """
+    Генератор зашифрованных фрагментов файла: (index, final, шифротекст)
+    
+    В памяти одновременно не больше двух фрагментов. start_index позволяет
+    продолжить прерванную передачу.
+    """
+    chunk_size = cipher.chunk_size
+    if start_index:
+        fileobj.seek(start_index * chunk_size)
+    index = start_index
+    chunk = fileobj.read(chunk_size)
+    while True:
+        # Читаем на фрагмент вперед, чтобы знать, последний ли текущий
+        next_chunk = fileobj.read(chunk_size) if len(chunk) == chunk_size else b''
+        final = not next_chunk
+        yield index, final, cipher.encrypt_chunk(index, chunk, final)
+        if final:
+            return
+        chunk = next_chunk
+        index += 1
+
+def decrypt_chunks(chunks, cipher: StreamCipher):
+    """
+    Генератор расшифрованных фрагментов из (index, final, шифротекст)
+    """
+    for index, final, data in chunks:
+        yield cipher.decrypt_chunk(index, data, final)
 
 class CryptoManager:
     def __init__(self, keys_dir):
@@ -15,6 +174,16 @@ class CryptoManager:
         self.public_key_path = keys_dir / "public_key.pem"
         self.private_key = None
         self.public_key = None
+        # Сеансовые ключи: исходящие по отпечатку ключа получателя,
+        # входящие по session_id и хэшу обернутого ключа (LRU)
+        self._outgoing_sessions = {}
+        self._incoming_sessions = OrderedDict()
+        self._session_lock = threading.Lock()
+        # LRU разобранных публичных ключей получателей по отпечатку PEM
+        self._public_key_cache = OrderedDict()
+        self._public_key_lock = threading.Lock()
+        self.key_cache_hits = 0
+        self.key_cache_misses = 0
         
     def generate_keys(self):
         """Генерация пары ключей RSA"""
@@ -72,8 +241,48 @@ class CryptoManager:
             format=serialization.PublicFormat.SubjectPublicKeyInfo
         )
         
-    def encrypt_message(self, message: str, recipient_public_key_pem: bytes):
-        """Шифрование сообщения для получателя"""
+    def load_recipient_public_key(self, recipient_public_key_pem: bytes):
+        """Получение разобранного публичного ключа получателя через LRU кэш"""
+        fingerprint = key_fingerprint(recipient_public_key_pem)
+        
+        with self._public_key_lock:
+            public_key = self._public_key_cache.get(fingerprint)
+            if public_key is not None:
+                self._public_key_cache.move_to_end(fingerprint)
+                self.key_cache_hits += 1
+                return public_key
+            self.key_cache_misses += 1
+            
+        public_key = serialization.load_pem_public_key(recipient_public_key_pem)
+        
+        with self._public_key_lock:
+            self._public_key_cache[fingerprint] = public_key
+            while len(self._public_key_cache) > PUBLIC_KEY_CACHE_SIZE:
+                self._public_key_cache.popitem(last=False)
+        return public_key
+        
+    def invalidate_public_key(self, recipient_public_key_pem: bytes):
+        """Удаление ключа получателя из кэша и сброс сеанса с ним"""
+        fingerprint = key_fingerprint(recipient_public_key_pem)
+        with self._public_key_lock:
+            self._public_key_cache.pop(fingerprint, None)
+        with self._session_lock:
+            self._outgoing_sessions.pop(fingerprint, None)
+            
+    def key_cache_stats(self):
+        """Статистика кэша публичных ключей"""
+        with self._public_key_lock:
+            return {
+                'size': len(self._public_key_cache),
+                'hits': self.key_cache_hits,
+                'misses': self.key_cache_misses
+            }
+        
+    def encrypt_message(self, message: str, recipient_public_key_pem: bytes, binary: bool = False):
+        """
+        Шифрование сообщения для получателя
+        binary=True возвращает бинарный конверт вместо словаря с base64
+        """
         # Генерируем симметричный ключ
         symmetric_key = os.urandom(32)  # AES-256
         
@@ -89,15 +298,15 @@ class CryptoManager:
         encrypted_message = encryptor.update(padded_data) + encryptor.finalize()
         
         # Шифруем симметричный ключ публичным ключом получателя
-        recipient_public_key = serialization.load_pem_public_key(recipient_public_key_pem)
-        encrypted_key = recipient_public_key.encrypt(
-            symmetric_key,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+        recipient_public_key = self.load_recipient_public_key(recipient_public_key_pem)
+        encrypted_key = recipient_public_key.encrypt(symmetric_key, OAEP_PADDING)
+        
+        if binary:
+            return encode_envelope(KIND_HYBRID, {
+                'encrypted_key': encrypted_key,
+                'iv': iv,
+                'encrypted_message': encrypted_message
+            })
         
         return {
             'encrypted_message': base64.b64encode(encrypted_message).decode(),
@@ -105,27 +314,144 @@ class CryptoManager:
             'iv': base64.b64encode(iv).decode()
         }
         
-    def decrypt_message(self, encrypted_data: dict):
-        """Расшифровка сообщения"""
+    def encrypt_for_many(self, message: str, recipient_public_key_pems, binary: bool = False):
+        """
+        Шифрование одного сообщения для нескольких получателей
+        
+        Тело шифруется один раз, для каждого получателя оборачивается только
+        симметричный ключ. Возвращает конверты в порядке списка ключей.
+        """
+        symmetric_key = os.urandom(32)  # AES-256
+        
+        iv = os.urandom(16)
+        cipher = Cipher(algorithms.AES(symmetric_key), modes.CBC(iv))
+        encryptor = cipher.encryptor()
+        
+        padder = sym_padding.PKCS7(128).padder()
+        padded_data = padder.update(message.encode()) + padder.finalize()
+        encrypted_message = encryptor.update(padded_data) + encryptor.finalize()
+        
+        # Общие поля кодируем один раз, конверты разделяют эти строки
+        encrypted_message_b64 = base64.b64encode(encrypted_message).decode()
+        iv_b64 = base64.b64encode(iv).decode()
+        
+        envelopes = []
+        for recipient_public_key_pem in recipient_public_key_pems:
+            recipient_public_key = self.load_recipient_public_key(recipient_public_key_pem)
+            encrypted_key = recipient_public_key.encrypt(symmetric_key, OAEP_PADDING)
+            if binary:
+                envelopes.append(encode_envelope(KIND_HYBRID, {
+                    'encrypted_key': encrypted_key,
+                    'iv': iv,
+                    'encrypted_message': encrypted_message
+                }))
+                continue
+            envelopes.append({
+                'encrypted_message': encrypted_message_b64,
+                'encrypted_key': base64.b64encode(encrypted_key).decode(),
+                'iv': iv_b64
+            })
+        return envelopes
+        
+    def encrypt_session_message(self, message: str, recipient_public_key_pem: bytes,
+                                binary: bool = False):
+        """Шифрование сообщения сеансовым ключом получателя (AES-256-GCM)"""
+        fingerprint = key_fingerprint(recipient_public_key_pem)
+        
+        with self._session_lock:
+            session = self._outgoing_sessions.get(fingerprint)
+            if session is None or session.expired():
+                recipient_public_key = self.load_recipient_public_key(recipient_public_key_pem)
+                session = SessionKey(recipient_public_key)
+                self._outgoing_sessions[fingerprint] = session
+            nonce = session.next_nonce()
+            
+        # session_id как associated data привязывает шифротекст к сеансу
+        encrypted_message = session.aesgcm.encrypt(nonce, message.encode(), session.session_id)
+        
+        if binary:
+            return encode_envelope(KIND_SESSION, {
+                'session_id': session.session_id,
+                'encrypted_key': session.encrypted_key,
+                'nonce': nonce,
+                'encrypted_message': encrypted_message
+            })
+        
+        return {
+            'session_id': session.session_id_b64,
+            'encrypted_key': session.encrypted_key_b64,
+            'nonce': base64.b64encode(nonce).decode(),
+            'encrypted_message': base64.b64encode(encrypted_message).decode()
+        }
+        
+    def create_stream(self, recipient_public_key_pem: bytes, chunk_size: int = ATTACHMENT_CHUNK_SIZE):
+        """
+        Новый зашифрованный поток для получателя
+        Возвращает (заголовок потока, StreamCipher)
+        """
+        key = AESGCM.generate_key(bit_length=256)
+        cipher = StreamCipher(key, chunk_size=chunk_size)
+        recipient_public_key = self.load_recipient_public_key(recipient_public_key_pem)
+        encrypted_key = recipient_public_key.encrypt(key, OAEP_PADDING)
+        return encode_stream_header(encrypted_key, cipher.nonce_prefix, chunk_size), cipher
+        
+    def open_stream(self, header) -> StreamCipher:
+        """Открытие входящего потока по его заголовку"""
+        if not self.private_key:
+            raise Exception("Private key not loaded")
+        encrypted_key, nonce_prefix, chunk_size = decode_stream_header(header)
+        key = self.private_key.decrypt(bytes(encrypted_key), OAEP_PADDING)
+        return StreamCipher(key, nonce_prefix, chunk_size)
+        
+    def sign(self, data: bytes) -> bytes:
+        """Подпись данных своим приватным ключом (RSA-PSS)"""
         if not self.private_key:
             raise Exception("Private key not loaded")
+        return self.private_key.sign(data, PSS_PADDING, hashes.SHA256())
+        
+    def verify_signature(self, data: bytes, signature: bytes, public_key_pem: bytes) -> bool:
+        """Проверка подписи публичным ключом собеседника"""
+        public_key = self.load_recipient_public_key(public_key_pem)
+        try:
+            public_key.verify(bytes(signature), data, PSS_PADDING, hashes.SHA256())
+            return True
+        except InvalidSignature:
+            return False
+        
+    def reset_sessions(self):
+        """Сброс всех сеансовых ключей"""
+        with self._session_lock:
+            self._outgoing_sessions.clear()
+            self._incoming_sessions.clear()
+        
+    def decrypt_message(self, encrypted_data):
+        """
+        Расшифровка сообщения
+        Принимает бинарный конверт (bytes/memoryview) или словарь с base64 полями
+        """
+        if not self.private_key:
+            raise Exception("Private key not loaded")
+            
+        if is_binary_envelope(encrypted_data):
+            kind, fields = decode_envelope(encrypted_data)
+            if kind == KIND_SESSION:
+                return self._decrypt_session(**fields)
+            return self._decrypt_hybrid(**fields)
             
+        fields = {name: base64.b64decode(value) for name, value in encrypted_data.items()}
+        if 'session_id' in fields:
+            return self._decrypt_session(fields['session_id'], fields['encrypted_key'],
+                                         fields['nonce'], fields['encrypted_message'])
+        return self._decrypt_hybrid(fields['encrypted_key'], fields['iv'],
+                                    fields['encrypted_message'])
+        
+    def _decrypt_hybrid(self, encrypted_key, iv, encrypted_message):
+        """Расшифровка гибридного конверта (RSA + AES-CBC)"""
         # Расшифровываем симметричный ключ
-        encrypted_key = base64.b64decode(encrypted_data['encrypted_key'])
-        symmetric_key = self.private_key.decrypt(
-            encrypted_key,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+        symmetric_key = self.private_key.decrypt(bytes(encrypted_key), OAEP_PADDING)
         
         # Расшифровываем сообщение
-        encrypted_message = base64.b64decode(encrypted_data['encrypted_message'])
-        iv = base64.b64decode(encrypted_data['iv'])
-        
-        cipher = Cipher(algorithms.AES(symmetric_key), modes.CBC(iv))
+        cipher = Cipher(algorithms.AES(symmetric_key), modes.CBC(bytes(iv)))
         decryptor = cipher.decryptor()
         padded_message = decryptor.update(encrypted_message) + decryptor.finalize()
         
@@ -133,4 +459,38 @@ class CryptoManager:
         unpadder = sym_padding.PKCS7(128).unpadder()
         message = unpadder.update(padded_message) + unpadder.finalize()
         
-        return message.decode()
\ No newline at end of file
+        return message.decode()
+        
+    def _decrypt_session(self, session_id, encrypted_key, nonce, encrypted_message):
+        """Расшифровка сообщения, зашифрованного сеансовым ключом"""
+        session_id = bytes(session_id)
+        nonce = bytes(nonce)
+        counter = int.from_bytes(nonce, 'big')
+        # Чужой конверт с тем же session_id, но своим ключом, получает
+        # свою запись и не подменяет ключ настоящего сеанса
+        cache_key = (session_id, hashlib.sha256(encrypted_key).digest())
+        
+        with self._session_lock:
+            session = self._incoming_sessions.get(cache_key)
+            if session is not None:
+                self._incoming_sessions.move_to_end(cache_key)
+                if session.is_replay(counter):
+                    raise ReplayError("Replayed session message")
+                    
+        if session is None:
+            # Первое сообщение сеанса: одна RSA операция на весь сеанс
+            session = IncomingSession(AESGCM(self.private_key.decrypt(bytes(encrypted_key),
+                                                                      OAEP_PADDING)))
+        message = session.aesgcm.decrypt(nonce, encrypted_message, session_id).decode()
+        
+        # Ключ кэшируется и номер засчитывается только после проверки тега
+        with self._session_lock:
+            cached = self._incoming_sessions.setdefault(cache_key, session)
+            if cached.is_replay(counter):
+                # Тот же номер расшифрован параллельно в другом потоке
+                raise ReplayError("Replayed session message")
+            cached.accept(counter)
+            while len(self._incoming_sessions) > SESSION_CACHE_SIZE:
+                self._incoming_sessions.popitem(last=False)
+                
+        return message
@@ -0,0 +1,167 @@
+"""
+Бинарный формат конверта зашифрованного сообщения
+
+    magic 'SM' | version (1 байт) | kind (1 байт) | поля вида
+
+    KIND_HYBRID:  key_len (2) | encrypted_key | iv (16) | AES-CBC шифротекст
+    KIND_SESSION: session_id (16) | key_len (2) | encrypted_key | nonce (12) |
+                  AES-GCM шифротекст с тегом
+    KIND_STREAM:  key_len (2) | encrypted_key | nonce_prefix (7) | chunk_size (4)
+                  - заголовок потока, фрагменты передаются отдельно
+
+Разбор возвращает memoryview срезы исходного буфера без копирования.
+JSON форма (base64 в словаре) по-прежнему поддерживается для совместимости.
+"""
+import base64
+import struct
+
+MAGIC = b'SM'
+VERSION = 1
+
+KIND_HYBRID = 1
+KIND_SESSION = 2
+KIND_STREAM = 3
+
+ENVELOPE_HEADER = struct.Struct('!2sBB')
+KEY_LENGTH = struct.Struct('!H')
+CHUNK_SIZE = struct.Struct('!I')
+
+IV_SIZE = 16
+NONCE_SIZE = 12
+SESSION_ID_SIZE = 16
+STREAM_NONCE_PREFIX_SIZE = 7
+
+# Поля каждого вида конверта в порядке их следования
+FIELDS = {
+    KIND_HYBRID: ('encrypted_key', 'iv', 'encrypted_message'),
+    KIND_SESSION: ('session_id', 'encrypted_key', 'nonce', 'encrypted_message'),
+}
+
+
+class EnvelopeError(ValueError):
+    """Неверный формат конверта"""
+
+
+def is_binary_envelope(data) -> bool:
+    """
+    Проверка, является ли объект бинарным конвертом
+    """
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:2]) == MAGIC
+
+
+def encode_envelope(kind: int, fields: dict) -> bytes:
+    """
+    Сборка бинарного конверта из полей (bytes)
+    """
+    encrypted_key = fields['encrypted_key']
+    parts = [ENVELOPE_HEADER.pack(MAGIC, VERSION, kind)]
+
+    if kind == KIND_HYBRID:
+        parts += [KEY_LENGTH.pack(len(encrypted_key)), encrypted_key,
+                  fields['iv'], fields['encrypted_message']]
+    elif kind == KIND_SESSION:
+        parts += [fields['session_id'], KEY_LENGTH.pack(len(encrypted_key)), encrypted_key,
+                  fields['nonce'], fields['encrypted_message']]
+    else:
+        raise EnvelopeError(f"Unknown envelope kind: {kind}")
+
+    return b''.join(parts)
+
+
+def _take(view, offset: int, size: int, what: str = "Envelope"):
+    # Срез поля с проверкой длины: обрезанный буфер - ошибка формата,
+    # а не struct.error или молча укороченное поле
+    end = offset + size
+    if end > len(view):
+        raise EnvelopeError(f"{what} truncated")
+    return view[offset:end], end
+
+
+def decode_envelope(data):
+    """
+    Разбор бинарного конверта
+
+    Возвращает (kind, поля), где поля - memoryview срезы data.
+    """
+    view = memoryview(data)
+    if len(view) < ENVELOPE_HEADER.size:
+        raise EnvelopeError("Envelope too short")
+
+    magic, version, kind = ENVELOPE_HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise EnvelopeError("Bad envelope magic")
+    if version != VERSION:
+        raise EnvelopeError(f"Unsupported envelope version: {version}")
+
+    offset = ENVELOPE_HEADER.size
+    fields = {}
+
+    if kind == KIND_SESSION:
+        fields['session_id'], offset = _take(view, offset, SESSION_ID_SIZE)
+    elif kind != KIND_HYBRID:
+        raise EnvelopeError(f"Unknown envelope kind: {kind}")
+
+    key_length_field, offset = _take(view, offset, KEY_LENGTH.size)
+    (key_length,) = KEY_LENGTH.unpack(key_length_field)
+    fields['encrypted_key'], offset = _take(view, offset, key_length)
+
+    if kind == KIND_HYBRID:
+        fields['iv'], offset = _take(view, offset, IV_SIZE)
+    else:
+        fields['nonce'], offset = _take(view, offset, NONCE_SIZE)
+
+    fields['encrypted_message'] = view[offset:]
+    return kind, fields
+
+
+def envelope_to_dict(data) -> dict:
+    """
+    Преобразование бинарного конверта в JSON форму (base64)
+    """
+    kind, fields = decode_envelope(data)
+    return {name: base64.b64encode(value).decode() for name, value in fields.items()}
+
+
+def envelope_from_dict(encrypted_data: dict) -> bytes:
+    """
+    Преобразование JSON формы конверта в бинарную
+    """
+    kind = KIND_SESSION if 'session_id' in encrypted_data else KIND_HYBRID
+    fields = {name: base64.b64decode(encrypted_data[name]) for name in FIELDS[kind]}
+    return encode_envelope(kind, fields)
+
+
+def encode_stream_header(encrypted_key: bytes, nonce_prefix: bytes, chunk_size: int) -> bytes:
+    """
+    Сборка заголовка зашифрованного потока
+    """
+    return b''.join([
+        ENVELOPE_HEADER.pack(MAGIC, VERSION, KIND_STREAM),
+        KEY_LENGTH.pack(len(encrypted_key)),
+        encrypted_key,
+        nonce_prefix,
+        CHUNK_SIZE.pack(chunk_size)
+    ])
+
+
+def decode_stream_header(data):
+    """
+    Разбор заголовка потока: (encrypted_key, nonce_prefix, chunk_size)
+    """
+    view = memoryview(data)
+    if len(view) < ENVELOPE_HEADER.size + KEY_LENGTH.size:
+        raise EnvelopeError("Stream header too short")
+    magic, version, kind = ENVELOPE_HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION or kind != KIND_STREAM:
+        raise EnvelopeError("Not a stream header")
+
+    what = "Stream header"
+    key_length_field, offset = _take(view, ENVELOPE_HEADER.size, KEY_LENGTH.size, what)
+    (key_length,) = KEY_LENGTH.unpack(key_length_field)
+    encrypted_key, offset = _take(view, offset, key_length, what)
+    nonce_prefix, offset = _take(view, offset, STREAM_NONCE_PREFIX_SIZE, what)
+    chunk_size_field, offset = _take(view, offset, CHUNK_SIZE.size, what)
+    if offset != len(view):
+        raise EnvelopeError("Stream header has trailing data")
+    (chunk_size,) = CHUNK_SIZE.unpack(chunk_size_field)
+    return encrypted_key, nonce_prefix, chunk_size
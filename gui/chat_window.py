@@ -2,16 +2,34 @@
 Chat window for Secure Messenger
 """
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QTextEdit, 
-                            QLineEdit, QPushButton, QListWidget, QLabel, 
+                            QLineEdit, QPushButton, QListWidget, QListWidgetItem, QLabel, 
                             QSplitter, QMessageBox)
 from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QTextCursor
+from collections import namedtuple
+from datetime import datetime
+from storage.database import message_cursor
+
+# Messages fetched per scroll step
+HISTORY_PAGE_SIZE = 50
+
+# Messages kept in the display; older/newer ones are dropped and re-fetched
+HISTORY_WINDOW = 500
+
+# Message shown live before it has been read back from the database
+LiveMessage = namedtuple('LiveMessage', 'id peer_id content timestamp direction')
 
 class ChatWindow(QWidget):
     def __init__(self, messenger_app, parent=None):
         super().__init__(parent)
         self.messenger_app = messenger_app
         self.current_peer = None
+        # Window of loaded history, oldest first
+        self.loaded_messages = []
+        self.has_older = False
+        self.has_newer = False
+        self._rendering = False
+        self.showing_search = False
         self.init_ui()
         self.setup_connections()
         
@@ -26,6 +44,12 @@ class ChatWindow(QWidget):
         left_panel = QVBoxLayout()
         left_panel.addWidget(QLabel("Contacts:"))
         
+        # Message search
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Search messages...")
+        self.search_input.returnPressed.connect(self.search_messages)
+        left_panel.addWidget(self.search_input)
+        
         self.peers_list = QListWidget()
         self.peers_list.itemClicked.connect(self.on_peer_selected)
         left_panel.addWidget(self.peers_list)
@@ -53,6 +77,7 @@ class ChatWindow(QWidget):
                 font-size: 12px;
             }
         """)
+        self.chat_display.verticalScrollBar().valueChanged.connect(self.on_history_scrolled)
         right_panel.addWidget(self.chat_display)
         
         # Message input
@@ -93,17 +118,27 @@ class ChatWindow(QWidget):
         pass
         
     def refresh_peers(self):
-        """Refresh peers list"""
+        """Refresh peers list, most recent conversations first"""
         self.peers_list.clear()
-        peers = self.messenger_app.db_manager.get_all_peers()
-        for peer in peers:
-            self.peers_list.addItem(peer.peer_id)
+        conversations = self.messenger_app.db_manager.get_conversations()
+        for conversation in conversations:
+            label = conversation.peer_id
+            if conversation.unread_count:
+                label = f"{label} ({conversation.unread_count})"
+            item = QListWidgetItem(label)
+            item.setData(Qt.UserRole, conversation.peer_id)
+            if conversation.preview:
+                item.setToolTip(conversation.preview)
+            self.peers_list.addItem(item)
+            if conversation.peer_id == self.current_peer:
+                self.peers_list.setCurrentItem(item)
             
     def on_peer_selected(self, item):
         """Handle peer selection"""
-        self.current_peer = item.text()
-        self.chat_display.clear()
-        self.chat_display.append(f"Selected peer: {self.current_peer}")
+        self.current_peer = item.data(Qt.UserRole)
+        self.messenger_app.db_manager.mark_read(self.current_peer)
+        item.setText(self.current_peer)
+        self.load_latest_history()
         self.message_input.setFocus()
         
     def add_peer(self):
@@ -142,7 +177,7 @@ class ChatWindow(QWidget):
             
         try:
             if self.messenger_app.send_message(self.current_peer, message):
-                self.append_message(f"You: {message}", "sent")
+                self.add_live_message(self.current_peer, message, "sent")
                 self.message_input.clear()
             else:
                 QMessageBox.critical(self, "Error", "Failed to send message")
@@ -159,29 +194,151 @@ class ChatWindow(QWidget):
         
     def incoming_message(self, sender_id, message):
         """Handle incoming message"""
-        self.append_message(f"{sender_id}: {message}", "received")
+        if sender_id == self.current_peer:
+            self.add_live_message(sender_id, message, "received")
+            self.messenger_app.db_manager.mark_read(sender_id)
+        else:
+            self.append_message(f"{sender_id}: {message}", "received")
+            self.refresh_peers()
+            
+    def add_live_message(self, peer_id, message, direction):
+        """Show a just sent/received message for the current peer"""
+        if self.has_newer or self.showing_search:
+            # The user is reading older history or search results; the message is loaded later
+            return
+        record = LiveMessage(None, peer_id, message, datetime.utcnow(), direction)
+        self.loaded_messages.append(record)
+        self.append_message(self.format_message(record), direction)
+        if len(self.loaded_messages) > HISTORY_WINDOW:
+            del self.loaded_messages[:-HISTORY_WINDOW]
+            self.has_older = True
+        
+    def format_message(self, msg):
+        """One display line per message"""
+        direction = "You" if msg.direction == 'sent' else msg.peer_id
+        timestamp = msg.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+        # U+2028 keeps multi-line messages inside a single text block
+        content = msg.content.replace('\n', '\u2028')
+        return f"[{timestamp}] {direction}: {content}"
         
     def show_history(self):
         """Show message history with current peer"""
         if not self.current_peer:
             QMessageBox.warning(self, "Warning", "Please select a peer first")
             return
-            
+        self.load_latest_history()
+        
+    def search_messages(self):
+        """Show full-text search results, limited to the current peer if one is selected"""
+        query = self.search_input.text().strip()
+        if not query:
+            if self.current_peer:
+                self.load_latest_history()
+            return
         try:
-            messages = self.messenger_app.db_manager.get_message_history(self.current_peer)
-            if not messages:
-                QMessageBox.information(self, "History", "No messages found")
+            results = self.messenger_app.db_manager.search_messages(
+                query, peer_id=self.current_peer, limit=HISTORY_PAGE_SIZE
+            )
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Search failed: {str(e)}")
+            return
+        # Results are not a history window; stop scroll paging until a peer is reopened
+        self.loaded_messages = []
+        self.has_older = False
+        self.has_newer = False
+        self.showing_search = True
+        self._rendering = True
+        try:
+            if not results:
+                self.chat_display.setPlainText(f"No messages found for '{query}'")
                 return
-                
-            history_text = "Message History:\n" + "="*50 + "\n"
-            for msg in reversed(messages):
-                direction = "You" if msg.direction == 'sent' else msg.peer_id
-                timestamp = msg.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-                history_text += f"[{timestamp}] {direction}: {msg.content}\n"
-                
-            # Show in message area
-            self.chat_display.clear()
-            self.chat_display.append(history_text)
+            self.chat_display.setPlainText("\n".join(
+                self.format_message(LiveMessage(r.id, r.peer_id, r.snippet, r.timestamp, r.direction))
+                for r in results
+            ))
+        finally:
+            self._rendering = False
             
+    def load_latest_history(self):
+        """Load the newest page of history for the current peer"""
+        try:
+            page = self.messenger_app.db_manager.get_message_history(
+                self.current_peer, limit=HISTORY_PAGE_SIZE
+            )
         except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to load history: {str(e)}")
\ No newline at end of file
+            QMessageBox.critical(self, "Error", f"Failed to load history: {str(e)}")
+            return
+        page.reverse()
+        self.loaded_messages = page
+        self.has_older = len(page) == HISTORY_PAGE_SIZE
+        self.has_newer = False
+        self.render_history(at_bottom=True)
+        
+    def on_history_scrolled(self, value):
+        """Fetch the adjacent page when the user scrolls to either end"""
+        if self._rendering or not self.current_peer:
+            return
+        bar = self.chat_display.verticalScrollBar()
+        if value == bar.minimum() and self.has_older:
+            self.load_older_history()
+        elif value == bar.maximum() and self.has_newer:
+            self.load_newer_history()
+            
+    def load_older_history(self):
+        """Prepend the page before the oldest loaded message"""
+        oldest = self.loaded_messages[0]
+        if oldest.id is None:
+            # Only unsaved live messages are left in the window
+            self.load_latest_history()
+            return
+        page = self.messenger_app.db_manager.get_message_history(
+            self.current_peer, limit=HISTORY_PAGE_SIZE, before=message_cursor(oldest)
+        )
+        self.has_older = len(page) == HISTORY_PAGE_SIZE
+        if not page:
+            return
+        page.reverse()
+        self.loaded_messages = page + self.loaded_messages
+        if len(self.loaded_messages) > HISTORY_WINDOW:
+            # Drop the newest messages; they are re-fetched on scroll down
+            self.loaded_messages = self.loaded_messages[:HISTORY_WINDOW]
+            self.has_newer = True
+        self.render_history(anchor_index=len(page))
+        
+    def load_newer_history(self):
+        """Append the page after the newest loaded message"""
+        newest = self.loaded_messages[-1]
+        page = self.messenger_app.db_manager.get_message_history(
+            self.current_peer, limit=HISTORY_PAGE_SIZE, after=message_cursor(newest)
+        )
+        self.has_newer = len(page) == HISTORY_PAGE_SIZE
+        if not page:
+            return
+        page.reverse()
+        anchor_index = len(self.loaded_messages) - 1
+        self.loaded_messages = self.loaded_messages + page
+        if len(self.loaded_messages) > HISTORY_WINDOW:
+            dropped = len(self.loaded_messages) - HISTORY_WINDOW
+            self.loaded_messages = self.loaded_messages[dropped:]
+            anchor_index -= dropped
+            self.has_older = True
+        self.render_history(anchor_index=anchor_index)
+        
+    def render_history(self, anchor_index=None, at_bottom=False):
+        """Redraw the loaded window, keeping anchor_index at the top of the view"""
+        self.showing_search = False
+        self._rendering = True
+        try:
+            self.chat_display.setPlainText(
+                "\n".join(self.format_message(msg) for msg in self.loaded_messages)
+            )
+            bar = self.chat_display.verticalScrollBar()
+            if at_bottom:
+                bar.setValue(bar.maximum())
+            elif anchor_index is not None:
+                block = self.chat_display.document().findBlockByNumber(max(anchor_index, 0))
+                cursor = QTextCursor(block)
+                self.chat_display.setTextCursor(cursor)
+                bar.setValue(bar.value() + self.chat_display.cursorRect(cursor).top())
+        finally:
+            self._rendering = False
@@ -1,16 +1,20 @@
 """
 Main window for Secure Messenger GUI
 """
-from PyQt5.QtWidgets import QMainWindow, QMessageBox
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QMainWindow, QMessageBox, QDialog
+from PyQt5.QtCore import Qt, pyqtSignal
 from gui.chat_window import ChatWindow
 from gui.login_dialog import LoginDialog
 
 class MainWindow(QMainWindow):
+    # Incoming messages arrive on the delivery thread and are marshalled here
+    message_received = pyqtSignal(str, str)
+    
     def __init__(self):
         super().__init__()
         self.messenger_app = None
         self.chat_window = None
+        self.message_received.connect(self.handle_incoming_message)
         self.init_ui()
         self.show_login()
         
@@ -34,7 +38,7 @@ class MainWindow(QMainWindow):
             self.messenger_app = MessengerApp(peer_id, host, port)
             
             # Setup message callback
-            self.messenger_app.client.set_message_callback(self.handle_incoming_message)
+            self.messenger_app.set_incoming_callback(self.message_received.emit)
             
             # Show chat window
             self.chat_window = ChatWindow(self.messenger_app)
@@ -45,25 +49,13 @@ class MainWindow(QMainWindow):
             QMessageBox.critical(self, "Error", f"Failed to start messenger: {str(e)}")
             self.show_login()
             
-    def handle_incoming_message(self, message_data):
-        """Handle incoming message"""
-        if self.chat_window and message_data.get('type') == 'message':
-            sender_id = message_data.get('from')
-            encrypted_data = message_data.get('data')
-            
-            try:
-                decrypted_message = self.messenger_app.crypto_manager.decrypt_message(encrypted_data)
-                self.messenger_app.db_manager.save_message(sender_id, decrypted_message, 'received')
-                
-                # Update GUI
-                if hasattr(self.chat_window, 'incoming_message'):
-                    self.chat_window.incoming_message(sender_id, decrypted_message)
-                    
-            except Exception as e:
-                print(f"Error decrypting message: {e}")
+    def handle_incoming_message(self, sender_id, message):
+        """Handle incoming message (already decrypted and saved)"""
+        if self.chat_window:
+            self.chat_window.incoming_message(sender_id, message)
                 
     def closeEvent(self, event):
         """Handle window close"""
         if self.messenger_app:
-            self.messenger_app.client.disconnect()
+            self.messenger_app.shutdown()
         event.accept()
\ No newline at end of file
@@ -2,10 +2,26 @@
 Основной клиент для Secure Messenger с поддержкой P2P
 """
 import socket
-import json
 import threading
+from collections import deque
 from typing import Callable, Optional
-from config.settings import DEFAULT_HOST, DEFAULT_PORT
+from config.settings import DEFAULT_HOST, DEFAULT_PORT, PATH_ACTIVE_WINDOW, PATH_PROBE_INTERVAL
+from network.path_selector import PATH_P2P, PATH_RELAY, PathSelector
+from network.protocol import FrameDecoder, ProtocolError, encode_frame, new_message_id
+
+# Размер буфера чтения из сокета relay сервера
+RECV_BUFFER_SIZE = 65536
+
+class _PendingFrame:
+    """
+    Кадр в очереди отправки и результат пачки, в которой он ушел
+    """
+    __slots__ = ('frame', 'done', 'error')
+    
+    def __init__(self, frame: bytes):
+        self.frame = frame
+        self.done = False
+        self.error = None
 
 class MessageClient:
     def __init__(self, peer_id: str, host=DEFAULT_HOST, port=DEFAULT_PORT, 
@@ -18,6 +34,12 @@ class MessageClient:
         self.message_callback = None
         self.use_p2p = use_p2p
         self.p2p_client = None
+        # Очередь исходящих кадров: все накопленные кадры уходят одним sendall
+        self._send_queue = deque()
+        self._send_lock = threading.Lock()
+        # Выбор пути к каждому пиру по RTT и потерям
+        self.path_selector = PathSelector()
+        self._probe_stop = threading.Event()
         
     def connect(self, crypto_manager=None):
         """
@@ -26,6 +48,7 @@ class MessageClient:
         # Подключение к центральному серверу
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.socket.connect((self.host, self.port))
             
             # Регистрация клиента
@@ -33,7 +56,7 @@ class MessageClient:
                 'type': 'register',
                 'peer_id': self.peer_id
             }
-            self.socket.send(json.dumps(register_msg).encode())
+            self._send_frame(encode_frame(register_msg))
             
             self.connected = True
             
@@ -42,6 +65,12 @@ class MessageClient:
             receive_thread.daemon = True
             receive_thread.start()
             
+            # Периодические пробы путей к активным пирам
+            self._probe_stop = threading.Event()
+            probe_thread = threading.Thread(target=self._probe_loop)
+            probe_thread.daemon = True
+            probe_thread.start()
+            
             print("Connected to relay server")
             
         except Exception as e:
@@ -55,6 +84,8 @@ class MessageClient:
                 self.p2p_client = P2PClient(self.peer_id, crypto_manager)
                 self.p2p_client.start()
                 self.p2p_client.set_message_callback(self._handle_p2p_message)
+                self.p2p_client.set_pong_callback(self._handle_p2p_pong)
+                self.p2p_client.set_connection_callback(self._handle_p2p_connection)
                 print("P2P client initialized")
             except Exception as e:
                 print(f"P2P initialization failed: {e}")
@@ -66,6 +97,7 @@ class MessageClient:
         Отключение от сервера и P2P
         """
         self.connected = False
+        self._probe_stop.set()
         
         if self.socket:
             self.socket.close()
@@ -73,20 +105,60 @@ class MessageClient:
         if self.p2p_client:
             self.p2p_client.stop()
             
-    def send_message(self, to_peer_id: str, encrypted_data: dict, 
-                    try_p2p: bool = True) -> bool:
+    def send_message(self, to_peer_id: str, encrypted_data, 
+                    try_p2p: bool = True, headers: Optional[dict] = None) -> bool:
         """
         Отправка сообщения (сначала P2P, потом через сервер)
+        headers - дополнительные поля заголовка (например, для передачи файлов)
+        
+        Оба пути несут один message_id (из headers или новый), поэтому
+        сообщение, дошедшее дважды, получатель сохранит один раз.
+        
+        Путь выбирает path_selector по измеренным RTT и потерям; прямой путь
+        доступен только после подтверждения пиром (без ожидания hole punching).
+        Отправка через P2P не ждет подтверждения: True значит, что сообщение
+        принято к доставке, а если пир его не подтвердит, оно уйдет через relay.
         """
-        # Пытаемся отправить через P2P если доступно
-        if try_p2p and self.p2p_client:
+        headers = dict(headers) if headers else {}
+        headers.setdefault('message_id', new_message_id())
+        
+        available = []
+        if try_p2p and self.p2p_client and self.p2p_client.is_connected(to_peer_id):
+            available.append(PATH_P2P)
+        if self.connected:
+            available.append(PATH_RELAY)
+        path = self.path_selector.select(to_peer_id, available)
+        
+        if path == PATH_P2P:
             try:
-                if self.p2p_client.send_p2p_message(to_peer_id, encrypted_data):
-                    return True
+                delivery = self.p2p_client.send_p2p_message(
+                    to_peer_id, encrypted_data, headers,
+                    lambda ok: self._on_p2p_delivery(to_peer_id, encrypted_data, headers, ok))
             except Exception as e:
                 print(f"P2P send failed: {e}")
-                
-        # Если P2P не сработал, отправляем через сервер
+                delivery = None
+            if delivery is not None:
+                return True
+            self.path_selector.record_loss(to_peer_id, PATH_P2P)
+            
+        # Если P2P не выбран или не сработал, отправляем через сервер
+        return self._send_relay(to_peer_id, encrypted_data, headers)
+        
+    def _on_p2p_delivery(self, to_peer_id: str, encrypted_data, headers: dict, ok: bool):
+        """
+        Итог отправки через P2P (пул потоков): без подтверждения - через relay
+        """
+        if ok:
+            # RTT обоих путей меряют только пробы: время до подтверждения
+            # включает очередь надежной доставки и с relay несравнимо
+            self.path_selector.record_success(to_peer_id, PATH_P2P)
+            return
+        self.path_selector.record_loss(to_peer_id, PATH_P2P)
+        if not self._send_relay(to_peer_id, encrypted_data, headers):
+            print(f"Message {headers['message_id']} to {to_peer_id} was not delivered")
+            
+    def _send_relay(self, to_peer_id: str, encrypted_data, headers: dict) -> bool:
+        """Отправка сообщения через сервер"""
         if not self.connected:
             return False
             
@@ -96,37 +168,129 @@ class MessageClient:
             'to': to_peer_id,
             'data': encrypted_data
         }
+        message.update(headers)
         
         try:
-            self.socket.send(json.dumps(message).encode())
+            self._send_frame(encode_frame(message))
             return True
         except Exception as e:
             print(f"Failed to send message through relay: {e}")
+            self.path_selector.record_loss(to_peer_id, PATH_RELAY)
             return False
             
+    def _send_frame(self, frame: bytes):
+        """
+        Отправка кадра с объединением очереди исходящих кадров
+        
+        Кадр ставится в очередь; поток, захвативший блокировку, отправляет
+        одним sendall все кадры, накопившиеся к этому моменту, в том числе
+        поставленные другими потоками. Если sendall пачки не удался, ошибку
+        получает каждый поток, чей кадр был в этой пачке.
+        """
+        pending = _PendingFrame(frame)
+        self._send_queue.append(pending)
+        with self._send_lock:
+            # Пачка, забравшая наш кадр, уже отправлена под этой же блокировкой
+            if not pending.done:
+                batch = []
+                while self._send_queue:
+                    batch.append(self._send_queue.popleft())
+                try:
+                    self.socket.sendall(b''.join(item.frame for item in batch))
+                except Exception as e:
+                    for item in batch:
+                        item.error = e
+                finally:
+                    for item in batch:
+                        item.done = True
+        if pending.error is not None:
+            raise pending.error
+            
     def receive_messages(self):
         """
         Получение сообщений через сервер
         """
+        decoder = FrameDecoder()
         try:
             while self.connected:
-                data = self.socket.recv(4096)
+                data = self.socket.recv(RECV_BUFFER_SIZE)
                 if not data:
                     break
                     
-                try:
-                    message = json.loads(data.decode())
+                for message in decoder.feed(data):
+                    if message.get('type') in ('ping', 'pong'):
+                        self._handle_relay_probe(message)
+                        continue
                     if self.message_callback:
                         self.message_callback(message)
-                except json.JSONDecodeError:
-                    continue
                     
+        except ProtocolError as e:
+            print(f"Relay protocol error: {e}")
         except Exception as e:
             if self.connected:
                 print(f"Error receiving messages: {e}")
         finally:
             self.connected = False
             
+    def _probe_loop(self):
+        """
+        Периодические пробы обоих путей к пирам, которым недавно писали
+        """
+        while not self._probe_stop.wait(PATH_PROBE_INTERVAL):
+            self.path_selector.expire_probes()
+            self.path_selector.forget_inactive()
+            for peer_id in self.path_selector.active_peers(PATH_ACTIVE_WINDOW):
+                if self.connected:
+                    self._probe_path(peer_id, PATH_RELAY)
+                if self.p2p_client and self.p2p_client.is_connected(peer_id):
+                    self._probe_path(peer_id, PATH_P2P)
+                    
+    def _probe_path(self, peer_id: str, path: str):
+        """
+        Отправка пробы; без ответа она будет учтена как потеря
+        """
+        probe_id = self.path_selector.start_probe(peer_id, path)
+        try:
+            if path == PATH_P2P:
+                self.p2p_client.send_ping(peer_id, probe_id)
+            else:
+                ping = {'type': 'ping', 'from': self.peer_id, 'to': peer_id, 'id': probe_id}
+                self._send_frame(encode_frame(ping))
+        except Exception as e:
+            print(f"Path probe to {peer_id} failed: {e}")
+            
+    def _handle_relay_probe(self, message: dict):
+        """
+        Ответ на пробу пира через relay или учет ответа на нашу
+        """
+        sender = message.get('from')
+        if not sender:
+            # Ответ самого сервера
+            return
+        if message.get('type') == 'ping':
+            pong = {'type': 'pong', 'from': self.peer_id, 'to': sender, 'id': message.get('id')}
+            try:
+                self._send_frame(encode_frame(pong))
+            except Exception as e:
+                print(f"Failed to answer relay ping: {e}")
+        else:
+            self.path_selector.complete_probe(message.get('id'), sender, PATH_RELAY)
+            
+    def _handle_p2p_pong(self, peer_id: str, probe_id):
+        self.path_selector.complete_probe(probe_id, peer_id, PATH_P2P)
+        
+    def _handle_p2p_connection(self, peer_id: str, state: str):
+        # Только что подтвержденный прямой путь сразу измеряем,
+        # чтобы не ждать следующего цикла проб
+        if self.p2p_client.is_connected(peer_id):
+            self._probe_path(peer_id, PATH_P2P)
+            
+    def get_route(self, peer_id: str) -> dict:
+        """
+        Текущий путь к пиру ('p2p', 'relay' или None) и измерения путей
+        """
+        return self.path_selector.get_route(peer_id)
+        
     def set_message_callback(self, callback: Callable):
         """
         Установка callback для входящих сообщений
@@ -148,14 +312,39 @@ class MessageClient:
             return self.p2p_client.get_public_address()
         return None
         
-    def establish_p2p_connection(self, peer_id: str, peer_ip: str, peer_port: int):
+    def get_nat_type(self) -> Optional[str]:
         """
-        Установка P2P соединения
+        Тип NAT P2P клиента (None - P2P выключен)
         """
         if self.p2p_client:
-            return self.p2p_client.establish_p2p_connection(peer_id, peer_ip, peer_port)
+            return self.p2p_client.get_nat_type()
+        return None
+        
+    def establish_p2p_connection(self, peer_id: str, peer_ip: str, peer_port: int,
+                                 peer_nat_type: Optional[str] = None, public_key=None):
+        """
+        Установка P2P соединения (False - пир доступен только через сервер)
+        """
+        if self.p2p_client:
+            return self.p2p_client.establish_p2p_connection(peer_id, peer_ip, peer_port,
+                                                            peer_nat_type, public_key)
         return False
         
+    def connect_p2p(self, peer_id: str, peer_ip: str, peer_port: int, public_key,
+                    peer_nat_type: Optional[str] = None, callback: Callable = None):
+        """
+        Установка P2P соединения в фоне
+        
+        callback(peer_id, connected) вызывается по завершении; до этого
+        сообщения пиру идут через сервер. Возвращает future или None без P2P.
+        """
+        if not self.p2p_client:
+            return None
+        future = self.p2p_client.connect(peer_id, peer_ip, peer_port, public_key, peer_nat_type)
+        if callback:
+            future.add_done_callback(lambda f: callback(peer_id, f.result()))
+        return future
+        
     def add_p2p_peer(self, peer_id: str, ip: str, port: int, public_key: str):
         """
         Добавление пира для P2P соединения
@@ -0,0 +1,217 @@
+"""
+Локальный STUN сервер с имитацией NAT для проверки STUNClient
+
+Слушает два IP (по умолчанию 127.0.0.1 и 127.0.0.2, на Linux оба адреса
+loopback есть всегда) и два порта на каждом, как сервер RFC 5780, и
+отвечает с XOR-MAPPED-ADDRESS, OTHER-ADDRESS и RESPONSE-ORIGIN, выполняя
+CHANGE-REQUEST. Между клиентом и сервером имитируется NAT с заданным
+поведением отображения и фильтрации: внешний порт выдается по правилам
+mapping, а ответ, который такой NAT не пропустил бы, не отправляется.
+
+    server = FakeSTUNServer(mapping=ADDRESS_DEPENDENT)
+    server.start()
+    behavior = STUNClient(server.servers, cache_path=None).get_nat_behavior(timeout=1.0)
+    server.stop()
+
+Запуск отдельно: python -m network.fake_stun_server [mapping] [filtering]
+"""
+import selectors
+import socket
+import struct
+import threading
+from typing import List, Optional, Tuple
+from network.stun_client import (
+    ADDRESS_AND_PORT_DEPENDENT, ADDRESS_DEPENDENT, BINDING_ERROR, BINDING_REQUEST,
+    BINDING_RESPONSE, CHANGE_IP, CHANGE_PORT, CHANGE_REQUEST, ENDPOINT_INDEPENDENT,
+    MAGIC_COOKIE, OTHER_ADDRESS, RESPONSE_ORIGIN, XOR_MAPPED_ADDRESS, is_stun_message,
+)
+
+# Внешний адрес имитируемого NAT (TEST-NET-2, RFC 5737)
+DEFAULT_PUBLIC_IP = '198.51.100.1'
+
+class FakeSTUNServer:
+    """
+    STUN сервер RFC 5780 за имитацией NAT
+    
+    public_ip=None - клиент без NAT (внешний адрес равен реальному).
+    rfc5780=False - сервер RFC 5389 без OTHER-ADDRESS, CHANGE-REQUEST
+    отклоняется ошибкой.
+    """
+    
+    def __init__(self, host: str = '127.0.0.1', alt_host: str = '127.0.0.2',
+                 mapping: str = ENDPOINT_INDEPENDENT, filtering: str = ENDPOINT_INDEPENDENT,
+                 public_ip: Optional[str] = DEFAULT_PUBLIC_IP, rfc5780: bool = True):
+        self.host = host
+        self.alt_host = alt_host
+        self.mapping = mapping
+        self.filtering = filtering
+        self.public_ip = public_ip
+        self.rfc5780 = rfc5780
+        self.requests = 0
+        self.sockets = {}  # (сменить IP, сменить порт) -> сокет
+        self._nat_ports = {}  # (адрес клиента, ключ отображения) -> внешний порт
+        self._contacted = {}  # адрес клиента -> адреса сервера, куда он писал
+        self._selector = None
+        self._thread = None
+        self._running = False
+        
+    def start(self):
+        """
+        Привязка сокетов и запуск обработки в отдельном потоке
+        """
+        primary = self._bind(self.host, 0)
+        port = primary.getsockname()[1]
+        alt = self._bind(self.host, 0)
+        alt_port = alt.getsockname()[1]
+        self.sockets = {
+            (False, False): primary,
+            (False, True): alt,
+            (True, False): self._bind(self.alt_host, port),
+            (True, True): self._bind(self.alt_host, alt_port),
+        }
+        self._selector = selectors.DefaultSelector()
+        for sock in self.sockets.values():
+            self._selector.register(sock, selectors.EVENT_READ)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name="fake-stun", daemon=True)
+        self._thread.start()
+        
+    def stop(self):
+        """
+        Остановка сервера
+        """
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout=1.0)
+        for sock in self.sockets.values():
+            sock.close()
+        if self._selector:
+            self._selector.close()
+            
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.sockets[(False, False)].getsockname()
+        
+    @property
+    def servers(self) -> List[str]:
+        """
+        Список серверов в формате STUNClient
+        """
+        host, port = self.address
+        return [f"{host}:{port}"]
+        
+    def _bind(self, host: str, port: int) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, port))
+        return sock
+        
+    def _serve(self):
+        while self._running:
+            for key, _ in self._selector.select(timeout=0.1):
+                try:
+                    data, addr = key.fileobj.recvfrom(2048)
+                except OSError:
+                    continue
+                self._handle_request(data, addr, key.fileobj)
+                
+    def _handle_request(self, data: bytes, client: Tuple[str, int], received_on: socket.socket):
+        if not is_stun_message(data) or struct.unpack('!H', data[:2])[0] != BINDING_REQUEST:
+            return
+        self.requests += 1
+        transaction_id = data[8:20]
+        server = received_on.getsockname()
+        self._contacted.setdefault(client, set()).add(server)
+        change = self._change_flags(data[20:])
+        
+        if change and not self.rfc5780:
+            # 420 Unknown Attribute: CHANGE-REQUEST не поддерживается
+            error = struct.pack('!HHBB', 0, 0, 4, 20)
+            self._reply(received_on, client, BINDING_ERROR, transaction_id,
+                        struct.pack('!HH', 0x0009, len(error)) + error)
+            return
+            
+        # Сокет ответа: тот, что получил запрос, со сменой IP и/или порта
+        on_alt_ip = (server[0] != self.host) != bool(change & CHANGE_IP)
+        on_alt_port = (server[1] != self.address[1]) != bool(change & CHANGE_PORT)
+        sock = self.sockets[(on_alt_ip, on_alt_port)]
+        origin = sock.getsockname()
+        if not self._passes_filter(client, origin):
+            return
+            
+        attributes = self._address_attribute(XOR_MAPPED_ADDRESS, self._mapped_address(client, server),
+                                              xor=True)
+        attributes += self._address_attribute(RESPONSE_ORIGIN, origin)
+        if self.rfc5780:
+            other = self.sockets[(not on_alt_ip, not on_alt_port)].getsockname()
+            attributes += self._address_attribute(OTHER_ADDRESS, other)
+        self._reply(sock, client, BINDING_RESPONSE, transaction_id, attributes)
+        
+    def _change_flags(self, attributes: bytes) -> int:
+        offset = 0
+        while offset + 4 <= len(attributes):
+            attr_type, attr_length = struct.unpack('!HH', attributes[offset:offset + 4])
+            if attr_type == CHANGE_REQUEST and attr_length == 4:
+                return struct.unpack('!I', attributes[offset + 4:offset + 8])[0]
+            offset += 4 + attr_length + (-attr_length % 4)
+        return 0
+        
+    def _mapped_address(self, client: Tuple[str, int], server: Tuple[str, int]) -> Tuple[str, int]:
+        """
+        Внешний адрес, который NAT выдал бы клиенту для связи с server
+        """
+        if self.public_ip is None:
+            return client
+        if self.mapping == ADDRESS_DEPENDENT:
+            key = server[0]
+        elif self.mapping == ADDRESS_AND_PORT_DEPENDENT:
+            key = server
+        else:
+            key = None
+        port = self._nat_ports.get((client, key))
+        if port is None:
+            # Новое отображение - следующий свободный внешний порт
+            port = 20000 + len(self._nat_ports)
+            self._nat_ports[(client, key)] = port
+        return self.public_ip, port
+        
+    def _passes_filter(self, client: Tuple[str, int], origin: Tuple[str, int]) -> bool:
+        """
+        Пропустит ли NAT клиента пакет с адреса origin
+        """
+        if self.public_ip is None or self.filtering == ENDPOINT_INDEPENDENT:
+            return True
+        contacted = self._contacted.get(client, ())
+        if self.filtering == ADDRESS_DEPENDENT:
+            return any(address[0] == origin[0] for address in contacted)
+        return origin in contacted
+        
+    def _address_attribute(self, attr_type: int, address: Tuple[str, int], xor: bool = False) -> bytes:
+        port = address[1]
+        ip = struct.unpack('!I', socket.inet_aton(address[0]))[0]
+        if xor:
+            port ^= MAGIC_COOKIE >> 16
+            ip ^= MAGIC_COOKIE
+        return struct.pack('!HHBBHI', attr_type, 8, 0, 0x01, port, ip)
+        
+    def _reply(self, sock: socket.socket, client: Tuple[str, int], message_type: int,
+               transaction_id: bytes, attributes: bytes):
+        header = struct.pack('!HHI12s', message_type, len(attributes), MAGIC_COOKIE, transaction_id)
+        try:
+            sock.sendto(header + attributes, client)
+        except OSError as e:
+            print(f"Fake STUN reply failed: {e}")
+
+if __name__ == "__main__":
+    import sys
+    from network.stun_client import STUNClient
+    
+    server = FakeSTUNServer(mapping=sys.argv[1] if len(sys.argv) > 1 else ENDPOINT_INDEPENDENT,
+                            filtering=sys.argv[2] if len(sys.argv) > 2 else ENDPOINT_INDEPENDENT)
+    server.start()
+    try:
+        print(f"Fake STUN server on {server.servers[0]}")
+        behavior = STUNClient(server.servers, cache_path=None).get_nat_behavior(timeout=1.0)
+        print(f"NAT type: {behavior.nat_type} (mapping: {behavior.mapping}, "
+              f"filtering: {behavior.filtering})")
+    finally:
+        server.stop()
@@ -0,0 +1,429 @@
+"""
+Передача файлов (вложений) по частям через relay и P2P
+
+Файл шифруется потоком фрагментов (StreamCipher), каждый фрагмент уходит
+отдельным сообщением с номером. Получатель пишет фрагменты сразу на диск по
+смещению номера и хранит состояние рядом с файлом, поэтому передачу можно
+продолжить с первого недостающего фрагмента.
+
+Продолжение запрашивает получатель: после своего перезапуска и когда прием
+стоит дольше ATTACHMENT_STALL_TIMEOUT (обрыв связи, потерянные фрагменты).
+Ключ потока отправителя хранится только в памяти, поэтому переживает
+перезапуск только прием; после перезапуска отправителя файл нужно
+отправить заново.
+
+Offer и фрагменты могут прийти разными путями (P2P и relay), поэтому
+фрагменты, опередившие offer, ненадолго буферизуются. Если offer так и не
+пришел, получатель просит отправителя повторить его.
+
+    file_offer:  заголовок потока + зашифрованные метаданные (имя, размер)
+    file_chunk:  index, final + зашифрованный фрагмент
+    file_resume: next_index - запрос получателя на повторную отправку
+"""
+import base64
+import json
+import itertools
+import os
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+from config.settings import DOWNLOADS_DIR, ATTACHMENT_CHUNK_SIZE, ATTACHMENT_STALL_TIMEOUT
+from crypto.encryption import CryptoManager, StreamCipher, encrypt_chunks
+
+FILE_KINDS = ('file_offer', 'file_chunk', 'file_resume')
+
+# Длина заголовка потока внутри file_offer
+OFFER_HEADER_LENGTH = struct.Struct('!H')
+
+# Как часто сохранять состояние приема (в фрагментах)
+STATE_SAVE_INTERVAL = 64
+
+# Фрагменты до прихода offer: на передачу и число таких передач
+EARLY_CHUNK_LIMIT = 64
+EARLY_TRANSFER_LIMIT = 16
+
+# Запросов продолжения подряд без прогресса, потом ожидание перезапуска
+MAX_RESUME_REQUESTS = 5
+
+# Сколько завершенных приемов помнить, чтобы запоздавшие повторы
+# фрагментов и offer не начинали прием заново
+COMPLETED_HISTORY_SIZE = 256
+
+
+def _chunk_count(size: int, chunk_size: int) -> int:
+    # Пустой файл - один пустой последний фрагмент
+    return max(1, (size + chunk_size - 1) // chunk_size)
+
+
+class OutgoingTransfer:
+    def __init__(self, file_id: str, peer_id: str, path: str, cipher: StreamCipher,
+                 offer: bytes):
+        self.file_id = file_id
+        self.peer_id = peer_id
+        self.path = path
+        self.cipher = cipher
+        self.offer = offer  # для повтора, если получатель его не получил
+
+
+class IncomingTransfer:
+    def __init__(self, file_id: str, peer_id: str, header: bytes, cipher: StreamCipher,
+                 name: str, size: int, part_path, state_path):
+        self.file_id = file_id
+        self.peer_id = peer_id
+        self.header = header
+        self.cipher = cipher
+        self.name = name
+        self.size = size
+        self.chunks = _chunk_count(size, cipher.chunk_size)
+        self.part_path = part_path
+        self.state_path = state_path
+        self.received = set()
+        self.file = None
+        self.last_progress = time.monotonic()
+        self.resume_requests = 0  # подряд без прогресса
+
+    def next_index(self) -> int:
+        """
+        Номер первого недостающего фрагмента
+        """
+        index = 0
+        while index in self.received:
+            index += 1
+        return index
+
+    def save_state(self):
+        state = {
+            'peer_id': self.peer_id,
+            'header': base64.b64encode(self.header).decode(),
+            'name': self.name,
+            'size': self.size,
+            'received': sorted(self.received)
+        }
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+
+class FileTransferManager:
+    def __init__(self, crypto_manager: CryptoManager, send: Callable,
+                 downloads_dir=DOWNLOADS_DIR, chunk_size: int = ATTACHMENT_CHUNK_SIZE):
+        """
+        send(peer_id, data: bytes, headers: dict) -> bool - отправка сообщения
+        """
+        self.crypto_manager = crypto_manager
+        self.send = send
+        self.downloads_dir = downloads_dir
+        self.chunk_size = chunk_size
+        self.outgoing: Dict[str, OutgoingTransfer] = {}
+        self.incoming: Dict[str, IncomingTransfer] = {}
+        self.complete_callback = None
+        self._early_chunks: Dict[str, tuple] = {}  # file_id -> (peer_id, время, [сообщения])
+        self._completed = OrderedDict()  # file_id завершенных приемов
+        self._lock = threading.Lock()
+        self._watchdog_thread = None
+        self._watchdog_stop = threading.Event()
+
+    def set_complete_callback(self, callback: Callable):
+        """
+        Установка callback(peer_id, path) на завершение приема файла
+        """
+        self.complete_callback = callback
+
+    # Отправка
+
+    def send_file(self, peer_id: str, public_key_pem: bytes, path: str) -> Optional[str]:
+        """
+        Отправка файла пиру; возвращает file_id или None при ошибке
+        """
+        size = os.path.getsize(path)
+        header, cipher = self.crypto_manager.create_stream(public_key_pem, self.chunk_size)
+        file_id = uuid.uuid4().hex
+
+        # Имя и размер шифруются: relay видит только file_id и номера фрагментов
+        metadata = json.dumps({'name': os.path.basename(path), 'size': size}).encode()
+        offer = OFFER_HEADER_LENGTH.pack(len(header)) + header + cipher.encrypt_metadata(metadata)
+
+        transfer = OutgoingTransfer(file_id, peer_id, path, cipher, offer)
+        with self._lock:
+            self.outgoing[file_id] = transfer
+
+        if not self.send(peer_id, offer, {'kind': 'file_offer', 'file_id': file_id}):
+            return None
+
+        self._stream(transfer, 0)
+        return file_id
+
+    def _stream(self, transfer: OutgoingTransfer, start_index: int) -> bool:
+        with open(transfer.path, 'rb') as f:
+            for index, final, data in encrypt_chunks(f, transfer.cipher, start_index):
+                headers = {
+                    'kind': 'file_chunk',
+                    'file_id': transfer.file_id,
+                    'index': index,
+                    'final': final
+                }
+                if not self.send(transfer.peer_id, data, headers):
+                    # Получатель запросит продолжение через file_resume
+                    print(f"Transfer {transfer.file_id} interrupted at chunk {index}")
+                    return False
+        return True
+
+    # Прием
+
+    def prepare(self, message: dict):
+        """
+        Тяжелая часть обработки (потоки пула): открытие потока по file_offer
+        """
+        if message.get('kind') != 'file_offer':
+            return None
+        data = memoryview(message['data'])
+        (header_length,) = OFFER_HEADER_LENGTH.unpack_from(data)
+        header = bytes(data[OFFER_HEADER_LENGTH.size:OFFER_HEADER_LENGTH.size + header_length])
+        cipher = self.crypto_manager.open_stream(header)
+        metadata = json.loads(cipher.decrypt_metadata(data[OFFER_HEADER_LENGTH.size + header_length:]))
+        return header, cipher, metadata
+
+    def deliver(self, peer_id: str, message: dict, prepared):
+        """
+        Обработка сообщения передачи файла (по порядку для отправителя)
+        """
+        kind = message.get('kind')
+        file_id = message.get('file_id')
+        if not file_id or not all(c in '0123456789abcdef' for c in file_id):
+            print(f"Invalid file transfer id from {peer_id}")
+            return
+
+        if kind == 'file_offer':
+            header, cipher, metadata = prepared
+            self._accept_offer(peer_id, file_id, header, cipher, metadata)
+        elif kind == 'file_chunk':
+            self._write_chunk(peer_id, file_id, message)
+        elif kind == 'file_resume':
+            self._resume_outgoing(peer_id, file_id, int(message.get('next_index', 0)),
+                                  bool(message.get('need_offer')))
+
+    def _accept_offer(self, peer_id, file_id, header, cipher, metadata):
+        name = os.path.basename(str(metadata.get('name', ''))) or file_id
+        # Проверка и регистрация под одним замком: повтор offer (другим
+        # путем или от возобновления) не откроет второй .part того же файла
+        with self._lock:
+            if file_id in self.incoming or file_id in self._completed:
+                return
+            early = self._early_chunks.pop(file_id, None)
+            transfer = IncomingTransfer(
+                file_id, peer_id, header, cipher, name, int(metadata.get('size', 0)),
+                self.downloads_dir / f"{file_id}.part",
+                self.downloads_dir / f"{file_id}.json"
+            )
+            transfer.file = open(transfer.part_path, 'wb')
+            transfer.save_state()
+            self.incoming[file_id] = transfer
+        print(f"Receiving file {name} ({transfer.size} bytes) from {peer_id}")
+
+        # Фрагменты, пришедшие раньше offer другим путем
+        if early is not None and early[0] == peer_id:
+            for message in early[2]:
+                self._write_chunk(peer_id, file_id, message)
+
+    def _write_chunk(self, peer_id, file_id, message):
+        transfer = self.incoming.get(file_id)
+        if transfer is None:
+            if file_id not in self._completed:
+                self._buffer_early_chunk(peer_id, file_id, message)
+            return
+        if transfer.peer_id != peer_id:
+            print(f"Chunk for unknown transfer {file_id} from {peer_id}")
+            return
+
+        index = int(message.get('index', -1))
+        final = bool(message.get('final'))
+        if index in transfer.received:
+            return
+        if not 0 <= index < transfer.chunks or final != (index == transfer.chunks - 1):
+            print(f"Invalid chunk {index} for transfer {file_id}")
+            return
+
+        data = transfer.cipher.decrypt_chunk(index, message['data'], final)
+        transfer.file.seek(index * transfer.cipher.chunk_size)
+        transfer.file.write(data)
+        transfer.received.add(index)
+        transfer.last_progress = time.monotonic()
+        transfer.resume_requests = 0
+
+        if len(transfer.received) == transfer.chunks:
+            self._finish(transfer)
+        elif len(transfer.received) % STATE_SAVE_INTERVAL == 0:
+            transfer.file.flush()
+            transfer.save_state()
+
+    def _finish(self, transfer: IncomingTransfer):
+        transfer.file.close()
+        target = self._reserve_target(transfer)
+        os.replace(transfer.part_path, target)
+        os.remove(transfer.state_path)
+        with self._lock:
+            del self.incoming[transfer.file_id]
+            self._completed[transfer.file_id] = True
+            if len(self._completed) > COMPLETED_HISTORY_SIZE:
+                self._completed.popitem(last=False)
+
+        if self.complete_callback:
+            self.complete_callback(transfer.peer_id, str(target))
+        else:
+            print(f"File received from {transfer.peer_id}: {target}")
+
+    def _reserve_target(self, transfer: IncomingTransfer):
+        """
+        Свободное имя для принятого файла; файл создается сразу (режим 'x'),
+        чтобы два одновременных приема не выбрали одно имя
+        """
+        candidates = itertools.chain(
+            [transfer.name, f"{transfer.file_id[:8]}_{transfer.name}"],
+            (f"{transfer.file_id[:8]}_{number}_{transfer.name}" for number in itertools.count(2))
+        )
+        for name in candidates:
+            target = self.downloads_dir / name
+            try:
+                open(target, 'x').close()
+                return target
+            except FileExistsError:
+                continue
+
+    def _buffer_early_chunk(self, peer_id, file_id, message):
+        # Offer мог пойти другим путем и еще не дойти
+        with self._lock:
+            early = self._early_chunks.get(file_id)
+            if early is None:
+                if len(self._early_chunks) >= EARLY_TRANSFER_LIMIT:
+                    print(f"Chunk for unknown transfer {file_id} from {peer_id}")
+                    return
+                early = self._early_chunks[file_id] = (peer_id, time.monotonic(), [])
+            if early[0] != peer_id or len(early[2]) >= EARLY_CHUNK_LIMIT:
+                # Недостающие фрагменты вернет запрос продолжения
+                return
+            early[2].append(message)
+
+    def _resume_outgoing(self, peer_id, file_id, next_index, need_offer=False):
+        with self._lock:
+            transfer = self.outgoing.get(file_id)
+        if transfer is None or transfer.peer_id != peer_id:
+            print(f"Cannot resume unknown transfer {file_id}")
+            return
+        # Повторная отправка не должна блокировать поток доставки
+        thread = threading.Thread(target=self._restream, args=(transfer, next_index, need_offer))
+        thread.daemon = True
+        thread.start()
+
+    def _restream(self, transfer: OutgoingTransfer, start_index: int, need_offer: bool):
+        if need_offer and not self.send(transfer.peer_id, transfer.offer,
+                                        {'kind': 'file_offer', 'file_id': transfer.file_id}):
+            return
+        self._stream(transfer, start_index)
+
+    # Продолжение прерванных передач
+
+    def load_incomplete(self):
+        """
+        Загрузка незавершенных входящих передач, сохраненных на диске
+        """
+        for state_path in self.downloads_dir.glob('*.json'):
+            file_id = state_path.stem
+            if file_id in self.incoming:
+                continue
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+                header = base64.b64decode(state['header'])
+                transfer = IncomingTransfer(
+                    file_id, state['peer_id'], header, self.crypto_manager.open_stream(header),
+                    state['name'], state['size'],
+                    self.downloads_dir / f"{file_id}.part", state_path
+                )
+                transfer.received = set(state['received'])
+                transfer.file = open(transfer.part_path, 'r+b')
+            except Exception as e:
+                print(f"Failed to load transfer {file_id}: {e}")
+                continue
+            with self._lock:
+                self.incoming[file_id] = transfer
+
+    def request_resume(self):
+        """
+        Запрос продолжения всех незавершенных входящих передач
+        """
+        with self._lock:
+            transfers = list(self.incoming.values())
+        for transfer in transfers:
+            self._request_resume(transfer)
+
+    def _request_resume(self, transfer: IncomingTransfer):
+        headers = {
+            'kind': 'file_resume',
+            'file_id': transfer.file_id,
+            'next_index': transfer.next_index()
+        }
+        transfer.resume_requests += 1
+        transfer.last_progress = time.monotonic()
+        self.send(transfer.peer_id, b'', headers)
+
+    def start_watchdog(self, stall_timeout: float = ATTACHMENT_STALL_TIMEOUT):
+        """
+        Запуск фонового запроса продолжения для остановившихся приемов
+        """
+        if self._watchdog_thread:
+            return
+        self._watchdog_stop.clear()
+        self._watchdog_thread = threading.Thread(
+            target=self._watchdog_loop, args=(stall_timeout,), name="file-transfer-watchdog"
+        )
+        self._watchdog_thread.daemon = True
+        self._watchdog_thread.start()
+
+    def _watchdog_loop(self, stall_timeout: float):
+        while not self._watchdog_stop.wait(stall_timeout / 2):
+            try:
+                self.check_stalled(stall_timeout)
+            except Exception as e:
+                print(f"File transfer watchdog failed: {e}")
+
+    def check_stalled(self, stall_timeout: float = ATTACHMENT_STALL_TIMEOUT):
+        """
+        Запрос продолжения приемов без новых фрагментов дольше stall_timeout
+        и повтора offer для фрагментов, чей offer так и не пришел
+        """
+        deadline = time.monotonic() - stall_timeout
+        with self._lock:
+            stalled = [transfer for transfer in self.incoming.values()
+                       if transfer.last_progress < deadline
+                       and transfer.resume_requests < MAX_RESUME_REQUESTS]
+            orphaned = [(file_id, early[0]) for file_id, early in self._early_chunks.items()
+                        if early[1] < deadline]
+            for file_id, _ in orphaned:
+                del self._early_chunks[file_id]
+
+        for transfer in stalled:
+            self._request_resume(transfer)
+            if transfer.resume_requests == MAX_RESUME_REQUESTS:
+                # Отправитель, видимо, перезапущен - ждем повторной отправки
+                print(f"Transfer {transfer.file_id} from {transfer.peer_id} is not resuming")
+        for file_id, peer_id in orphaned:
+            headers = {'kind': 'file_resume', 'file_id': file_id,
+                       'next_index': 0, 'need_offer': True}
+            self.send(peer_id, b'', headers)
+
+    def close(self):
+        """
+        Сохранение состояния незавершенных приемов
+        """
+        if self._watchdog_thread:
+            self._watchdog_stop.set()
+            self._watchdog_thread.join()
+            self._watchdog_thread = None
+        for transfer in list(self.incoming.values()):
+            if transfer.file:
+                transfer.file.close()
+            transfer.save_state()
@@ -0,0 +1,185 @@
+"""
+Фрагментация P2P сообщений по размеру пути
+
+Сообщение больше одной датаграммы делится на фрагменты размером не больше
+MTU пути; фрагментация на уровне IP не используется (потеря одного IP
+фрагмента теряет всю датаграмму, а многие NAT такие пакеты отбрасывают).
+Фрагменты идут отдельными пакетами надежной доставки, поэтому приходят по
+порядку и повторяются по одному. Reassembler собирает их обратно и следит,
+чтобы незаконченные сообщения не занимали память бесконечно.
+
+Первый фрагмент сообщения помечен (first). После сброса недособранного
+сообщения его оставшиеся фрагменты отбрасываются до следующего первого,
+а вместо хвоста feed возвращает MESSAGE_LOST, чтобы транспорт сообщил
+отправителю о потере, а не выдал обрезанное сообщение.
+
+MTU пути начинается с DEFAULT_DATAGRAM_SIZE (безопасно для IPv4 и IPv6
+с туннелями) и повышается пробами с запретом фрагментации (DF), если ОС
+позволяет его выставить.
+"""
+import socket
+import sys
+import time
+from collections import OrderedDict
+from typing import Hashable, List, Optional
+
+# Размер UDP датаграммы, который проходит практически везде
+DEFAULT_DATAGRAM_SIZE = 1200
+
+# Размеры, которые пробуются по очереди (Ethernet 1500 без заголовков IPv6 и IPv4)
+PROBE_DATAGRAM_SIZES = [1452, 1472]
+
+# Максимальный размер собираемого сообщения
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# Сколько ждать следующего фрагмента
+REASSEMBLY_TIMEOUT = 30.0
+
+# Память под все незаконченные сообщения
+REASSEMBLY_MEMORY_LIMIT = 64 * 1024 * 1024
+
+# Результат feed для последнего фрагмента сброшенного сообщения
+MESSAGE_LOST = object()
+
+# Запрет фрагментации: (level, option, value) для разных ОС
+if sys.platform.startswith('linux'):
+    # IP_MTU_DISCOVER = IP_PMTUDISC_PROBE: DF без учета кэша PMTU ядра
+    _DONT_FRAGMENT = (socket.IPPROTO_IP, getattr(socket, 'IP_MTU_DISCOVER', 10), 3)
+elif sys.platform == 'win32':
+    _DONT_FRAGMENT = (socket.IPPROTO_IP, getattr(socket, 'IP_DONTFRAGMENT', 14), 1)
+else:
+    _DONT_FRAGMENT = None
+
+
+def set_dont_fragment(sock: socket.socket) -> bool:
+    """
+    Выставление DF на UDP сокете; False - ОС не позволяет (пробы MTU невозможны)
+    """
+    if _DONT_FRAGMENT is None:
+        return False
+    try:
+        sock.setsockopt(*_DONT_FRAGMENT)
+        return True
+    except OSError:
+        return False
+
+
+def fragment(payload: bytes, size: int) -> List[bytes]:
+    """
+    Деление сообщения на части не больше size байт (пустое - одна пустая часть)
+    """
+    if len(payload) > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message too large: {len(payload)} bytes")
+    view = memoryview(payload)
+    return [bytes(view[i:i + size]) for i in range(0, len(payload), size)] or [b'']
+
+
+class _Partial:
+    __slots__ = ('chunks', 'size', 'updated')
+
+    def __init__(self, now: float):
+        self.chunks = []
+        self.size = 0
+        self.updated = now
+
+
+class Reassembler:
+    """
+    Сборка сообщений из фрагментов, приходящих по порядку
+
+    key - отправитель (адрес); first=True - фрагмент начинает сообщение,
+    more=True - за фрагментом следуют еще. Сообщение сбрасывается, если превышает max_message_size, если
+    фрагменты перестали приходить на timeout секунд или если вся
+    собираемая память больше memory_limit (сначала самые старые).
+    """
+
+    def __init__(self, max_message_size: int = MAX_MESSAGE_SIZE,
+                 memory_limit: int = REASSEMBLY_MEMORY_LIMIT,
+                 timeout: float = REASSEMBLY_TIMEOUT):
+        self.max_message_size = max_message_size
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+        self._partials: 'OrderedDict[Hashable, _Partial]' = OrderedDict()
+        self._memory = 0
+        self.dropped = 0
+        self.orphaned = 0  # фрагментов сброшенных сообщений
+
+    def feed(self, key: Hashable, chunk: bytes, more: bool, first: bool = True):
+        """
+        Добавление фрагмента; возвращает сообщение целиком после последнего,
+        MESSAGE_LOST после последнего фрагмента сброшенного сообщения, иначе None
+        """
+        if first:
+            # Незаконченное сообщение без последнего фрагмента уже не соберется
+            self.discard(key)
+        partial = self._partials.get(key)
+        if partial is None:
+            if not first:
+                # Продолжение сброшенного сообщения
+                self.orphaned += 1
+                return None if more else MESSAGE_LOST
+            if not more:
+                # Сообщение в одном пакете - без копирования
+                return chunk
+            partial = self._partials[key] = _Partial(time.monotonic())
+        else:
+            self._partials.move_to_end(key)
+            partial.updated = time.monotonic()
+
+        partial.chunks.append(chunk)
+        partial.size += len(chunk)
+        self._memory += len(chunk)
+        if partial.size > self.max_message_size:
+            print(f"Dropping oversized message from {key}")
+            self.discard(key)
+            return None
+
+        if not more:
+            self.discard(key, dropped=False)
+            return b''.join(partial.chunks)
+
+        while self._memory > self.memory_limit and self._partials:
+            oldest = next(iter(self._partials))
+            print(f"Reassembly memory exhausted, dropping message from {oldest}")
+            self.discard(oldest)
+        return None
+
+    def discard(self, key: Hashable, dropped: bool = True):
+        """
+        Сброс незаконченного сообщения (например, отправитель начал заново)
+        """
+        partial = self._partials.pop(key, None)
+        if partial is not None:
+            self._memory -= partial.size
+            if dropped:
+                self.dropped += 1
+
+    def expire(self) -> int:
+        """
+        Сброс сообщений, фрагменты которых давно не приходили
+        """
+        deadline = time.monotonic() - self.timeout
+        expired = []
+        # Порядок словаря - по времени последнего фрагмента
+        for key, partial in self._partials.items():
+            if partial.updated >= deadline:
+                break
+            expired.append(key)
+        for key in expired:
+            self.discard(key)
+        return len(expired)
+
+    def next_expiry(self) -> Optional[float]:
+        """
+        Момент (time.monotonic), когда истечет самое старое сообщение
+        """
+        for partial in self._partials.values():
+            return partial.updated + self.timeout
+        return None
+
+    @property
+    def memory_used(self) -> int:
+        return self._memory
+
+    def __len__(self) -> int:
+        return len(self._partials)
@@ -1,11 +1,46 @@
 """
 Утилиты для обхода NAT (Hole Punching)
+
+Прием, hole punching и таймеры надежной доставки для всех пиров работают
+в одном цикле asyncio (отдельный поток p2p-loop) без опроса по таймауту.
+Методы HolePuncher вызываются из обычных потоков как раньше; корутины
+(punch) можно запускать в цикле напрямую или через run_coroutine.
 """
+import asyncio
+import concurrent.futures
+import errno
 import socket
 import threading
 import time
 from typing import Callable, Optional, Tuple
 import random
+from config.settings import P2P_WINDOW, STUN_TIMEOUT
+from network.fragmentation import set_dont_fragment
+from network.peer_table import PeerRegistry
+from network.reliable import Delivery, ReliableTransport, is_reliable_packet
+
+# Максимальный размер UDP датаграммы
+MAX_DATAGRAM_SIZE = 65535
+
+# Размер буферов сокета
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Пауза между сериями пакетов hole punching
+PUNCH_INTERVAL = 0.1
+
+class _HolePunchProtocol(asyncio.DatagramProtocol):
+    """
+    Прием датаграмм в цикле событий
+    """
+    def __init__(self, hole_puncher: 'HolePuncher'):
+        self.hole_puncher = hole_puncher
+        
+    def datagram_received(self, data: bytes, addr):
+        self.hole_puncher._handle_datagram(data, addr[:2])
+        
+    def error_received(self, exc: Exception):
+        # ICMP "порт недоступен" и подобное - пакет просто потерян
+        pass
 
 class HolePuncher:
     def __init__(self, local_port: int = 0):
@@ -13,64 +48,150 @@ class HolePuncher:
         self.socket = None
         self.running = False
         self.on_message_callback = None
-        self.peers = {}  # peer_id -> (ip, port, last_seen)
+        # "ip:port" -> адрес пиров, с которыми идет надежная доставка или
+        # подтверждено соединение (не всех источников датаграмм); ограничена
+        # по размеру и времени, вместе с записью забывается и канал доставки.
+        # Подтвержденные пиры закреплены и не вытесняются случайными адресами
+        self.peers = PeerRegistry(on_evict=self._forget_peer)
+        self.loop = None
+        self.loop_thread = None
+        self._transport = None
+        self._stun_client = None  # опрос STUN через этот сокет
+        # Надежная доставка поверх того же сокета
+        self.reliable = ReliableTransport(self._send_raw, self._deliver_reliable, window=P2P_WINDOW)
         
     def start(self, on_message: Callable = None):
         """
         Запуск Hole Punching клиента
+        
+        on_message(data, addr) вызывается в потоке цикла событий и не должен
+        блокироваться: пока он работает, прием и таймеры всех пиров стоят.
         """
         self.on_message_callback = on_message
-        self.running = True
         
         # Создаем UDP сокет
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind(('', self.local_port))
+        # Буферы побольше: окно надежной доставки - сотни пакетов
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                self.socket.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+            except OSError:
+                pass
+        # DF: большие пакеты не дробятся по IP, MTU пути ищут пробы
+        self.reliable.probe_mtu = set_dont_fragment(self.socket)
+        try:
+            self.socket.bind(('', self.local_port))
+        except OSError:
+            self.socket.close()
+            self.socket = None
+            raise
         
-        # Запускаем поток для приема сообщений
-        self.receive_thread = threading.Thread(target=self._receive_loop)
-        self.receive_thread.daemon = True
-        self.receive_thread.start()
+        # Цикл событий в отдельном потоке: прием, punching и таймеры
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self._run_loop, name="p2p-loop")
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+        self._transport, _ = self.run_coroutine(self.loop.create_datagram_endpoint(
+            lambda: _HolePunchProtocol(self), sock=self.socket))
+        self.running = True
+        self.reliable.start(self.loop)
         
         print(f"Hole Puncher started on port {self.socket.getsockname()[1]}")
         
     def stop(self):
         """
-        Остановка клиента
+        Остановка клиента (сразу, без ожидания таймаутов)
         """
         self.running = False
+        self.reliable.stop()
+        if self.loop and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self._shutdown)
+            except RuntimeError:
+                # Цикл уже завершился
+                pass
+            if threading.current_thread() is not self.loop_thread:
+                self.loop_thread.join(timeout=1.0)
         if self.socket:
             self.socket.close()
             
-    def _receive_loop(self):
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+            # Даем отмененным задачам и закрытию транспорта завершиться
+            pending = asyncio.all_tasks(self.loop)
+            if pending:
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        finally:
+            self.loop.close()
+            
+    def _shutdown(self):
+        if self._transport:
+            self._transport.close()
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+        self.loop.stop()
+        
+    def run_coroutine(self, coro, wait: bool = True):
         """
-        Цикл приема сообщений
+        Запуск корутины в цикле P2P из другого потока
+        
+        wait=False - вернуть concurrent.futures.Future не дожидаясь результата
         """
-        while self.running:
-            try:
-                self.socket.settimeout(1.0)
-                data, addr = self.socket.recvfrom(4096)
-                
-                # Обновляем информацию о пире
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result() if wait else future
+        
+    def _handle_datagram(self, data: bytes, addr: Tuple[str, int]):
+        """
+        Обработка принятой датаграммы (в цикле событий)
+        """
+        # Ответы STUN сервера (он не пир)
+        if self._stun_client and self._stun_client.handle_response(data):
+            return
+        
+        # Любой пакет продлевает запись уже известного пира, но новые
+        # адреса не добавляет: мусор и поддельные источники не вытесняют пиров
+        self.peers.touch_address(addr)
+        
+        # Пакеты надежной доставки разбирает транспорт, он же
+        # выдает из них сообщения по порядку
+        if is_reliable_packet(data):
+            if self.reliable.handle_datagram(data, addr):
                 self._update_peer_info(addr)
-                
-                # Обрабатываем сообщение
-                if self.on_message_callback:
-                    try:
-                        message = data.decode('utf-8')
-                        self.on_message_callback(message, addr)
-                    except Exception as e:
-                        print(f"Error processing message: {e}")
-                        
-            except socket.timeout:
-                continue
+            return
+        
+        # Обрабатываем сообщение (callback получает сырые байты)
+        if self.on_message_callback:
+            try:
+                self.on_message_callback(data, addr)
             except Exception as e:
-                if self.running:
-                    print(f"Error in receive loop: {e}")
-                break
+                print(f"Error processing message: {e}")
                 
-    def punch_hole(self, target_ip: str, target_port: int, attempts: int = 20):
+    async def discover_public_address(self, stun_client, timeout: float = STUN_TIMEOUT):
+        """
+        Внешний адрес именно этого сокета через STUN (корутина цикла P2P)
+        """
+        self._stun_client = stun_client
+        try:
+            return await stun_client.discover(self._transport.sendto, timeout)
+        finally:
+            self._stun_client = None
+            
+    async def classify_nat(self, stun_client, timeout: float = STUN_TIMEOUT):
         """
-        Hole Punching к целевому адресу
+        Поведение NAT для этого сокета (NATBehavior, корутина цикла P2P)
+        """
+        self._stun_client = stun_client
+        try:
+            return await stun_client.classify(self._transport.sendto,
+                                              self.socket.getsockname()[1], timeout)
+        finally:
+            self._stun_client = None
+            
+    async def punch(self, target_ip: str, target_port: int, attempts: int = 20):
+        """
+        Hole Punching к целевому адресу (корутина цикла P2P)
         """
         print(f"Punching hole to {target_ip}:{target_port}")
         
@@ -85,47 +206,113 @@ class HolePuncher:
                 ]
                 
                 for msg in messages:
-                    self.socket.sendto(msg, (target_ip, target_port))
+                    self._transport.sendto(msg, (target_ip, target_port))
                     
-                time.sleep(0.1)  # Небольшая пауза
-                
             except Exception as e:
                 print(f"Hole punch attempt {i} failed: {e}")
                 
-    def send_to_peer(self, peer_id: str, message: str) -> bool:
+            await asyncio.sleep(PUNCH_INTERVAL)  # Небольшая пауза
+            
+    def punch_hole(self, target_ip: str, target_port: int, attempts: int = 20):
+        """
+        Hole Punching к целевому адресу; поток ждет окончания пробивания
+        """
+        try:
+            self.run_coroutine(self.punch(target_ip, target_port, attempts))
+        except concurrent.futures.CancelledError:
+            # Клиент остановлен во время пробивания
+            pass
+            
+    def send_to_peer(self, peer_id: str, message) -> bool:
         """
         Отправка сообщения пиру
         """
-        if peer_id not in self.peers:
+        entry = self.peers.get(peer_id)
+        if entry is None:
             print(f"Unknown peer: {peer_id}")
             return False
             
-        ip, port, _ = self.peers[peer_id]
+        ip, port = entry.address
+        if isinstance(message, str):
+            message = message.encode('utf-8')
         try:
-            self.socket.sendto(message.encode('utf-8'), (ip, port))
+            self.socket.sendto(message, (ip, port))
             return True
         except Exception as e:
             print(f"Failed to send to peer {peer_id}: {e}")
             return False
             
-    def send_direct(self, ip: str, port: int, message: str) -> bool:
+    def send_direct(self, ip: str, port: int, message) -> bool:
         """
-        Прямая отправка сообщения
+        Прямая отправка сообщения (str или bytes)
         """
+        if isinstance(message, str):
+            message = message.encode('utf-8')
         try:
-            self.socket.sendto(message.encode('utf-8'), (ip, port))
+            self.socket.sendto(message, (ip, port))
             return True
         except Exception as e:
             print(f"Failed to send direct message: {e}")
             return False
             
-    def _update_peer_info(self, addr: Tuple[str, int]):
+    def send_reliable(self, ip: str, port: int, message, timeout: Optional[float] = None) -> bool:
+        """
+        Отправка с подтверждением доставки; False - не подтверждено за timeout
+        """
+        delivery = self.send_reliable_async(ip, port, message)
+        if delivery is None:
+            return False
+        if threading.current_thread() is self.loop_thread:
+            # Подтверждения обрабатывает этот же поток - ждать нельзя
+            return delivery.done and delivery.ok
+        return delivery.wait(timeout)
+        
+    def send_reliable_async(self, ip: str, port: int, message) -> Optional[Delivery]:
+        """
+        Отправка с подтверждением без ожидания; None - сообщение не принято
+        """
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        try:
+            return self.reliable.send_async((ip, port), message)
+        except ValueError as e:
+            print(f"Failed to send reliable message: {e}")
+            return None
+            
+    def _send_raw(self, data: bytes, addr: Tuple[str, int]) -> bool:
+        # Сокет неблокирующий и потокобезопасен для датаграмм, поэтому пакеты
+        # уходят напрямую из любого потока, без перехода в цикл событий
+        try:
+            self.socket.sendto(data, addr)
+            return True
+        except Exception as e:
+            # Пакет считается потерянным, его повторит транспорт; слишком
+            # большая проба MTU с DF и полный буфер - ожидаемые ошибки
+            if self.running and getattr(e, 'errno', None) not in (errno.EMSGSIZE, errno.EAGAIN,
+                                                                  errno.EWOULDBLOCK):
+                print(f"Failed to send packet: {e}")
+            return False
+            
+    def _deliver_reliable(self, data: bytes, addr: Tuple[str, int]):
+        if self.on_message_callback:
+            self.on_message_callback(data, addr)
+            
+    def _update_peer_info(self, addr: Tuple[str, int], pinned: Optional[bool] = None):
         """
         Обновление информации о пире
         """
         ip, port = addr
-        peer_id = f"{ip}:{port}"
-        self.peers[peer_id] = (ip, port, time.time())
+        self.peers.add(f"{ip}:{port}", addr, pinned=pinned)
+        
+    def pin_peer(self, addr: Tuple[str, int], pinned: bool = True):
+        """
+        Закрепление адреса подтвержденного пира (или снятие закрепления)
+        """
+        self._update_peer_info(tuple(addr), pinned)
+        
+    def _forget_peer(self, entry, reason: str):
+        # Пир молчит дольше PEER_TTL или вытеснен - его канал больше не нужен
+        self.reliable.close_channel(entry.address)
         
     def get_local_address(self) -> Tuple[str, int]:
         """
@@ -137,9 +324,13 @@ class HolePuncher:
         
     def get_peer_info(self, peer_id: str) -> Optional[Tuple[str, int, float]]:
         """
-        Получение информации о пире
+        Получение информации о пире: (ip, port, время последнего пакета)
         """
-        return self.peers.get(peer_id)
+        entry = self.peers.get(peer_id)
+        if entry is None:
+            return None
+        last_seen = time.time() - (time.monotonic() - entry.last_seen)
+        return entry.address + (last_seen,)
 
 # Утилита для координированного Hole Punching
 class CoordinatedHolePuncher:
@@ -159,18 +350,18 @@ class CoordinatedHolePuncher:
         
         print(f"Coordinating hole punching between {peer1_addr} and {peer2_addr}")
         
-        # Оба клиента начинают отправлять пакеты друг другу одновременно
-        def punch_target(target_addr):
-            self.hole_puncher.punch_hole(target_addr[0], target_addr[1], attempts=30)
-            
-        # Запускаем в отдельных потоках
-        thread1 = threading.Thread(target=punch_target, args=(peer2_addr,))
-        thread2 = threading.Thread(target=punch_target, args=(peer1_addr,))
-        
-        thread1.start()
-        thread2.start()
+        try:
+            self.hole_puncher.run_coroutine(self.punch_both(peer1_addr, peer2_addr))
+        except concurrent.futures.CancelledError:
+            return
         
-        thread1.join()
-        thread2.join()
+        print("Hole punching coordination completed")
         
-        print("Hole punching coordination completed")
\ No newline at end of file
+    async def punch_both(self, peer1_addr: Tuple[str, int], peer2_addr: Tuple[str, int]):
+        """
+        Пакеты к обоим адресам одновременно, в одном цикле событий
+        """
+        await asyncio.gather(
+            self.hole_puncher.punch(peer2_addr[0], peer2_addr[1], attempts=30),
+            self.hole_puncher.punch(peer1_addr[0], peer1_addr[1], attempts=30),
+        )
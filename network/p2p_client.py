@@ -1,12 +1,87 @@
 """
 P2P клиент для Secure Messenger
+
+Соединение с пиром проходит состояния punching -> probing -> confirmed
+(или failed). Пока идет hole punching, пиру повторяется проба со
+случайным nonce; пир отвечает подписью nonce своим RSA ключом, и только
+проверенная подпись переводит соединение в confirmed. Сообщения идут
+напрямую лишь к подтвержденным пирам, остальные - через relay.
+
+Проверка взаимная: каждая сторона подтверждает соединение только своей
+пробой. Ответ дается лишь пиру, с которым идет или шло соединение, на
+пробу, подписанную его ключом, и не чаще PROBE_RATE в секунду с адреса -
+поддельные пробы не заставят подписывать и не превратят клиента в
+усилитель трафика. Подпись и проверка выполняются вне цикла событий.
 """
+import asyncio
+import base64
+import concurrent.futures
 import json
+import os
+import threading
 import time
+from collections import OrderedDict
 from typing import Callable, Optional, Tuple
-from network.stun_client import get_public_address
+from network.stun_client import NAT_UNKNOWN, STUNClient, punching_possible
 from network.nat_traversal import HolePuncher, CoordinatedHolePuncher
+from network.peer_table import PeerRegistry
+from network.reliable import Delivery
+from network.protocol import FrameDecoder, ProtocolError, decode_message, encode_frame
 from crypto.encryption import CryptoManager
+from config.settings import (P2P_CONNECT_TIMEOUT, P2P_PROBE_INTERVAL, P2P_PUNCH_ATTEMPTS,
+                             P2P_SEND_TIMEOUT)
+
+# Состояния соединения с пиром
+STATE_PUNCHING = 'punching'
+STATE_PROBING = 'probing'
+STATE_CONFIRMED = 'confirmed'
+STATE_FAILED = 'failed'
+
+# Контекст подписи пробы: подпись нельзя выдать за подпись другого протокола
+PROBE_CONTEXT = b'secure-messenger-p2p-probe:'
+# Контекст подписи самой пробы (ее нельзя выдать за ответ)
+PROBE_REQUEST_CONTEXT = b'secure-messenger-p2p-probe-request:'
+
+# Подписанных ответов на пробы в памяти (повторы пробы не подписываются заново)
+PROBE_SIGNATURE_CACHE_SIZE = 64
+
+# Ответов на пробы в секунду с одного адреса (повтор пробы - раз в
+# P2P_PROBE_INTERVAL) и адресов, для которых помнится этот счет
+PROBE_RATE = 8
+PROBE_RATE_TABLE_SIZE = 1024
+
+# Одновременных проверок и подписей проб в пуле потоков
+PROBE_MAX_PENDING = 8
+
+def probe_payload(nonce: bytes, initiator_id: str, responder_id: str,
+                  context: bytes = PROBE_CONTEXT) -> bytes:
+    """
+    Подписываемые данные пробы: nonce и оба участника
+    """
+    return b'\0'.join([context + nonce, initiator_id.encode('utf-8'),
+                       responder_id.encode('utf-8')])
+
+class PeerConnection:
+    """
+    Соединение с одним пиром
+    
+    future (concurrent.futures.Future) завершается True, когда пир
+    подтвердил адрес подписью, или False при неудаче; state - текущее
+    состояние, address - адрес, с которого пришел подписанный ответ.
+    """
+    def __init__(self, peer_id: str, address: Tuple[str, int], public_key: Optional[bytes]):
+        self.peer_id = peer_id
+        self.address = address
+        self.public_key = public_key
+        self.state = STATE_PUNCHING
+        self.nonce = os.urandom(16)
+        self.future = concurrent.futures.Future()
+        self.confirmed_at = None
+        self._event = None  # asyncio.Event в цикле HolePuncher
+        
+    @property
+    def confirmed(self) -> bool:
+        return self.state == STATE_CONFIRMED
 
 class P2PClient:
     def __init__(self, peer_id: str, crypto_manager: CryptoManager):
@@ -15,27 +90,91 @@ class P2PClient:
         self.hole_puncher = HolePuncher()
         self.coordinated_puncher = CoordinatedHolePuncher(self.hole_puncher)
         self.message_callback = None
-        self.connected_peers = {}  # peer_id -> (ip, port, public_key)
+        # Подтвержденные пиры: peer_id -> адрес и публичный ключ; пир, от
+        # которого нет пакетов дольше PEER_TTL, забывается (NAT уже закрыл дыру)
+        self.connected_peers = PeerRegistry(on_evict=self._on_peer_evicted)
+        self.connections = {}  # peer_id -> PeerConnection
+        self._probes = {}  # nonce -> PeerConnection, ожидающие ответа
+        self._probe_signatures = {}  # (nonce, from) -> подпись
+        self._probe_rate = OrderedDict()  # адрес -> (доступно ответов, время)
+        self._probes_pending = 0  # проверок и подписей в пуле потоков
+        self._connections_lock = threading.Lock()
+        self.connection_callback = None
+        self.pong_callback = None
         self.public_address = None
+        self.stun_client = STUNClient()
+        self.address_callback = None
+        self.nat_type = NAT_UNKNOWN
+        self.nat_behavior = None  # NATBehavior последней проверки
         
     def start(self):
         """
         Запуск P2P клиента
-        """
-        # Получаем публичный адрес через STUN
-        print("Getting public address via STUN...")
-        self.public_address = get_public_address()
         
-        if self.public_address:
-            print(f"Public address: {self.public_address[0]}:{self.public_address[1]}")
-        else:
-            # Если STUN не работает, используем локальный адрес
-            local_addr = self.hole_puncher.get_local_address()
-            self.public_address = local_addr
-            print(f"Using local address: {local_addr[0]}:{local_addr[1]}")
+        Не блокирует: внешний адрес берется из кэша STUN или определяется в
+        фоне, а до ответа STUN public_address - локальный адрес сокета.
+        Тип NAT тоже определяется в фоне (до этого - из кэша или unknown).
+        """
+        cached = self.stun_client.load_cache()
+        # Тот же локальный порт - то же отображение в NAT, пока оно не устарело
+        if cached:
+            self.hole_puncher.local_port = cached[1]
             
         # Запускаем Hole Puncher
-        self.hole_puncher.start(on_message=self._handle_p2p_message)
+        try:
+            self.hole_puncher.start(on_message=self._handle_p2p_message)
+        except OSError:
+            # Порт занят - новый порт, а значит и новое отображение
+            cached = None
+            self.hole_puncher.local_port = 0
+            self.hole_puncher.start(on_message=self._handle_p2p_message)
+            
+        if cached:
+            self.public_address = cached[0]
+            print(f"Public address (cached): {self.public_address[0]}:{self.public_address[1]}")
+            self.nat_type = self.stun_client.load_cached_nat_type() or NAT_UNKNOWN
+            if self.nat_type == NAT_UNKNOWN:
+                self.hole_puncher.run_coroutine(self._classify_nat(), wait=False)
+        else:
+            # Пока STUN не ответил, используем локальный адрес
+            self.public_address = self.hole_puncher.get_local_address()
+            print("Getting public address via STUN...")
+            self.hole_puncher.run_coroutine(self._discover_public_address(), wait=False)
+            
+    async def _discover_public_address(self):
+        """
+        Определение внешнего адреса в фоне (в цикле HolePuncher)
+        """
+        address = await self.hole_puncher.discover_public_address(self.stun_client)
+        if address:
+            self.public_address = address
+            self.stun_client.save_cache(address, self.hole_puncher.get_local_address()[1])
+            print(f"Public address: {address[0]}:{address[1]}")
+        else:
+            local_addr = self.public_address
+            print(f"Using local address: {local_addr[0]}:{local_addr[1]}")
+        if self.address_callback:
+            self.address_callback(self.public_address)
+        await self._classify_nat()
+        
+    async def _classify_nat(self):
+        """
+        Определение типа NAT в фоне, чтобы не пробивать заведомо закрытое
+        """
+        behavior = await self.hole_puncher.classify_nat(self.stun_client)
+        self.nat_behavior = behavior
+        self.nat_type = behavior.nat_type
+        print(f"NAT type: {behavior.nat_type} (mapping: {behavior.mapping}, "
+              f"filtering: {behavior.filtering})")
+        if behavior.mapped_address:
+            self.stun_client.save_cache(behavior.mapped_address,
+                                        self.hole_puncher.get_local_address()[1], behavior.nat_type)
+        
+    def can_punch(self, peer_nat_type: Optional[str] = None) -> bool:
+        """
+        Есть ли смысл пробивать NAT к пиру с типом peer_nat_type (None - неизвестен)
+        """
+        return punching_possible(self.nat_type, peer_nat_type)
         
     def stop(self):
         """
@@ -43,46 +182,320 @@ class P2PClient:
         """
         self.hole_puncher.stop()
         
-    def add_peer(self, peer_id: str, ip: str, port: int, public_key: str):
+    def add_peer(self, peer_id: str, ip: str, port: int, public_key):
         """
         Добавление пира для P2P соединения
+        
+        Адрес проверяется в фоне; до подтверждения сообщения идут через relay.
         """
-        self.connected_peers[peer_id] = (ip, port, public_key)
         print(f"Added P2P peer: {peer_id} at {ip}:{port}")
+        return self.connect(peer_id, ip, port, public_key)
         
-    def establish_p2p_connection(self, peer_id: str, peer_public_ip: str, peer_port: int):
+    def connect(self, peer_id: str, ip: str, port: int, public_key=None,
+                peer_nat_type: Optional[str] = None,
+                timeout: float = P2P_CONNECT_TIMEOUT) -> concurrent.futures.Future:
         """
-        Установка P2P соединения с пиром
+        Установка P2P соединения с пиром без блокировки
+        
+        Возвращает future с результатом (True - адрес подтвержден пиром).
+        Если попытка к тому же адресу уже идет или удалась, возвращается ее
+        future. Без публичного ключа пира или при безнадежных типах NAT
+        future сразу завершается False.
+        """
+        if isinstance(public_key, str):
+            public_key = public_key.encode('utf-8')
+        address = (ip, port)
+        with self._connections_lock:
+            connection = self.connections.get(peer_id)
+            if (connection and connection.address == address
+                    and connection.state != STATE_FAILED):
+                return connection.future
+            replaced = connection
+            if replaced:
+                if public_key is None:
+                    public_key = replaced.public_key
+                # Новый адрес пира - прежняя попытка больше не нужна
+                if not self._finish(replaced, STATE_FAILED):
+                    replaced = None
+            connection = PeerConnection(peer_id, address, public_key)
+            self.connections[peer_id] = connection
+        if replaced:
+            self.connected_peers.remove(peer_id)
+            self._notify(replaced)
+            
+        if not public_key:
+            print(f"No public key for {peer_id}, cannot verify P2P connection")
+            self._fail(connection)
+        elif not self.can_punch(peer_nat_type):
+            print(f"Direct connection to {peer_id} impossible (NAT: {self.nat_type}, "
+                  f"peer NAT: {peer_nat_type or 'unknown'}), using relay")
+            self._fail(connection)
+        else:
+            print(f"Attempting P2P connection to {peer_id} at {ip}:{port}")
+            self._notify(connection)
+            try:
+                self.hole_puncher.run_coroutine(self._connect(connection, timeout), wait=False)
+            except RuntimeError:
+                # Цикл HolePuncher не запущен или уже остановлен
+                self._fail(connection)
+        return connection.future
+        
+    def establish_p2p_connection(self, peer_id: str, peer_public_ip: str, peer_port: int,
+                                 peer_nat_type: Optional[str] = None, public_key=None,
+                                 timeout: float = P2P_CONNECT_TIMEOUT) -> bool:
         """
-        print(f"Attempting P2P connection to {peer_id} at {peer_public_ip}:{peer_port}")
+        Установка P2P соединения с пиром; поток ждет результата
         
-        # Hole Punching
-        self.hole_puncher.punch_hole(peer_public_ip, peer_port, attempts=20)
+        Если по типам NAT прямое соединение невозможно, сразу возвращает
+        False, и сообщения идут через relay.
+        """
+        return self.connect(peer_id, peer_public_ip, peer_port, public_key,
+                            peer_nat_type, timeout).result()
         
-        # Проверяем, установилось ли соединение
-        test_message = {
-            'type': 'p2p_test',
+    async def _connect(self, connection: PeerConnection, timeout: float):
+        """
+        Hole punching и повтор пробы до подписанного ответа или таймаута
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        connection._event = asyncio.Event()
+        self._probes[connection.nonce] = connection
+        punch = asyncio.ensure_future(self.hole_puncher.punch(*connection.address,
+                                                              attempts=P2P_PUNCH_ATTEMPTS))
+        try:
+            # Проба подписана: пир отвечает только тому, кто владеет ключом
+            signature = await loop.run_in_executor(None, self.crypto_manager.sign, probe_payload(
+                connection.nonce, self.peer_id, connection.peer_id, PROBE_REQUEST_CONTEXT))
+            probe = encode_frame({
+                'type': 'p2p_probe',
+                'from': self.peer_id,
+                'to': connection.peer_id,
+                'nonce': connection.nonce.hex(),
+                'signature': base64.b64encode(signature).decode('ascii')
+            })
+            while not connection.future.done():
+                if punch.done() and connection.state == STATE_PUNCHING:
+                    self._set_state(connection, STATE_PROBING)
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    print(f"P2P connection to {connection.peer_id} not confirmed")
+                    break
+                self.hole_puncher.send_direct(*connection.address, probe)
+                try:
+                    await asyncio.wait_for(connection._event.wait(),
+                                           min(P2P_PROBE_INTERVAL, remaining))
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as e:
+            print(f"P2P connection to {connection.peer_id} failed: {e}")
+        finally:
+            punch.cancel()
+            self._probes.pop(connection.nonce, None)
+            # Таймаут или остановка клиента
+            self._fail(connection)
+            
+    def _handle_probe(self, message: dict, sender_addr: Tuple[str, int]):
+        """
+        Ответ на пробу пира: подпись nonce своим ключом (в цикле событий)
+        """
+        if message.get('to') != self.peer_id or not self.crypto_manager:
+            # Проба не нам (адрес достался другому клиенту) или нечем подписать
+            return
+        initiator_id = str(message['from'])
+        connection = self.connections.get(initiator_id)
+        if connection is None or not connection.public_key:
+            # Соединение с этим пиром не устанавливалось - отвечать незачем
+            return
+        if not self._allow_probe(tuple(sender_addr)) or self._probes_pending >= PROBE_MAX_PENDING:
+            return
+        nonce = bytes.fromhex(message['nonce'])
+        request_signature = base64.b64decode(message.get('signature') or '')
+        self._probes_pending += 1
+        future = self.hole_puncher.loop.run_in_executor(
+            None, self._sign_probe, nonce, initiator_id, request_signature, connection.public_key)
+        future.add_done_callback(
+            lambda f: self._send_probe_response(f, message['nonce'], sender_addr))
+        
+    def _allow_probe(self, address: Tuple[str, int]) -> bool:
+        """
+        Ограничение ответов на пробы с одного адреса (token bucket)
+        """
+        now = time.monotonic()
+        tokens, updated = self._probe_rate.pop(address, (PROBE_RATE, now))
+        tokens = min(PROBE_RATE, tokens + (now - updated) * PROBE_RATE)
+        allowed = tokens >= 1
+        self._probe_rate[address] = (tokens - 1 if allowed else tokens, now)
+        if len(self._probe_rate) > PROBE_RATE_TABLE_SIZE:
+            self._probe_rate.popitem(last=False)
+        return allowed
+        
+    def _sign_probe(self, nonce: bytes, initiator_id: str, request_signature: bytes,
+                    public_key: bytes) -> Optional[bytes]:
+        """
+        Проверка подписи пробы и подпись ответа (пул потоков); None - проба поддельная
+        """
+        key = (nonce, initiator_id)
+        signature = self._probe_signatures.get(key)
+        if signature is not None:
+            return signature
+        request = probe_payload(nonce, initiator_id, self.peer_id, PROBE_REQUEST_CONTEXT)
+        if not self.crypto_manager.verify_signature(request, request_signature, public_key):
+            return None
+        signature = self.crypto_manager.sign(probe_payload(nonce, initiator_id, self.peer_id))
+        with self._connections_lock:
+            if len(self._probe_signatures) >= PROBE_SIGNATURE_CACHE_SIZE:
+                self._probe_signatures.pop(next(iter(self._probe_signatures)), None)
+            self._probe_signatures[key] = signature
+        return signature
+        
+    def _send_probe_response(self, future, nonce_hex: str, sender_addr: Tuple[str, int]):
+        self._probes_pending -= 1
+        if future.cancelled():
+            # Клиент остановлен
+            return
+        try:
+            signature = future.result()
+        except Exception as e:
+            print(f"Failed to answer P2P probe: {e}")
+            return
+        if signature is None:
+            print(f"Invalid P2P probe signature from {sender_addr[0]}:{sender_addr[1]}")
+            return
+        response = {
+            'type': 'p2p_probe_response',
             'from': self.peer_id,
-            'timestamp': time.time()
+            'nonce': nonce_hex,
+            'signature': base64.b64encode(signature).decode('ascii')
         }
+        self.hole_puncher.send_direct(sender_addr[0], sender_addr[1], encode_frame(response))
         
-        success = self.hole_puncher.send_direct(peer_public_ip, peer_port, json.dumps(test_message))
-        if success:
-            print(f"P2P connection established with {peer_id}")
-            return True
-        else:
-            print(f"Failed to establish P2P connection with {peer_id}")
-            return False
+    def _handle_probe_response(self, message: dict, sender_addr: Tuple[str, int]):
+        """
+        Проверка подписанного ответа на нашу пробу (в пуле потоков)
+        """
+        connection = self._probes.get(bytes.fromhex(message['nonce']))
+        if connection is None or message.get('from') != connection.peer_id:
+            return
+        if connection.future.done() or self._probes_pending >= PROBE_MAX_PENDING:
+            return
+        payload = probe_payload(connection.nonce, self.peer_id, connection.peer_id)
+        signature = base64.b64decode(message['signature'])
+        self._probes_pending += 1
+        future = self.hole_puncher.loop.run_in_executor(
+            None, self.crypto_manager.verify_signature, payload, signature, connection.public_key)
+        future.add_done_callback(
+            lambda f: self._confirm_probe(f, connection, sender_addr))
+        
+    def _confirm_probe(self, future, connection: PeerConnection, sender_addr: Tuple[str, int]):
+        self._probes_pending -= 1
+        if future.cancelled():
+            # Клиент остановлен
+            return
+        try:
+            valid = future.result()
+        except Exception as e:
+            print(f"Failed to verify P2P probe response: {e}")
+            return
+        if not valid:
+            print(f"Invalid P2P probe signature from {sender_addr[0]}:{sender_addr[1]}")
+            return
+        with self._connections_lock:
+            if connection.future.done():
+                return
+            # Ответ мог прийти с другого адреса (NAT пира выбрал другой порт)
+            connection.address = tuple(sender_addr)
+            self._finish(connection, STATE_CONFIRMED)
+            current = self.connections.get(connection.peer_id) is connection
+        if current:
+            self.connected_peers.add(connection.peer_id, connection.address, connection.public_key)
+            # Канал доставки подтвержденного пира не вытесняется чужими адресами
+            self.hole_puncher.pin_peer(connection.address)
+        self._notify(connection)
+        print(f"P2P connection confirmed with {connection.peer_id} "
+              f"at {sender_addr[0]}:{sender_addr[1]}")
+        
+    def _fail(self, connection: PeerConnection):
+        with self._connections_lock:
+            finished = self._finish(connection, STATE_FAILED)
+        if finished:
+            self._notify(connection)
             
-    def send_p2p_message(self, to_peer_id: str, encrypted_ dict) -> bool:
+    def _finish(self, connection: PeerConnection, state: str) -> bool:
         """
-        Отправка сообщения через P2P
+        Завершение попытки соединения (под _connections_lock); False - уже завершена
         """
-        if to_peer_id not in self.connected_peers:
-            print(f"Unknown P2P peer: {to_peer_id}")
+        if connection.future.done():
             return False
+        if state == STATE_CONFIRMED:
+            connection.confirmed_at = time.time()
+        connection.state = state
+        connection.future.set_result(state == STATE_CONFIRMED)
+        if connection._event:
+            # Event цикла asyncio: будим _connect из любого потока
+            try:
+                self.hole_puncher.loop.call_soon_threadsafe(connection._event.set)
+            except RuntimeError:
+                # Цикл уже остановлен
+                pass
+        return True
+        
+    def _set_state(self, connection: PeerConnection, state: str):
+        with self._connections_lock:
+            if connection.future.done() and state != STATE_FAILED:
+                return
+            connection.state = state
+            current = self.connections.get(connection.peer_id) is connection
+        if state == STATE_FAILED and current:
+            self.connected_peers.remove(connection.peer_id)
+            self.hole_puncher.pin_peer(connection.address, False)
+        self._notify(connection)
+        
+    def _on_peer_evicted(self, entry, reason: str):
+        connection = self.connections.get(entry.peer_id)
+        if connection and connection.confirmed and connection.address == entry.address:
+            print(f"P2P peer {entry.peer_id} {reason}, path marked failed")
+            self._set_state(connection, STATE_FAILED)
+        
+    def _notify(self, connection: PeerConnection):
+        if self.connection_callback:
+            try:
+                self.connection_callback(connection.peer_id, connection.state)
+            except Exception as e:
+                print(f"Error in connection callback: {e}")
+                
+    def is_connected(self, peer_id: str) -> bool:
+        """
+        Подтвержден ли прямой путь к пиру (и пир не замолчал дольше PEER_TTL)
+        """
+        # Истекшие записи снимаются здесь: путь помечается failed до отправки
+        self.connected_peers.expire()
+        connection = self.connections.get(peer_id)
+        return connection is not None and connection.confirmed
+        
+    def get_connection_state(self, peer_id: str) -> Optional[str]:
+        """
+        Состояние соединения с пиром (None - соединение не устанавливалось)
+        """
+        connection = self.connections.get(peer_id)
+        return connection.state if connection else None
+        
+    def send_p2p_message(self, to_peer_id: str, encrypted_data, headers: Optional[dict] = None,
+                         done_callback: Optional[Callable] = None) -> Optional[Delivery]:
+        """
+        Отправка сообщения через P2P без ожидания подтверждения
+        
+        None - прямой путь не подтвержден, сообщение не отправлено. Иначе
+        возвращается Delivery, а done_callback(ok) вызывается в пуле потоков,
+        когда пир подтвердит прием (ok=True) или через P2P_SEND_TIMEOUT без
+        подтверждения (ok=False): тогда вызывающий отправляет через relay
+        (повтор отбросит получатель по message_id).
+        """
+        connection = self.connections.get(to_peer_id)
+        if connection is None or not connection.confirmed:
+            # Прямой путь не подтвержден - сразу relay
+            return None
             
-        ip, port, _ = self.connected_peers[to_peer_id]
+        ip, port = connection.address
         
         message = {
             'type': 'p2p_message',
@@ -91,50 +504,119 @@ class P2PClient:
             'data': encrypted_data,
             'timestamp': time.time()
         }
+        if headers:
+            message.update(headers)
         
-        message_str = json.dumps(message)
-        success = self.hole_puncher.send_direct(ip, port, message_str)
+        # Датаграмма - один кадр протокола; бинарный конверт идет без base64
+        delivery = self.hole_puncher.send_reliable_async(ip, port, encode_frame(message))
+        if delivery is None or not self._in_loop(self._watch_delivery, connection, delivery,
+                                                 done_callback):
+            return None
+        return delivery
         
-        if success:
-            print(f"P2P message sent to {to_peer_id}")
-        else:
-            print(f"Failed to send P2P message to {to_peer_id}")
+    def _in_loop(self, callback: Callable, *args) -> bool:
+        """Вызов в цикле событий из любого потока; False - клиент остановлен"""
+        try:
+            self.hole_puncher.loop.call_soon_threadsafe(callback, *args)
+            return True
+        except RuntimeError:
+            return False
             
-        return success
+    def _watch_delivery(self, connection: PeerConnection, delivery: Delivery,
+                        done_callback: Optional[Callable]):
+        """
+        Ожидание подтверждения в цикле событий, не дольше P2P_SEND_TIMEOUT
+        """
+        finished = False
         
-    def _handle_p2p_message(self, message_str: str, sender_addr: Tuple[str, int]):
+        def finish():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            timer.cancel()
+            self._delivery_done(connection, bool(delivery.ok), done_callback)
+            
+        timer = self.hole_puncher.loop.call_later(P2P_SEND_TIMEOUT, finish)
+        # Доставку решает поток транспорта под своим замком - в цикл передается только вызов
+        delivery.add_done_callback(lambda _: self._in_loop(finish))
+        
+    def _delivery_done(self, connection: PeerConnection, ok: bool,
+                       done_callback: Optional[Callable]):
+        if ok:
+            # Подтверждение доставки - тоже признак живого пира
+            self.connected_peers.touch(connection.peer_id)
+        elif connection.confirmed:
+            # Путь перестал работать: следующие сообщения - через relay,
+            # пока соединение не установят заново
+            print(f"P2P delivery to {connection.peer_id} not confirmed, path marked failed")
+            self._set_state(connection, STATE_FAILED)
+        if done_callback:
+            # Отправка через relay блокирует - не в цикле событий
+            self.hole_puncher.loop.run_in_executor(None, done_callback, ok)
+        
+    def send_ping(self, peer_id: str, probe_id: int) -> bool:
+        """
+        Проба пути к подтвержденному пиру одной датаграммой без повторов
+        
+        Ответ p2p_pong передается в pong_callback(peer_id, probe_id).
+        """
+        connection = self.connections.get(peer_id)
+        if connection is None or not connection.confirmed:
+            return False
+        ping = {'type': 'p2p_ping', 'from': self.peer_id, 'id': probe_id}
+        return self.hole_puncher.send_direct(*connection.address, encode_frame(ping))
+        
+    def _decode_datagram(self, data: bytes) -> Optional[dict]:
+        """
+        Разбор датаграммы: кадр протокола или JSON текст (старый формат)
+        """
+        if data[:1] == b'{':
+            return json.loads(data)
+        try:
+            frames = FrameDecoder().feed_payloads(data)
+        except ProtocolError:
+            frames = []
+        if len(frames) != 1:
+            # Служебные пакеты hole punching (PING, KEEP_ALIVE...)
+            return None
+        return decode_message(*frames[0])
+        
+    def _handle_p2p_message(self, data: bytes, sender_addr: Tuple[str, int]):
         """
         Обработка входящего P2P сообщения
         """
         try:
-            message = json.loads(message_str)
+            # Любой пакет с подтвержденного адреса продлевает запись пира
+            peer_id = self.connected_peers.touch_address(tuple(sender_addr))
+            message = self._decode_datagram(data)
+            if message is None:
+                return
             msg_type = message.get('type')
             
-            if msg_type == 'p2p_test':
-                # Ответ на тестовое сообщение
-                response = {
-                    'type': 'p2p_test_response',
-                    'from': self.peer_id,
-                    'timestamp': time.time()
-                }
-                self.hole_puncher.send_direct(sender_addr[0], sender_addr[1], json.dumps(response))
-                print(f"Received P2P test from {sender_addr[0]}:{sender_addr[1]}")
+            if msg_type == 'p2p_probe':
+                self._handle_probe(message, sender_addr)
                 
-            elif msg_type == 'p2p_test_response':
-                print(f"P2P connection confirmed with {sender_addr[0]}:{sender_addr[1]}")
+            elif msg_type == 'p2p_probe_response':
+                self._handle_probe_response(message, sender_addr)
+                
+            elif msg_type == 'p2p_ping':
+                pong = {'type': 'p2p_pong', 'from': self.peer_id, 'id': message.get('id')}
+                self.hole_puncher.send_direct(sender_addr[0], sender_addr[1], encode_frame(pong))
+                
+            elif msg_type == 'p2p_pong':
+                # Засчитываем ответ, только если он пришел с подтвержденного адреса
+                if peer_id is not None and peer_id == message.get('from') and self.pong_callback:
+                    self.pong_callback(peer_id, message.get('id'))
                 
             elif msg_type == 'p2p_message':
                 # Обработка входящего сообщения
-                sender_id = message.get('from')
-                encrypted_data = message.get('data')
-                
                 if self.message_callback:
-                    # Передаем сообщение основному приложению
-                    p2p_message = {
-                        'type': 'p2p_message',
-                        'from': sender_id,
-                        'data': encrypted_data
-                    }
+                    # Передаем сообщение основному приложению вместе с
+                    # дополнительными полями заголовка
+                    p2p_message = dict(message)
+                    p2p_message.pop('to', None)
+                    p2p_message.pop('timestamp', None)
                     self.message_callback(p2p_message)
                     
         except Exception as e:
@@ -146,11 +628,37 @@ class P2PClient:
         """
         self.message_callback = callback
         
+    def set_connection_callback(self, callback: Callable):
+        """
+        Установка callback(peer_id, state) на смену состояния соединения
+        
+        Вызывается из потока цикла HolePuncher или из вызвавшего connect.
+        """
+        self.connection_callback = callback
+        
+    def set_pong_callback(self, callback: Callable):
+        """
+        Установка callback(peer_id, probe_id) на ответ пира на send_ping
+        """
+        self.pong_callback = callback
+        
+    def set_address_callback(self, callback: Callable):
+        """
+        Установка callback, вызываемого, когда STUN определил внешний адрес
+        """
+        self.address_callback = callback
+        
     def get_public_address(self) -> Optional[Tuple[str, int]]:
         """
         Получение публичного адреса клиента
         """
         return self.public_address
+        
+    def get_nat_type(self) -> str:
+        """
+        Тип NAT клиента (NAT_* из stun_client), чтобы сообщить его пирам
+        """
+        return self.nat_type
 
 # Пример использования
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+"""
+Выбор пути доставки к пиру: напрямую (P2P) или через relay
+
+Для каждого пира и пути ведется сглаженный RTT, доля потерь и время
+последнего успеха. Оценка пути - ожидаемое время доставки rtt / (1 - loss).
+Маршрут меняется, только если другой путь лучше текущего заметно (на долю
+hysteresis и не меньше MIN_SWITCH_GAIN) или текущий путь отказал, чтобы шум
+измерений не перебрасывал сообщения с пути на путь.
+
+RTT обоих путей измеряется одинаково - пробами ping/pong (start_probe /
+complete_probe; проба без ответа за probe_timeout - потеря). Время до
+подтверждения обычной отправки включает очередь и повторы надежной доставки,
+которых у relay нет, поэтому отправки учитываются только как успех или
+потеря (record_success / record_loss).
+
+Сведения о пирах, которым не писали дольше PATH_STATS_TTL, забываются
+(forget_inactive), так что таблицы не растут без границ.
+"""
+import itertools
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+from config.settings import PATH_HYSTERESIS, PATH_PROBE_TIMEOUT, PATH_STATS_TTL
+
+PATH_P2P = 'p2p'
+PATH_RELAY = 'relay'
+
+# Порядок путей без измерений: прямой первым
+PATH_PREFERENCE = (PATH_P2P, PATH_RELAY)
+
+# Сглаживание RTT (как SRTT в TCP) и доли потерь
+RTT_ALPHA = 0.125
+LOSS_ALPHA = 0.1
+
+# Подряд потерянных проб или отправок, после которых путь отказал
+MAX_CONSECUTIVE_FAILURES = 3
+
+# Доля потерь, выше которой путь не используется
+MAX_LOSS = 0.5
+
+# Минимальный выигрыш в ожидаемом времени доставки для смены пути (секунд)
+MIN_SWITCH_GAIN = 0.005
+
+
+class PathStats:
+    """
+    Состояние одного пути к пиру
+    """
+    __slots__ = ('rtt', 'loss', 'last_success', 'last_failure', 'failures', 'samples')
+
+    def __init__(self):
+        self.rtt = None
+        self.loss = 0.0
+        self.last_success = None
+        self.last_failure = None
+        self.failures = 0  # подряд
+        self.samples = 0
+
+    def on_success(self, rtt: Optional[float], now: float):
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else self.rtt + RTT_ALPHA * (rtt - self.rtt)
+        self.loss -= LOSS_ALPHA * self.loss
+        self.failures = 0
+        self.last_success = now
+        self.samples += 1
+
+    def on_loss(self, now: float):
+        self.loss += LOSS_ALPHA * (1.0 - self.loss)
+        self.failures += 1
+        self.last_failure = now
+        self.samples += 1
+
+    @property
+    def failed(self) -> bool:
+        return self.failures >= MAX_CONSECUTIVE_FAILURES or self.loss > MAX_LOSS
+
+    @property
+    def score(self) -> Optional[float]:
+        """
+        Ожидаемое время доставки; None - RTT еще не измерен
+        """
+        if self.failed:
+            return float('inf')
+        if self.rtt is None:
+            return None
+        return self.rtt / (1.0 - self.loss)
+
+    def as_dict(self, now: float) -> dict:
+        return {
+            'rtt': self.rtt,
+            'loss': self.loss,
+            'score': self.score,
+            'failed': self.failed,
+            'failures': self.failures,
+            'samples': self.samples,
+            'last_success_ago': None if self.last_success is None else now - self.last_success,
+        }
+
+
+class PathSelector:
+    """
+    Маршруты к пирам по измерениям путей (потокобезопасно)
+    """
+
+    def __init__(self, hysteresis: float = PATH_HYSTERESIS,
+                 probe_timeout: float = PATH_PROBE_TIMEOUT):
+        self.hysteresis = hysteresis
+        self.probe_timeout = probe_timeout
+        self._paths: Dict[str, Dict[str, PathStats]] = {}
+        self._routes: Dict[str, str] = {}
+        self._last_used: Dict[str, float] = {}
+        self._probes = {}  # probe_id -> (peer_id, path, время отправки)
+        self._probe_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.switches = 0
+
+    def _stats(self, peer_id: str, path: str) -> PathStats:
+        paths = self._paths.setdefault(peer_id, {})
+        stats = paths.get(path)
+        if stats is None:
+            stats = paths[path] = PathStats()
+        return stats
+
+    def select(self, peer_id: str, available: Iterable[str]) -> Optional[str]:
+        """
+        Путь для следующего сообщения из доступных сейчас (None - ни одного)
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._last_used[peer_id] = now
+            candidates = [path for path in PATH_PREFERENCE if path in available]
+            if not candidates:
+                return None
+            current = self._routes.get(peer_id)
+            best = min(candidates, key=lambda path: self._rank(peer_id, path))
+            if current in candidates and best != current and not self._stats(peer_id, current).failed:
+                current_score = self._stats(peer_id, current).score
+                best_score = self._stats(peer_id, best).score
+                # Держимся текущего пути, пока другой не станет заметно лучше
+                if (current_score is None or best_score is None or best_score >= current_score
+                        - max(current_score * self.hysteresis, MIN_SWITCH_GAIN)):
+                    best = current
+            if best != current:
+                if current is not None:
+                    self.switches += 1
+                    print(f"Route to {peer_id}: {current} -> {best}")
+                self._routes[peer_id] = best
+            return best
+
+    def _rank(self, peer_id: str, path: str):
+        # Измеренные пути по оценке, затем неизмеренные по предпочтению,
+        # отказавшие - последними
+        stats = self._stats(peer_id, path)
+        score = stats.score
+        if score is None:
+            return (1, PATH_PREFERENCE.index(path))
+        if stats.failed:
+            return (2, PATH_PREFERENCE.index(path))
+        return (0, score)
+
+    def record_success(self, peer_id: str, path: str):
+        """
+        Подтвержденная доставка по пути (RTT не меняется - его меряют пробы)
+        """
+        with self._lock:
+            self._stats(peer_id, path).on_success(None, time.monotonic())
+
+    def record_loss(self, peer_id: str, path: str):
+        """
+        Неподтвержденная доставка или потерянная проба
+        """
+        with self._lock:
+            self._stats(peer_id, path).on_loss(time.monotonic())
+
+    def start_probe(self, peer_id: str, path: str) -> int:
+        """
+        Регистрация отправленной пробы; возвращает ее идентификатор
+        """
+        now = time.monotonic()
+        with self._lock:
+            probe_id = next(self._probe_ids)
+            self._probes[probe_id] = (peer_id, path, now)
+            # Пир, которого измеряют до первой отправки, тоже не забывается сразу
+            self._last_used.setdefault(peer_id, now)
+            return probe_id
+
+    def complete_probe(self, probe_id: int, peer_id: str, path: str) -> Optional[float]:
+        """
+        Ответ на пробу; возвращает измеренный RTT (None - проба чужая или истекла)
+        """
+        now = time.monotonic()
+        with self._lock:
+            probe = self._probes.get(probe_id)
+            if probe is None or probe[:2] != (peer_id, path):
+                return None
+            del self._probes[probe_id]
+            rtt = now - probe[2]
+            self._stats(peer_id, path).on_success(rtt, now)
+            return rtt
+
+    def expire_probes(self) -> int:
+        """
+        Учет потерь для проб без ответа дольше probe_timeout
+        """
+        now = time.monotonic()
+        deadline = now - self.probe_timeout
+        with self._lock:
+            # Идентификаторы растут вместе со временем отправки
+            expired = []
+            for probe_id, (peer_id, path, sent_at) in self._probes.items():
+                if sent_at > deadline:
+                    break
+                expired.append(probe_id)
+                self._stats(peer_id, path).on_loss(now)
+            for probe_id in expired:
+                del self._probes[probe_id]
+            return len(expired)
+
+    def active_peers(self, window: float) -> List[str]:
+        """
+        Пиры, которым отправляли сообщения за последние window секунд
+        """
+        deadline = time.monotonic() - window
+        with self._lock:
+            return [peer_id for peer_id, used in self._last_used.items() if used >= deadline]
+
+    def get_route(self, peer_id: str) -> dict:
+        """
+        Текущий путь к пиру и измерения всех путей
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'peer_id': peer_id,
+                'path': self._routes.get(peer_id),
+                'paths': {path: stats.as_dict(now)
+                          for path, stats in self._paths.get(peer_id, {}).items()},
+            }
+
+    def forget(self, peer_id: str):
+        """
+        Удаление всех сведений о пире
+        """
+        with self._lock:
+            self._forget(peer_id)
+
+    def forget_inactive(self, ttl: float = PATH_STATS_TTL) -> int:
+        """
+        Удаление сведений о пирах, которым не писали дольше ttl секунд
+        """
+        deadline = time.monotonic() - ttl
+        with self._lock:
+            inactive = [peer_id for peer_id in self._paths.keys() | self._last_used.keys()
+                        if self._last_used.get(peer_id, deadline) <= deadline]
+            for peer_id in inactive:
+                self._forget(peer_id)
+            return len(inactive)
+
+    def _forget(self, peer_id: str):
+        self._paths.pop(peer_id, None)
+        self._routes.pop(peer_id, None)
+        self._last_used.pop(peer_id, None)
+        for probe_id in [probe_id for probe_id, probe in self._probes.items()
+                         if probe[0] == peer_id]:
+            del self._probes[probe_id]
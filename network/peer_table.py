@@ -0,0 +1,213 @@
+"""
+Таблица пиров с ограничением по размеру и времени жизни
+
+Запись живет ttl секунд с последнего обращения (add/touch); таблица
+больше max_size вытесняет самые давние записи. Все записи имеют один ttl,
+поэтому порядок LRU совпадает с порядком истечения: устаревшие записи
+снимаются с головы OrderedDict за O(1) каждая, без обхода таблицы.
+Истечение выполняется при каждом добавлении, так что память ограничена
+даже при потоке пакетов с поддельных адресов.
+
+Обратный индекс address -> peer_id позволяет найти пира по адресу
+входящего пакета.
+
+Закрепленные записи (pinned - подтвержденные пиры) при переполнении
+вытесняются только после всех незакрепленных, так что поток записей с
+поддельных адресов не вытеснит настоящих пиров; ttl для них тот же.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Optional, Tuple
+from config.settings import PEER_TABLE_SIZE, PEER_TTL
+
+# Причины удаления записи для on_evict
+EVICT_EXPIRED = 'expired'
+EVICT_OVERFLOW = 'overflow'
+
+
+class PeerEntry:
+    __slots__ = ('peer_id', 'address', 'value', 'last_seen', 'pinned')
+
+    def __init__(self, peer_id: Hashable, address: Tuple[str, int], value, now: float,
+                 pinned: bool = False):
+        self.peer_id = peer_id
+        self.address = address
+        self.value = value
+        self.last_seen = now  # time.monotonic()
+        self.pinned = pinned
+
+
+class PeerRegistry:
+    """
+    Потокобезопасная таблица peer_id -> PeerEntry
+
+    on_evict(entry, reason) вызывается вне блокировки для записей,
+    удаленных по истечению ttl или из-за переполнения (но не remove).
+    """
+
+    def __init__(self, max_size: int = PEER_TABLE_SIZE, ttl: float = PEER_TTL,
+                 on_evict: Optional[Callable] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._entries: 'OrderedDict[Hashable, PeerEntry]' = OrderedDict()
+        self._by_address = {}  # address -> peer_id
+        self._lock = threading.Lock()
+        self.stats = {
+            'added': 0,
+            'expired': 0,
+            'evicted': 0,
+            'removed': 0,
+        }
+
+    def add(self, peer_id: Hashable, address: Tuple[str, int], value=None,
+            pinned: Optional[bool] = None) -> PeerEntry:
+        """
+        Добавление или обновление записи (сбрасывает ее ttl)
+
+        pinned=None оставляет закрепление существующей записи как есть.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(peer_id)
+            if entry is None:
+                entry = self._entries[peer_id] = PeerEntry(peer_id, address, value, now,
+                                                           bool(pinned))
+                self.stats['added'] += 1
+            else:
+                self._entries.move_to_end(peer_id)
+                entry.last_seen = now
+                entry.value = value
+                if pinned is not None:
+                    entry.pinned = pinned
+                if entry.address != address:
+                    self._unindex(entry)
+                    entry.address = address
+            previous = self._by_address.get(address)
+            if previous is not None and previous != peer_id:
+                # Адрес перешел к другому пиру - старая запись недействительна
+                self._drop(self._entries[previous])
+                self.stats['removed'] += 1
+            self._by_address[address] = peer_id
+            evicted = self._expire(now)
+            while len(self._entries) > self.max_size:
+                evicted.append((self._drop(self._overflow_victim()), EVICT_OVERFLOW))
+                self.stats['evicted'] += 1
+        self._notify(evicted)
+        return entry
+
+    def touch(self, peer_id: Hashable) -> bool:
+        """
+        Продление записи без изменений; False - записи нет
+        """
+        with self._lock:
+            entry = self._entries.get(peer_id)
+            if entry is None:
+                return False
+            self._entries.move_to_end(peer_id)
+            entry.last_seen = time.monotonic()
+            return True
+
+    def touch_address(self, address: Tuple[str, int]) -> Optional[Hashable]:
+        """
+        Продление записи пира с адресом address; возвращает его peer_id
+
+        Истекшая, но еще не снятая запись не продлевается (None), как и в get.
+        """
+        now = time.monotonic()
+        with self._lock:
+            peer_id = self._by_address.get(address)
+            if peer_id is None:
+                return None
+            entry = self._entries[peer_id]
+            if now - entry.last_seen > self.ttl:
+                return None
+            self._entries.move_to_end(peer_id)
+            entry.last_seen = now
+            return peer_id
+
+    def get(self, peer_id: Hashable) -> Optional[PeerEntry]:
+        """
+        Запись пира, если она не истекла
+        """
+        with self._lock:
+            entry = self._entries.get(peer_id)
+            if entry is None or time.monotonic() - entry.last_seen > self.ttl:
+                return None
+            return entry
+
+    def peer_for_address(self, address: Tuple[str, int]) -> Optional[Hashable]:
+        """
+        peer_id по адресу входящего пакета
+        """
+        with self._lock:
+            return self._by_address.get(address)
+
+    def remove(self, peer_id: Hashable) -> Optional[PeerEntry]:
+        with self._lock:
+            entry = self._entries.get(peer_id)
+            if entry is None:
+                return None
+            self.stats['removed'] += 1
+            return self._drop(entry)
+
+    def expire(self) -> int:
+        """
+        Удаление всех истекших записей
+        """
+        with self._lock:
+            evicted = self._expire(time.monotonic())
+        self._notify(evicted)
+        return len(evicted)
+
+    def _expire(self, now: float) -> List[Tuple[PeerEntry, str]]:
+        # Голова словаря - самая давняя запись
+        deadline = now - self.ttl
+        expired = []
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.last_seen >= deadline:
+                break
+            expired.append((self._drop(entry), EVICT_EXPIRED))
+        self.stats['expired'] += len(expired)
+        return expired
+
+    def _overflow_victim(self) -> PeerEntry:
+        # Самая давняя незакрепленная запись; закрепленных немного,
+        # поэтому обход с головы короткий
+        for entry in self._entries.values():
+            if not entry.pinned:
+                return entry
+        return next(iter(self._entries.values()))
+
+    def _drop(self, entry: PeerEntry) -> PeerEntry:
+        del self._entries[entry.peer_id]
+        self._unindex(entry)
+        return entry
+
+    def _unindex(self, entry: PeerEntry):
+        if self._by_address.get(entry.address) == entry.peer_id:
+            del self._by_address[entry.address]
+
+    def _notify(self, evicted: List[Tuple[PeerEntry, str]]):
+        if not self.on_evict:
+            return
+        for entry, reason in evicted:
+            try:
+                self.on_evict(entry, reason)
+            except Exception as e:
+                print(f"Error in peer eviction callback: {e}")
+
+    def items(self) -> List[Tuple[Hashable, PeerEntry]]:
+        """
+        Снимок записей от самой давней к самой свежей
+        """
+        with self._lock:
+            return list(self._entries.items())
+
+    def __contains__(self, peer_id: Hashable) -> bool:
+        return self.get(peer_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
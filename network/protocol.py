@@ -0,0 +1,166 @@
+"""
+Протокол обмена с relay сервером: кадры с префиксом длины
+
+Каждый кадр - это 4 байта длины (big-endian) и тело указанной длины.
+Обычный кадр содержит JSON документ. Если старший бит длины установлен,
+кадр бинарный: 4 байта длины JSON заголовка, сам заголовок и бинарные
+данные, которые подставляются в поле 'data' сообщения.
+"""
+import json
+import struct
+import uuid
+from typing import List, Tuple
+
+# Заголовок кадра: длина тела в байтах
+FRAME_HEADER = struct.Struct('!I')
+
+# Длина JSON заголовка внутри бинарного кадра
+HEADER_LENGTH = struct.Struct('!I')
+
+# Флаг бинарного кадра в старшем бите длины
+BINARY_FLAG = 0x80000000
+
+# Максимальный размер одного кадра (защита от мусора в потоке)
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """Нарушение формата потока кадров"""
+
+
+def new_message_id() -> str:
+    """
+    Глобально уникальный идентификатор сообщения (заголовок 'message_id')
+
+    Повторная отправка того же сообщения (другим путем или после ошибки)
+    идет с тем же идентификатором, и получатель отбрасывает дубликат.
+    """
+    return uuid.uuid4().hex
+
+
+def _dumps(message: dict) -> bytes:
+    return json.dumps(message, separators=(',', ':')).encode('utf-8')
+
+
+def encode_frame(message: dict) -> bytes:
+    """
+    Упаковка сообщения в кадр
+
+    Если поле 'data' содержит bytes, оно передается как есть в бинарном кадре.
+    """
+    data = message.get('data')
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        payload = _dumps(message)
+        if len(payload) > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame too large: {len(payload)} bytes")
+        return FRAME_HEADER.pack(len(payload)) + payload
+
+    header = {name: value for name, value in message.items() if name != 'data'}
+    header_bytes = _dumps(header)
+    length = HEADER_LENGTH.size + len(header_bytes) + len(data)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame too large: {length} bytes")
+    return b''.join([
+        FRAME_HEADER.pack(length | BINARY_FLAG),
+        HEADER_LENGTH.pack(len(header_bytes)),
+        header_bytes,
+        data
+    ])
+
+
+def pack_frame(binary: bool, payload: bytes) -> bytes:
+    """
+    Повторная упаковка принятого тела кадра (для пересылки без разбора)
+    """
+    length = len(payload) | BINARY_FLAG if binary else len(payload)
+    return FRAME_HEADER.pack(length) + payload
+
+
+def _split_binary(payload: bytes) -> Tuple[memoryview, memoryview]:
+    view = memoryview(payload)
+    if len(view) < HEADER_LENGTH.size:
+        raise ProtocolError("Binary frame too short")
+    (header_length,) = HEADER_LENGTH.unpack_from(view)
+    end = HEADER_LENGTH.size + header_length
+    if end > len(view):
+        raise ProtocolError("Binary frame header truncated")
+    return view[HEADER_LENGTH.size:end], view[end:]
+
+
+def decode_header(binary: bool, payload: bytes) -> dict:
+    """
+    Разбор только JSON заголовка кадра (бинарные данные не трогаются)
+    """
+    header = bytes(_split_binary(payload)[0]) if binary else payload
+    try:
+        return json.loads(header)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ProtocolError(f"Malformed frame: {e}") from e
+
+
+def decode_message(binary: bool, payload: bytes) -> dict:
+    """
+    Разбор кадра в сообщение; бинарные данные - memoryview среза тела
+    """
+    message = decode_header(binary, payload)
+    if binary:
+        message['data'] = _split_binary(payload)[1]
+    return message
+
+
+class FrameDecoder:
+    """
+    Инкрементальный декодер потока кадров
+
+    Принимает данные в том виде, в котором их вернул recv: кадр может прийти
+    по частям, а несколько кадров - одним куском.
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed_payloads(self, data: bytes) -> List[Tuple[bool, bytes]]:
+        """
+        Добавление данных в буфер и выдача (бинарный ли кадр, тело) без разбора
+        """
+        self._buffer += data
+        return self._drain()
+
+    def feed(self, data: bytes) -> List[dict]:
+        """
+        Добавление данных в буфер и выдача всех полностью принятых сообщений
+        """
+        self._buffer += data
+        return [decode_message(binary, payload) for binary, payload in self._drain()]
+
+    def _drain(self) -> List[Tuple[bool, bytes]]:
+        buffer = self._buffer
+        offset = 0
+        header_size = FRAME_HEADER.size
+        payloads = []
+
+        while len(buffer) - offset >= header_size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+            binary = bool(length & BINARY_FLAG)
+            length &= ~BINARY_FLAG
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Frame too large: {length} bytes")
+
+            end = offset + header_size + length
+            if end > len(buffer):
+                break
+
+            payloads.append((binary, bytes(buffer[offset + header_size:end])))
+            offset = end
+
+        # Удаляем обработанные кадры одним сдвигом буфера
+        if offset:
+            del buffer[:offset]
+        return payloads
+
+    def pending_bytes(self) -> int:
+        """
+        Количество байт незавершенного кадра в буфере
+        """
+        return len(self._buffer)
@@ -0,0 +1,320 @@
+"""
+Relay сервер для Secure Messenger на asyncio
+
+Сервер хранит таблицу маршрутизации peer_id -> соединение и пересылает
+кадры 'message' получателю без повторной сериализации. Кадры 'ping'/'pong'
+с полем 'to' пересылаются так же (клиенты так измеряют путь через relay),
+на 'ping' без 'to' сервер отвечает сам. Содержимое сообщений
+зашифровано end-to-end, сервер видит только заголовки маршрутизации.
+"""
+import argparse
+import asyncio
+from collections import deque
+from typing import Dict, Optional
+from config.settings import DEFAULT_HOST, DEFAULT_PORT
+from network.protocol import FrameDecoder, ProtocolError, decode_header, encode_frame, pack_frame
+
+# Размер буфера чтения из сокета клиента
+READ_CHUNK_SIZE = 65536
+
+# Лимит исходящего буфера одного соединения (байт)
+OUTBOX_LIMIT = 1024 * 1024
+
+# Сколько отправитель ждет освобождения буфера получателя (секунд)
+SEND_TIMEOUT = 5.0
+
+# Размер очереди входящих соединений
+LISTEN_BACKLOG = 4096
+
+
+class Outbox:
+    """
+    Исходящий буфер соединения, ограниченный по размеру в байтах
+
+    Пока буфер переполнен, put() ждет - так медленный получатель притормаживает
+    чтение из сокета отправителя, и давление передается по TCP обратно.
+    """
+
+    def __init__(self, limit: int = OUTBOX_LIMIT):
+        self.limit = limit
+        self.size = 0
+        self.closed = False
+        self._frames = deque()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+
+    def _has_room(self, length: int) -> bool:
+        # Кадр больше лимита все равно пропускаем, но только в пустой буфер
+        return self.size == 0 or self.size + length <= self.limit
+
+    def _append(self, frame: bytes):
+        self._frames.append(frame)
+        self.size += len(frame)
+        self._ready.set()
+
+    async def put(self, frame: bytes):
+        while not self.closed and not self._has_room(len(frame)):
+            self._space.clear()
+            await self._space.wait()
+        if self.closed:
+            raise ConnectionResetError("Connection closed")
+        self._append(frame)
+
+    def put_nowait(self, frame: bytes) -> bool:
+        """
+        Постановка кадра без ожидания; False если буфер переполнен
+        """
+        if self.closed or not self._has_room(len(frame)):
+            return False
+        self._append(frame)
+        return True
+
+    async def get_batch(self) -> Optional[bytes]:
+        """
+        Получение всех накопленных кадров одним куском; None после закрытия
+        """
+        while not self._frames:
+            if self.closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        batch = b''.join(self._frames)
+        self._frames.clear()
+        self.size = 0
+        self._space.set()
+        return batch
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+        self._space.set()
+
+
+class RelayConnection:
+    """
+    Соединение одного клиента с relay сервером
+    """
+
+    def __init__(self, server: 'RelayServer', reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.peer_id = None
+        self.outbox = Outbox(server.outbox_limit)
+        self.address = writer.get_extra_info('peername')
+
+    async def run(self):
+        """
+        Обслуживание соединения: чтение кадров и фоновая запись
+        """
+        writer_task = asyncio.get_running_loop().create_task(self._write_loop())
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await self.reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                for binary, payload in decoder.feed_payloads(data):
+                    await self._handle_frame(binary, payload)
+        except ProtocolError as e:
+            print(f"Protocol error from {self.address}: {e}")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.server.unregister(self)
+            self.outbox.close()
+            await writer_task
+            self.writer.close()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                batch = await self.outbox.get_batch()
+                if batch is None:
+                    break
+                self.writer.write(batch)
+                await self.writer.drain()
+        except ConnectionError:
+            self.outbox.close()
+
+    async def _handle_frame(self, binary: bool, payload: bytes):
+        # Для бинарного кадра разбирается только заголовок маршрутизации
+        message = decode_header(binary, payload)
+        if not isinstance(message, dict):
+            # Корректный JSON, но не объект (массив, число...)
+            self._send_error('invalid_frame')
+            return
+
+        msg_type = message.get('type')
+
+        if msg_type == 'register':
+            peer_id = message.get('peer_id')
+            if not peer_id or not isinstance(peer_id, str):
+                self._send_error('invalid_register')
+                return
+            self.server.register(peer_id, self)
+
+        elif msg_type == 'message':
+            if self.peer_id is None or message.get('from') != self.peer_id:
+                self._send_error('not_registered')
+                return
+            if not isinstance(message.get('to'), str):
+                # Ключ таблицы маршрутизации - строка; список или объект в
+                # dict.get дал бы TypeError и оборвал соединение
+                self._send_error('invalid_recipient')
+                return
+            await self.server.route(self, message['to'], pack_frame(binary, payload))
+
+        elif msg_type in ('ping', 'pong'):
+            if message.get('to') is None:
+                if msg_type == 'ping':
+                    self.outbox.put_nowait(encode_frame({'type': 'pong', 'id': message.get('id')}))
+                return
+            if self.peer_id is None or message.get('from') != self.peer_id:
+                self._send_error('not_registered')
+                return
+            if not isinstance(message['to'], str):
+                self._send_error('invalid_recipient')
+                return
+            # Проба не ждет места в буфере получателя и не порождает ошибок:
+            # пропавшая проба - тоже измерение пути
+            self.server.route_nowait(message.get('to'), pack_frame(binary, payload))
+
+        else:
+            self._send_error('unknown_type')
+
+    def _send_error(self, reason: str, **extra):
+        error = {'type': 'error', 'reason': reason}
+        error.update(extra)
+        self.outbox.put_nowait(encode_frame(error))
+
+
+class RelayServer:
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                 outbox_limit: int = OUTBOX_LIMIT, send_timeout: float = SEND_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.outbox_limit = outbox_limit
+        self.send_timeout = send_timeout
+        self.routes: Dict[str, RelayConnection] = {}  # peer_id -> соединение
+        self.connections = set()
+        self.server = None
+        self.stats = {
+            'relayed': 0,
+            'unknown_peer': 0,
+            'recipient_busy': 0,
+        }
+
+    async def start(self):
+        """
+        Запуск сервера
+        """
+        self.server = await asyncio.start_server(
+            self._handle_client, self.host, self.port, backlog=LISTEN_BACKLOG
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        print(f"Relay server listening on {self.host}:{self.port}")
+
+    async def serve_forever(self):
+        if not self.server:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def stop(self):
+        """
+        Остановка сервера и закрытие всех соединений
+        """
+        if self.server:
+            self.server.close()
+        for connection in list(self.connections):
+            connection.writer.close()
+        if self.server:
+            await self.server.wait_closed()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Ограничиваем буфер транспорта, чтобы drain() реально ждал клиента
+        writer.transport.set_write_buffer_limits(high=self.outbox_limit)
+        connection = RelayConnection(self, reader, writer)
+        self.connections.add(connection)
+        try:
+            await connection.run()
+        finally:
+            self.connections.discard(connection)
+
+    def register(self, peer_id: str, connection: RelayConnection):
+        """
+        Регистрация клиента в таблице маршрутизации
+        """
+        previous = self.routes.get(peer_id)
+        if previous is not None and previous is not connection:
+            # Повторный вход с того же peer_id вытесняет старое соединение
+            previous.writer.close()
+        if connection.peer_id and connection.peer_id != peer_id:
+            self.unregister(connection)
+        connection.peer_id = peer_id
+        self.routes[peer_id] = connection
+
+    def unregister(self, connection: RelayConnection):
+        if connection.peer_id and self.routes.get(connection.peer_id) is connection:
+            del self.routes[connection.peer_id]
+
+    async def route(self, sender: RelayConnection, to_peer_id: str, frame: bytes):
+        """
+        Пересылка кадра получателю с ожиданием места в его буфере
+        """
+        target = self.routes.get(to_peer_id)
+        if target is None:
+            self.stats['unknown_peer'] += 1
+            sender._send_error('unknown_peer', to=to_peer_id)
+            return
+
+        try:
+            await asyncio.wait_for(target.outbox.put(frame), self.send_timeout)
+        except (asyncio.TimeoutError, ConnectionResetError):
+            self.stats['recipient_busy'] += 1
+            sender._send_error('recipient_busy', to=to_peer_id)
+            return
+        self.stats['relayed'] += 1
+
+    def route_nowait(self, to_peer_id: str, frame: bytes) -> bool:
+        """
+        Пересылка служебного кадра без ожидания; False - получателя нет или буфер полон
+        """
+        target = self.routes.get(to_peer_id)
+        return target is not None and target.outbox.put_nowait(frame)
+
+
+def _raise_open_files_limit():
+    """
+    Поднятие лимита открытых файлов до максимума (только POSIX)
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Secure Messenger relay server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--outbox-limit', type=int, default=OUTBOX_LIMIT,
+                        help='Per-connection write buffer limit in bytes')
+    args = parser.parse_args()
+
+    _raise_open_files_limit()
+    server = RelayServer(args.host, args.port, outbox_limit=args.outbox_limit)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,746 @@
+"""
+Надежная упорядоченная доставка поверх UDP сокета HolePuncher
+
+Сообщение делится на пакеты DATA не больше MTU пути (network.fragmentation),
+каждый со своим номером. Получатель выдает пакеты строго по порядку номеров,
+собирая из них сообщения и отвечает ACK: номер следующего ожидаемого
+(кумулятивное подтверждение) и до MAX_SACK_BLOCKS диапазонов, принятых
+с опережением (SACK). Отправитель держит окно неподтвержденных пакетов
+размером min(cwnd, окно получателя):
+
+    - таймер повтора по RFC 6298 (SRTT, RTTVAR, RTO с удвоением);
+    - быстрый повтор, если после пакета подтверждены DUP_THRESHOLD более поздних;
+    - проба хвоста: если подтверждений нет 2*SRTT, последний пакет отправляется
+      повторно, не дожидаясь RTO (иначе одиночная потеря стоит целого RTO);
+    - AIMD: медленный старт до ssthresh, затем +1 пакет за RTT; потеря
+      уменьшает окно вдвое, истечение таймера - до одного пакета.
+
+Пакеты (первый байт PACKET_MAGIC отличает их от кадров и пакетов hole punching):
+
+    DATA: magic | type | flags | conn_id (4) | seq (4) | tx (4) | данные
+    ACK:  magic | type | conn_id (4) | cum_ack (4) | seq (4) | tx (4) | окно (2)
+          | n (1) | n * (start, end) | d (1) | d * lost_seq (4)
+    MTU_PROBE: magic | type | conn_id (4) | size (4) | заполнение до size байт
+    MTU_ACK:   magic | type | conn_id (4) | size (4)
+
+flags & FLAG_FIRST - первый фрагмент сообщения, flags & FLAG_MORE - у
+сообщения есть следующие фрагменты. Если получатель сбросил недособранное
+сообщение (слишком большое, нехватка памяти, таймаут сборки), номер
+последнего фрагмента такого сообщения повторяется в ACK (lost_seq, до
+MAX_LOST_NOTICES последних), и отправитель завершает его доставку неудачей -
+сообщение уходит через relay, а не считается доставленным. MTU пути ищется
+пробами с DF: подтвержденный размер становится размером пакетов DATA
+(сообщения, поставленные в очередь раньше, уже поделены по старому размеру).
+
+tx - номер отправки у отправителя, ACK возвращает seq и tx пакета, который
+его вызвал. RTT измеряется только по этой паре, поэтому повторные отправки
+и потерянные ACK не искажают оценку (как метки времени в TCP).
+
+Таймеры работают в своем потоке или, если start получил цикл asyncio,
+через loop.call_at в этом цикле; в обоих случаях без опроса - сон до
+ближайшего срока (повтор, проба, MTU, сборка фрагментов).
+
+conn_id выбирается отправителем случайно; после отказа доставки соединение
+начинается заново с новым conn_id, и получатель сбрасывает свое состояние.
+"""
+import asyncio
+import bisect
+import random
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
+from network.fragmentation import (DEFAULT_DATAGRAM_SIZE, MESSAGE_LOST, PROBE_DATAGRAM_SIZES,
+                                   Reassembler, fragment)
+
+PACKET_MAGIC = 0xD7
+
+DATA = 1
+ACK = 2
+MTU_PROBE = 3
+MTU_ACK = 4
+
+FLAG_MORE = 0x01
+FLAG_FIRST = 0x02
+
+DATA_HEADER = struct.Struct('!BBBIII')
+ACK_HEADER = struct.Struct('!BBIIIIHB')
+MTU_HEADER = struct.Struct('!BBII')
+SACK_BLOCK = struct.Struct('!II')
+MAX_SACK_BLOCKS = 4
+LOST_COUNT = struct.Struct('!B')
+LOST_SEQ = struct.Struct('!I')
+MAX_LOST_NOTICES = 4
+
+MTU_PROBE_ATTEMPTS = 3
+
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 60.0
+CLOCK_GRANULARITY = 0.01
+MIN_PROBE_TIMEOUT = 0.01
+MAX_RETRIES = 8
+
+INITIAL_CWND = 4.0
+RECEIVE_WINDOW = 256
+DUP_THRESHOLD = 3
+
+
+def is_reliable_packet(data: bytes) -> bool:
+    return len(data) >= MTU_HEADER.size and data[0] == PACKET_MAGIC
+
+
+class Delivery:
+    """
+    Результат отправки одного сообщения
+    """
+
+    # Один замок на все доставки: callback не теряется между проверкой и resolve
+    _callbacks_lock = threading.Lock()
+
+    def __init__(self):
+        self.ok = None
+        self._event = threading.Event()
+        self._callbacks = []
+
+    def _resolve(self, ok: bool):
+        with self._callbacks_lock:
+            if self.ok is not None:
+                return
+            self.ok = ok
+            callbacks, self._callbacks = self._callbacks, []
+        self._event.set()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Error in delivery callback: {e}")
+
+    def add_done_callback(self, callback: Callable):
+        """
+        callback(delivery) после подтверждения или отказа (сразу, если уже решено)
+        Вызывается под замком транспорта: callback должен только передать
+        работу в другой поток, не отправляя из себя
+        """
+        with self._callbacks_lock:
+            if self.ok is None:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    @property
+    def done(self) -> bool:
+        return self.ok is not None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ожидание подтверждения; True - получатель принял сообщение
+        """
+        self._event.wait(timeout)
+        return bool(self.ok)
+
+
+class _Segment:
+    __slots__ = ('seq', 'payload', 'more', 'first', 'delivery', 'sent_at', 'sent_order',
+                 'retries', 'sacked', 'lost')
+
+    def __init__(self, seq: int, payload: bytes, more: bool, delivery: Delivery,
+                 first: bool = True):
+        self.seq = seq
+        self.payload = payload
+        self.more = more
+        self.first = first
+        # Одна на все фрагменты сообщения
+        self.delivery = delivery
+        self.sent_at = 0.0
+        self.sent_order = 0
+        self.retries = 0
+        self.sacked = False
+        self.lost = False
+
+
+class _Channel:
+    """
+    Состояние обмена с одним адресом: отправка и прием
+    """
+
+    def __init__(self, addr: Tuple[str, int]):
+        self.addr = addr
+        # Отправка
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self._reset_sender()
+        # Прием
+        self.peer_conn_id = None
+        self.expected = 0
+        self.last_received = (0, 0)  # seq и tx для ACK
+        self.out_of_order: Dict[int, Tuple[bytes, int]] = {}
+        # Последние фрагменты сброшенных при сборке сообщений - для ACK
+        self.lost_seqs = deque(maxlen=MAX_LOST_NOTICES)
+
+    def _reset_sender(self):
+        self.conn_id = random.getrandbits(32)
+        self.next_seq = 0
+        self.unacked: 'OrderedDict[int, _Segment]' = OrderedDict()
+        self.queue = deque()
+        self.cwnd = INITIAL_CWND
+        self.ssthresh = float(RECEIVE_WINDOW)
+        self.peer_window = RECEIVE_WINDOW
+        self.recovery_seq = None
+        self.timer_deadline = None
+        self.probe_deadline = None
+        self.transmissions = 0
+        # Счетчики по unacked, чтобы не обходить окно на каждый ACK
+        self.sacked_count = 0
+        self.lost_count = 0
+        # Поиск MTU пути начинается заново и после отказа доставки
+        self.datagram_size = DEFAULT_DATAGRAM_SIZE
+        self.mtu_candidates = list(PROBE_DATAGRAM_SIZES)
+        self.mtu_probe_size = None
+        self.mtu_attempts = 0
+        self.mtu_deadline = None
+
+    def in_flight(self) -> int:
+        return len(self.unacked) - self.sacked_count - self.lost_count
+
+    def mark_lost(self, segment: _Segment):
+        if not segment.sacked and not segment.lost:
+            segment.lost = True
+            self.lost_count += 1
+
+
+class ReliableTransport:
+    """
+    Надежная доставка для всех адресов одного UDP сокета
+
+    send_datagram(data, addr) - отправка сырой датаграммы,
+    deliver(payload, addr) - выдача принятого сообщения (по порядку).
+    handle_datagram вызывается из потока приема сокета.
+    """
+
+    def __init__(self, send_datagram: Callable, deliver: Callable,
+                 window: int = RECEIVE_WINDOW, max_retries: int = MAX_RETRIES,
+                 probe_mtu: bool = False):
+        self._send_datagram = send_datagram
+        self._deliver = deliver
+        self.window = window
+        self.max_retries = max_retries
+        # Пробы MTU имеют смысл, только если на сокете выставлен DF
+        self.probe_mtu = probe_mtu
+        self._reassembler = Reassembler()
+        self._channels: Dict[Tuple[str, int], _Channel] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._running = False
+        self._timer_thread = None
+        self._loop = None
+        self._timer_handle = None
+        # Когда таймеры проснутся сами; 0 - уже работают
+        self._next_wakeup = float('inf')
+        self.stats = {
+            'sent': 0,
+            'retransmits': 0,
+            'acked': 0,
+            'failed': 0,
+            'received': 0,
+            'duplicates': 0,
+            'reassembly_dropped': 0,
+        }
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """
+        Запуск таймеров: в цикле loop, а без него - в отдельном потоке
+        """
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._loop = loop
+            self._next_wakeup = float('inf')
+        if loop is not None:
+            return
+        self._timer_thread = threading.Thread(target=self._timer_loop, name="reliable-timer")
+        self._timer_thread.daemon = True
+        self._timer_thread.start()
+
+    def stop(self):
+        """
+        Остановка таймеров; неподтвержденные сообщения считаются недоставленными
+        """
+        with self._lock:
+            self._running = False
+            self._wakeup.notify()
+            for channel in self._channels.values():
+                self._fail_channel(channel)
+        # Таймер в цикле asyncio сработает вхолостую или пропадет с циклом
+        if self._timer_thread:
+            self._timer_thread.join(timeout=1.0)
+
+    # Отправка
+
+    def send(self, addr: Tuple[str, int], payload: bytes, timeout: Optional[float] = None) -> bool:
+        """
+        Отправка с ожиданием подтверждения не дольше timeout секунд
+        """
+        return self.send_async(addr, payload).wait(timeout)
+
+    def send_async(self, addr: Tuple[str, int], payload: bytes) -> Delivery:
+        """
+        Постановка сообщения в очередь отправки без ожидания
+        
+        ValueError - сообщение больше fragmentation.MAX_MESSAGE_SIZE
+        """
+        delivery = Delivery()
+        with self._lock:
+            if not self._running:
+                delivery._resolve(False)
+                return delivery
+            channel = self._channel(addr)
+            chunks = fragment(payload, channel.datagram_size - DATA_HEADER.size)
+            for i, chunk in enumerate(chunks):
+                channel.queue.append(_Segment(channel.next_seq, chunk, i < len(chunks) - 1, delivery,
+                                              first=i == 0))
+                channel.next_seq += 1
+            now = time.monotonic()
+            outgoing = self._fill_window(channel, now)
+            if self.probe_mtu and channel.mtu_candidates and channel.mtu_probe_size is None:
+                outgoing += self._send_mtu_probe(channel, now)
+        self._flush(outgoing)
+        return delivery
+
+    def channel_stats(self, addr: Tuple[str, int]) -> Optional[dict]:
+        """
+        Состояние канала с адресом (для отладки и выбора пути)
+        """
+        with self._lock:
+            channel = self._channels.get(addr)
+            if channel is None:
+                return None
+            return {
+                'srtt_ms': channel.srtt * 1000 if channel.srtt is not None else None,
+                'rto_ms': channel.rto * 1000,
+                'cwnd': channel.cwnd,
+                'in_flight': channel.in_flight(),
+                'queued': len(channel.queue),
+                'datagram_size': channel.datagram_size,
+            }
+
+    def close_channel(self, addr: Tuple[str, int]) -> bool:
+        """
+        Удаление состояния обмена с адресом (пир пропал); неподтвержденные
+        сообщения считаются недоставленными
+        """
+        with self._lock:
+            channel = self._channels.pop(addr, None)
+            if channel is None:
+                return False
+            self._fail_channel(channel)
+            self._reassembler.discard(addr, dropped=False)
+        return True
+
+    # Прием
+
+    def handle_datagram(self, data: bytes, addr: Tuple[str, int]) -> bool:
+        """
+        Обработка пакета надежной доставки
+
+        True - пакет относится к каналу с addr (DATA или ответ на наши пакеты);
+        ACK с адреса, которому мы ничего не отправляли, канал не создает.
+        """
+        packet_type = data[1]
+        deliveries = []
+        related = packet_type != MTU_PROBE
+        with self._lock:
+            channel = self._channels.get(addr)
+            if channel is None and packet_type in (ACK, MTU_ACK):
+                return False
+            if packet_type == DATA and len(data) >= DATA_HEADER.size:
+                channel = self._channel(addr)
+                _, _, flags, conn_id, seq, tx = DATA_HEADER.unpack_from(data)
+                outgoing = self._on_data(channel, conn_id, seq, tx, data[DATA_HEADER.size:],
+                                         flags, deliveries)
+            elif packet_type == ACK and len(data) >= ACK_HEADER.size:
+                _, _, conn_id, cum_ack, echo_seq, echo_tx, window, count = \
+                    ACK_HEADER.unpack_from(data)
+                sacks = [SACK_BLOCK.unpack_from(data, ACK_HEADER.size + i * SACK_BLOCK.size)
+                         for i in range(min(count, MAX_SACK_BLOCKS))
+                         if len(data) >= ACK_HEADER.size + (i + 1) * SACK_BLOCK.size]
+                outgoing = self._on_ack(channel, conn_id, cum_ack, (echo_seq, echo_tx),
+                                        window, sacks,
+                                        self._parse_lost(data, ACK_HEADER.size
+                                                         + count * SACK_BLOCK.size))
+            elif packet_type == MTU_PROBE:
+                _, _, conn_id, _ = MTU_HEADER.unpack_from(data)
+                # Подтверждается фактически принятый размер; канал для этого не нужен
+                outgoing = [(MTU_HEADER.pack(PACKET_MAGIC, MTU_ACK, conn_id, len(data)), addr)]
+            elif packet_type == MTU_ACK:
+                _, _, conn_id, size = MTU_HEADER.unpack_from(data)
+                outgoing = self._on_mtu_ack(channel, conn_id, size)
+            else:
+                return False
+            self._schedule(self._reassembler.next_expiry())
+        self._flush(outgoing)
+        # Выдача вне блокировки; поток приема один, поэтому порядок сохраняется
+        for payload in deliveries:
+            try:
+                self._deliver(payload, addr)
+            except Exception as e:
+                print(f"Error delivering reliable message: {e}")
+        return related
+
+    # Внутреннее (вызывается под self._lock)
+
+    def _channel(self, addr) -> _Channel:
+        channel = self._channels.get(addr)
+        if channel is None:
+            channel = self._channels[addr] = _Channel(addr)
+        return channel
+
+    def _parse_lost(self, data: bytes, offset: int) -> List[int]:
+        # Номера потерянных при сборке сообщений после блоков SACK
+        if len(data) < offset + LOST_COUNT.size:
+            return []
+        (count,) = LOST_COUNT.unpack_from(data, offset)
+        offset += LOST_COUNT.size
+        return [LOST_SEQ.unpack_from(data, offset + i * LOST_SEQ.size)[0]
+                for i in range(min(count, MAX_LOST_NOTICES))
+                if len(data) >= offset + (i + 1) * LOST_SEQ.size]
+
+    def _on_data(self, channel: _Channel, conn_id: int, seq: int, tx: int, payload: bytes,
+                 flags: int, deliveries: List[bytes]) -> list:
+        if conn_id != channel.peer_conn_id:
+            if seq >= self.window:
+                # Хвост прежнего соединения, которого мы не знаем
+                return []
+            # Отправитель начал соединение заново; его недособранное сообщение
+            # уже отмечено у него как недоставленное
+            channel.peer_conn_id = conn_id
+            channel.expected = 0
+            channel.out_of_order = {}
+            channel.lost_seqs.clear()
+            self._reassembler.discard(channel.addr, dropped=False)
+
+        channel.last_received = (seq, tx)
+        if seq == channel.expected:
+            self._reassemble(channel, seq, payload, flags, deliveries)
+            channel.expected += 1
+            while channel.expected in channel.out_of_order:
+                self._reassemble(channel, channel.expected,
+                                 *channel.out_of_order.pop(channel.expected), deliveries)
+                channel.expected += 1
+        elif channel.expected < seq < channel.expected + self.window:
+            if seq in channel.out_of_order:
+                self.stats['duplicates'] += 1
+            channel.out_of_order[seq] = (payload, flags)
+        else:
+            self.stats['duplicates'] += 1
+        return [(self._build_ack(channel), channel.addr)]
+
+    def _reassemble(self, channel: _Channel, seq: int, payload: bytes, flags: int,
+                    deliveries: List[bytes]):
+        message = self._reassembler.feed(channel.addr, payload, bool(flags & FLAG_MORE),
+                                         bool(flags & FLAG_FIRST))
+        if message is MESSAGE_LOST:
+            # ACK этого и следующих пакетов сообщит отправителю о потере
+            channel.lost_seqs.append(seq)
+        elif message is not None:
+            deliveries.append(message)
+            self.stats['received'] += 1
+
+    def _build_ack(self, channel: _Channel) -> bytes:
+        # Диапазоны принятого с опережением, начиная с самых новых
+        blocks = []
+        for seq in sorted(channel.out_of_order, reverse=True):
+            if blocks and blocks[-1][0] == seq + 1:
+                blocks[-1][0] = seq
+            elif len(blocks) < MAX_SACK_BLOCKS:
+                blocks.append([seq, seq + 1])
+            else:
+                break
+        window = max(0, self.window - len(channel.out_of_order))
+        return ACK_HEADER.pack(PACKET_MAGIC, ACK, channel.peer_conn_id, channel.expected,
+                               *channel.last_received, window, len(blocks)) + \
+            b''.join(SACK_BLOCK.pack(start, end) for start, end in blocks) + \
+            LOST_COUNT.pack(len(channel.lost_seqs)) + \
+            b''.join(LOST_SEQ.pack(seq) for seq in channel.lost_seqs)
+
+    def _on_ack(self, channel: _Channel, conn_id: int, cum_ack: int, echo: Tuple[int, int],
+                window: int, sacks, lost: List[int] = ()) -> list:
+        if conn_id != channel.conn_id:
+            return []
+        for seq in lost:
+            segment = channel.unacked.get(seq)
+            if segment is not None and not segment.delivery.done:
+                # Получатель сбросил сообщение при сборке - доставка не удалась,
+                # хотя все его пакеты подтверждены
+                segment.delivery._resolve(False)
+                self.stats['failed'] += 1
+        now = time.monotonic()
+        channel.peer_window = window
+        newly_acked = 0
+
+        echo_seq, echo_tx = echo
+        segment = channel.unacked.get(echo_seq)
+        if segment is not None and segment.sent_order == echo_tx:
+            self._sample_rtt(channel, now - segment.sent_at)
+
+        while channel.unacked:
+            seq, segment = next(iter(channel.unacked.items()))
+            if seq >= cum_ack:
+                break
+            channel.unacked.popitem(last=False)
+            if segment.sacked:
+                channel.sacked_count -= 1
+            else:
+                newly_acked += 1
+                if segment.lost:
+                    channel.lost_count -= 1
+            self.stats['acked'] += 1
+            if not segment.more:
+                # Подтвержден последний фрагмент, значит и все сообщение
+                segment.delivery._resolve(True)
+
+        for start, end in sacks:
+            for seq in range(max(start, cum_ack), min(end, channel.next_seq)):
+                segment = channel.unacked.get(seq)
+                if segment is not None and not segment.sacked:
+                    if segment.lost:
+                        segment.lost = False
+                        channel.lost_count -= 1
+                    segment.sacked = True
+                    channel.sacked_count += 1
+                    newly_acked += 1
+
+        if channel.recovery_seq is not None and cum_ack >= channel.recovery_seq:
+            channel.recovery_seq = None
+
+        if self._detect_losses(channel) and channel.recovery_seq is None:
+            # Потеря по SACK: мультипликативное уменьшение, один раз за окно
+            channel.ssthresh = max(channel.in_flight() / 2.0, 2.0)
+            channel.cwnd = channel.ssthresh
+            channel.recovery_seq = channel.next_seq
+        elif newly_acked and channel.recovery_seq is None:
+            if channel.cwnd < channel.ssthresh:
+                channel.cwnd += newly_acked
+            else:
+                channel.cwnd += newly_acked / channel.cwnd
+            channel.cwnd = min(channel.cwnd, float(self.window))
+
+        if newly_acked:
+            # Новое подтверждение - таймеры заново
+            channel.timer_deadline = now + channel.rto if channel.unacked else None
+            channel.probe_deadline = self._probe_deadline(channel, now) if channel.unacked else None
+            self._schedule(channel.probe_deadline or channel.timer_deadline)
+        return self._fill_window(channel, now)
+
+    def _sample_rtt(self, channel: _Channel, rtt: float):
+        if channel.srtt is None:
+            channel.srtt = rtt
+            channel.rttvar = rtt / 2
+        else:
+            channel.rttvar = 0.75 * channel.rttvar + 0.25 * abs(channel.srtt - rtt)
+            channel.srtt = 0.875 * channel.srtt + 0.125 * rtt
+        channel.rto = min(MAX_RTO, max(MIN_RTO, channel.srtt + max(CLOCK_GRANULARITY,
+                                                                   4 * channel.rttvar)))
+
+    def _detect_losses(self, channel: _Channel) -> bool:
+        """
+        Пакет потерян, если подтверждено DUP_THRESHOLD отправленных после него
+        """
+        if channel.sacked_count < DUP_THRESHOLD:
+            return False
+        sacked_orders = sorted(segment.sent_order for segment in channel.unacked.values()
+                               if segment.sacked)
+        detected = False
+        for segment in channel.unacked.values():
+            if segment.sacked or segment.lost:
+                continue
+            later = len(sacked_orders) - bisect.bisect_right(sacked_orders, segment.sent_order)
+            if later >= DUP_THRESHOLD:
+                channel.mark_lost(segment)
+                detected = True
+        return detected
+
+    def _fill_window(self, channel: _Channel, now: float) -> list:
+        outgoing = []
+        limit = max(1, int(min(channel.cwnd, channel.peer_window)))
+        in_flight = channel.in_flight()
+
+        # Сначала повтор потерянных, затем новые сообщения
+        for segment in channel.unacked.values():
+            if in_flight >= limit or not channel.lost_count:
+                break
+            if segment.lost:
+                segment.lost = False
+                channel.lost_count -= 1
+                self.stats['retransmits'] += 1
+                outgoing.append(self._transmit(channel, segment, now))
+                in_flight += 1
+
+        while channel.queue and in_flight < limit:
+            segment = channel.queue.popleft()
+            channel.unacked[segment.seq] = segment
+            self.stats['sent'] += 1
+            outgoing.append(self._transmit(channel, segment, now))
+            in_flight += 1
+
+        if channel.unacked and channel.timer_deadline is None:
+            channel.timer_deadline = now + channel.rto
+            channel.probe_deadline = self._probe_deadline(channel, now)
+            self._schedule(channel.probe_deadline or channel.timer_deadline)
+        return outgoing
+
+    def _schedule(self, deadline: Optional[float]):
+        # Будим таймеры, только если они спят дольше нужного
+        if deadline is not None and deadline < self._next_wakeup:
+            self._next_wakeup = deadline
+            if self._loop is None:
+                self._wakeup.notify()
+            elif self._running:
+                self._loop.call_soon_threadsafe(self._arm_timer, deadline)
+
+    def _probe_deadline(self, channel: _Channel, now: float) -> Optional[float]:
+        if channel.srtt is None:
+            return None
+        return now + max(2 * channel.srtt, MIN_PROBE_TIMEOUT)
+
+    def _on_probe_timeout(self, channel: _Channel, now: float) -> list:
+        # Одна проба до следующего подтверждения; окно не уменьшается
+        channel.probe_deadline = None
+        segment = next((segment for segment in reversed(channel.unacked.values())
+                        if not segment.sacked and not segment.lost), None)
+        if segment is None:
+            return []
+        self.stats['retransmits'] += 1
+        return [self._transmit(channel, segment, now)]
+
+    def _transmit(self, channel: _Channel, segment: _Segment, now: float):
+        channel.transmissions += 1
+        segment.sent_at = now
+        segment.sent_order = channel.transmissions
+        flags = (FLAG_MORE if segment.more else 0) | (FLAG_FIRST if segment.first else 0)
+        packet = DATA_HEADER.pack(PACKET_MAGIC, DATA, flags,
+                                  channel.conn_id, segment.seq, segment.sent_order) + segment.payload
+        return packet, channel.addr
+
+    def _send_mtu_probe(self, channel: _Channel, now: float) -> list:
+        channel.mtu_probe_size = channel.mtu_candidates[0]
+        channel.mtu_deadline = now + channel.rto
+        self._schedule(channel.mtu_deadline)
+        packet = MTU_HEADER.pack(PACKET_MAGIC, MTU_PROBE, channel.conn_id, channel.mtu_probe_size)
+        return [(packet.ljust(channel.mtu_probe_size, b'\0'), channel.addr)]
+
+    def _on_mtu_ack(self, channel: _Channel, conn_id: int, size: int) -> list:
+        if conn_id != channel.conn_id or size != channel.mtu_probe_size:
+            return []
+        channel.datagram_size = size
+        channel.mtu_candidates.pop(0)
+        channel.mtu_attempts = 0
+        channel.mtu_probe_size = None
+        channel.mtu_deadline = None
+        if channel.mtu_candidates:
+            return self._send_mtu_probe(channel, time.monotonic())
+        return []
+
+    def _on_mtu_timeout(self, channel: _Channel, now: float) -> list:
+        channel.mtu_attempts += 1
+        if channel.mtu_attempts < MTU_PROBE_ATTEMPTS:
+            return self._send_mtu_probe(channel, now)
+        # Больший размер не проходит - остаемся на подтвержденном
+        channel.mtu_candidates = []
+        channel.mtu_probe_size = None
+        channel.mtu_deadline = None
+        return []
+
+    def _on_timeout(self, channel: _Channel, now: float) -> list:
+        oldest = next((segment for segment in channel.unacked.values() if not segment.sacked), None)
+        if oldest is None:
+            channel.timer_deadline = None
+            channel.probe_deadline = None
+            return []
+        oldest.retries += 1
+        if oldest.retries > self.max_retries:
+            print(f"Reliable delivery to {channel.addr[0]}:{channel.addr[1]} failed")
+            self._fail_channel(channel)
+            return []
+
+        # Все неподтвержденные считаются потерянными, окно - один пакет
+        channel.ssthresh = max(channel.in_flight() / 2.0, 2.0)
+        channel.cwnd = 1.0
+        channel.recovery_seq = None
+        for segment in channel.unacked.values():
+            channel.mark_lost(segment)
+        channel.rto = min(channel.rto * 2, MAX_RTO)
+        channel.timer_deadline = now + channel.rto
+        channel.probe_deadline = None
+        return self._fill_window(channel, now)
+
+    def _fail_channel(self, channel: _Channel):
+        failed = list(channel.unacked.values()) + list(channel.queue)
+        for segment in failed:
+            segment.delivery._resolve(False)
+        self.stats['failed'] += len(failed)
+        # Получатель увидит новый conn_id и начнет прием с нуля
+        channel._reset_sender()
+
+    def _run_timers(self, now: float) -> Tuple[list, Optional[float]]:
+        """
+        Обработка истекших сроков; возвращает пакеты и ближайший срок
+        """
+        outgoing = []
+        deadlines = []
+        for channel in self._channels.values():
+            if channel.mtu_deadline is not None and channel.mtu_deadline <= now:
+                outgoing += self._on_mtu_timeout(channel, now)
+            if channel.timer_deadline is not None and channel.timer_deadline <= now:
+                outgoing += self._on_timeout(channel, now)
+            elif channel.probe_deadline is not None and channel.probe_deadline <= now:
+                outgoing += self._on_probe_timeout(channel, now)
+            deadlines += [deadline for deadline in (channel.timer_deadline,
+                                                    channel.probe_deadline,
+                                                    channel.mtu_deadline)
+                          if deadline is not None]
+        self._reassembler.expire()
+        self.stats['reassembly_dropped'] = self._reassembler.dropped
+        expiry = self._reassembler.next_expiry()
+        if expiry is not None:
+            deadlines.append(expiry)
+        return outgoing, min(deadlines) if deadlines else None
+
+    def _timer_loop(self):
+        while True:
+            with self._lock:
+                if not self._running:
+                    return
+                outgoing, deadline = self._run_timers(time.monotonic())
+                if not outgoing:
+                    # Сон до ближайшего срока или до _schedule с более ранним
+                    self._next_wakeup = deadline if deadline is not None else float('inf')
+                    self._wakeup.wait(None if deadline is None else deadline - time.monotonic())
+                    self._next_wakeup = 0.0
+            self._flush(outgoing)
+
+    def _arm_timer(self, deadline: float):
+        # В цикле asyncio; loop.time() - это time.monotonic()
+        if self._timer_handle is not None:
+            if self._timer_handle.when() <= deadline:
+                return
+            self._timer_handle.cancel()
+        self._timer_handle = self._loop.call_at(deadline, self._on_loop_timer)
+
+    def _on_loop_timer(self):
+        self._timer_handle = None
+        with self._lock:
+            if not self._running:
+                return
+            outgoing, deadline = self._run_timers(time.monotonic())
+            self._next_wakeup = deadline if deadline is not None else float('inf')
+        if deadline is not None:
+            self._arm_timer(deadline)
+        self._flush(outgoing)
+
+    def _flush(self, outgoing):
+        for packet, addr in outgoing:
+            self._send_datagram(packet, addr)
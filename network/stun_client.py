@@ -1,13 +1,112 @@
 """
 STUN клиент для определения внешнего IP и порта
+
+Запросы уходят на все серверы сразу с одного сокета, ответы сопоставляются
+по transaction ID, побеждает первый корректный. Повтор запросов - по
+RFC 5389 (0.5 с с удвоением) до общего таймаута. discover работает в цикле
+asyncio с любым сокетом (например, сокетом HolePuncher, чтобы узнать
+отображение именно его порта), get_external_address - блокирующая обертка
+со своим сокетом.
+
+classify определяет поведение NAT по RFC 5780: отображение (сравнением
+внешних адресов для разных адресов сервера из OTHER-ADDRESS) и фильтрацию
+(ответами с другого адреса/порта по CHANGE-REQUEST). Если сервер не
+поддерживает RFC 5780, отображение сравнивается по двум разным серверам,
+а фильтрация остается неизвестной.
+
+Последнее отображение хранится в STUN_CACHE_PATH вместе с локальным портом
+и считается действительным STUN_CACHE_TTL секунд.
 """
+import asyncio
+import json
 import socket
 import struct
 import random
-from typing import Tuple, Optional
+import time
+from collections import namedtuple
+from pathlib import Path
+from typing import Callable, Tuple, Optional
+from config.settings import STUN_CACHE_PATH, STUN_CACHE_TTL, STUN_TIMEOUT
+
+MAGIC_COOKIE = 0x2112A442
+
+# Типы сообщений
+BINDING_REQUEST = 0x0001
+BINDING_RESPONSE = 0x0101
+BINDING_ERROR = 0x0111
+
+# Атрибуты
+MAPPED_ADDRESS = 0x0001
+CHANGE_REQUEST = 0x0003
+XOR_MAPPED_ADDRESS = 0x0020
+RESPONSE_ORIGIN = 0x802B
+OTHER_ADDRESS = 0x802C
+
+CHANGE_IP = 0x04
+CHANGE_PORT = 0x02
+
+# Первый повтор запроса, дальше интервал удваивается
+RETRANSMIT_INTERVAL = 0.5
+
+# Поведение отображения и фильтрации (RFC 5780)
+ENDPOINT_INDEPENDENT = 'endpoint_independent'
+ADDRESS_DEPENDENT = 'address_dependent'
+ADDRESS_AND_PORT_DEPENDENT = 'address_and_port_dependent'
+# Два сервера дали разные порты, но различить два варианта выше нельзя
+ENDPOINT_DEPENDENT = 'endpoint_dependent'
+BEHAVIOR_UNKNOWN = 'unknown'
+
+# Типы NAT в привычных названиях
+NAT_OPEN = 'open'
+NAT_FULL_CONE = 'full_cone'
+NAT_RESTRICTED_CONE = 'restricted_cone'
+NAT_PORT_RESTRICTED_CONE = 'port_restricted_cone'
+NAT_CONE = 'cone'  # отображение не зависит от адреса, фильтрация неизвестна
+NAT_SYMMETRIC = 'symmetric'
+NAT_BLOCKED = 'blocked'
+NAT_UNKNOWN = 'unknown'
+
+NATBehavior = namedtuple('NATBehavior', 'nat_type mapping filtering mapped_address')
+
+def is_stun_message(data: bytes) -> bool:
+    """
+    Похоже ли на сообщение STUN: два старших бита 0 и magic cookie
+    """
+    return (len(data) >= 20 and data[0] & 0xC0 == 0
+            and struct.unpack('!I', data[4:8])[0] == MAGIC_COOKIE)
+
+def punching_possible(local_type: str, peer_type: Optional[str] = None) -> bool:
+    """
+    Может ли hole punching сработать при таких NAT с двух сторон
+    
+    За симметричным NAT пир видит пакеты с непредсказуемого порта, поэтому
+    пройти может только к пиру без фильтрации по порту. Неизвестный тип
+    пира при симметричном своем NAT считается безнадежным.
+    """
+    if NAT_BLOCKED in (local_type, peer_type):
+        return False
+    lenient = (NAT_OPEN, NAT_FULL_CONE, NAT_RESTRICTED_CONE)
+    if local_type == NAT_SYMMETRIC:
+        return peer_type in lenient
+    if peer_type == NAT_SYMMETRIC:
+        return local_type in lenient
+    return True
+
+def _local_ip_towards(address: Tuple[str, int]) -> Optional[str]:
+    """
+    Локальный IP интерфейса, через который идет маршрут к address
+    """
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            # connect для UDP только выбирает маршрут, пакеты не отправляются
+            sock.connect(address)
+            return sock.getsockname()[0]
+    except OSError:
+        return None
 
 class STUNClient:
-    def __init__(self, stun_servers=None):
+    def __init__(self, stun_servers=None, cache_path: Path = STUN_CACHE_PATH,
+                 cache_ttl: float = STUN_CACHE_TTL):
         # Список публичных STUN серверов
         self.stun_servers = stun_servers or [
             'stun.l.google.com:19302',
@@ -15,91 +114,298 @@ class STUNClient:
             'stun.stunprotocol.org:3478',
             'stun.voiparound.com:3478'
         ]
+        self.cache_path = Path(cache_path) if cache_path else None
+        self.cache_ttl = cache_ttl
+        self._pending = {}  # transaction_id -> Future ответа
         
-    def get_external_address(self) -> Optional[Tuple[str, int]]:
+    def get_external_address(self, timeout: float = STUN_TIMEOUT) -> Optional[Tuple[str, int]]:
         """
         Получение внешнего IP и порта через STUN
         Возвращает: (external_ip, external_port) или None
+        
+        Блокирует не дольше timeout; нельзя вызывать из работающего цикла asyncio.
         """
-        for server in self.stun_servers:
-            try:
-                host, port = server.split(':')
-                port = int(port)
-                
-                external_addr = self._query_stun_server(host, port)
-                if external_addr:
-                    return external_addr
-            except Exception as e:
-                print(f"STUN server {server} failed: {e}")
-                continue
-                
-        return None
+        try:
+            address, local_port = asyncio.run(self._standalone(self.discover, timeout))
+        except Exception as e:
+            print(f"STUN discovery failed: {e}")
+            return None
+        if address:
+            self.save_cache(address, local_port)
+        return address
         
-    def _query_stun_server(self, host: str, port: int) -> Optional[Tuple[str, int]]:
+    def get_nat_behavior(self, timeout: float = STUN_TIMEOUT) -> NATBehavior:
         """
-        Отправка STUN запроса и обработка ответа
+        Определение типа NAT со своего сокета (блокирует до нескольких timeout)
         """
+        behavior, local_port = asyncio.run(self._standalone(self.classify, timeout, with_port=True))
+        if behavior.mapped_address:
+            self.save_cache(behavior.mapped_address, local_port, behavior.nat_type)
+        return behavior
+        
+    async def _standalone(self, method, timeout: float, with_port: bool = False):
+        loop = asyncio.get_running_loop()
+        client = self
+        
+        class _Protocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                client.handle_response(data)
+                
+        transport, _ = await loop.create_datagram_endpoint(_Protocol, local_addr=('0.0.0.0', 0))
+        local_port = transport.get_extra_info('sockname')[1]
         try:
-            # Создаем UDP сокет
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(3)  # 3 секунды таймаут
-            
-            # STUN Binding Request
-            transaction_id = random.getrandbits(96).to_bytes(12, 'big')
-            stun_request = self._create_binding_request(transaction_id)
+            if with_port:
+                result = await method(transport.sendto, local_port, timeout)
+            else:
+                result = await method(transport.sendto, timeout)
+            return result, local_port
+        finally:
+            transport.close()
             
-            # Отправляем запрос
-            sock.sendto(stun_request, (host, port))
+    async def discover(self, sendto: Callable, timeout: float = STUN_TIMEOUT) -> Optional[Tuple[str, int]]:
+        """
+        Параллельный опрос всех серверов через sendto(data, addr)
+        
+        Ответы, пришедшие на тот же сокет, нужно передавать в handle_response.
+        """
+        queries = [asyncio.ensure_future(self._query(server, sendto, timeout))
+                   for server in self.stun_servers]
+        try:
+            for query in asyncio.as_completed(queries):
+                response = await query
+                if response:
+                    return response['mapped']
+            print("No STUN server answered")
+            return None
+        finally:
+            for query in queries:
+                query.cancel()
+                
+    async def classify(self, sendto: Callable, local_port: int,
+                       timeout: float = STUN_TIMEOUT) -> NATBehavior:
+        """
+        Поведение NAT по RFC 5780 для сокета с локальным портом local_port
+        """
+        # Тест I на всех серверах; нужен сервер с OTHER-ADDRESS
+        responses = [response for response in await asyncio.gather(
+            *[self._query(server, sendto, timeout) for server in self.stun_servers]) if response]
+        if not responses:
+            # Молчание серверов - не доказательство блокировки UDP (сервер
+            # может быть недоступен сам); hole punching все равно пробуем
+            print("No STUN server answered")
+            return NATBehavior(NAT_UNKNOWN, BEHAVIOR_UNKNOWN, BEHAVIOR_UNKNOWN, None)
+        primary = next((response for response in responses if response.get('other')), responses[0])
+        mapped = primary['mapped']
+        server_ip, server_port = primary['server']
+        
+        if mapped == (_local_ip_towards(primary['server']), local_port):
+            # Внешний адрес совпадает с локальным - NAT нет
+            return NATBehavior(NAT_OPEN, ENDPOINT_INDEPENDENT, ENDPOINT_INDEPENDENT, mapped)
             
-            # Получаем ответ
-            response, _ = sock.recvfrom(1024)
+        other = primary.get('other')
+        if other:
+            # Фильтрация проверяется первой: пакеты тестов отображения на
+            # другой адрес сервера открыли бы его в фильтре NAT
+            filtering = await self._filtering_test(sendto, primary['server'], timeout)
+            other_ip, other_port = other
+            # Тест II: другой IP сервера, тот же порт
+            response = await self._request(sendto, (other_ip, server_port), timeout)
+            if not response:
+                mapping = BEHAVIOR_UNKNOWN
+            elif response['mapped'] == mapped:
+                mapping = ENDPOINT_INDEPENDENT
+            else:
+                # Тест III: другой IP и другой порт
+                second = response['mapped']
+                response = await self._request(sendto, (other_ip, other_port), timeout)
+                if not response:
+                    mapping = BEHAVIOR_UNKNOWN
+                elif response['mapped'] == second:
+                    mapping = ADDRESS_DEPENDENT
+                else:
+                    mapping = ADDRESS_AND_PORT_DEPENDENT
+        else:
+            # Без RFC 5780: сравнение отображений для разных серверов
+            others = [response['mapped'] for response in responses
+                      if response['server'][0] != server_ip]
+            if not others:
+                mapping = BEHAVIOR_UNKNOWN
+            elif all(address == mapped for address in others):
+                mapping = ENDPOINT_INDEPENDENT
+            else:
+                mapping = ENDPOINT_DEPENDENT
+            filtering = BEHAVIOR_UNKNOWN
             
-            # Парсим ответ
-            external_addr = self._parse_binding_response(response, transaction_id)
+        return NATBehavior(self._nat_type(mapping, filtering), mapping, filtering, mapped)
+        
+    async def _filtering_test(self, sendto: Callable, server: Tuple[str, int], timeout: float) -> str:
+        # Тест II: ответ с другого IP и порта
+        response = await self._request(sendto, server, timeout, CHANGE_IP | CHANGE_PORT)
+        if response is not None:
+            return ENDPOINT_INDEPENDENT if response else BEHAVIOR_UNKNOWN
+        # Тест III: ответ с того же IP, но другого порта
+        response = await self._request(sendto, server, timeout, CHANGE_PORT)
+        if response is not None:
+            return ADDRESS_DEPENDENT if response else BEHAVIOR_UNKNOWN
+        return ADDRESS_AND_PORT_DEPENDENT
+        
+    def _nat_type(self, mapping: str, filtering: str) -> str:
+        if mapping in (ADDRESS_DEPENDENT, ADDRESS_AND_PORT_DEPENDENT, ENDPOINT_DEPENDENT):
+            return NAT_SYMMETRIC
+        if mapping != ENDPOINT_INDEPENDENT:
+            return NAT_UNKNOWN
+        return {
+            ENDPOINT_INDEPENDENT: NAT_FULL_CONE,
+            ADDRESS_DEPENDENT: NAT_RESTRICTED_CONE,
+            ADDRESS_AND_PORT_DEPENDENT: NAT_PORT_RESTRICTED_CONE,
+        }.get(filtering, NAT_CONE)
+        
+    async def _query(self, server: str, sendto: Callable, timeout: float) -> Optional[dict]:
+        """
+        Binding Request серверу "host:port"; None - нет ответа за timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            host, port = server.rsplit(':', 1)
+            infos = await asyncio.wait_for(loop.getaddrinfo(
+                host, int(port), family=socket.AF_INET, type=socket.SOCK_DGRAM), timeout)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            print(f"STUN server {server} failed: {e!r}")
+            return None
+        return await self._request(sendto, infos[0][4], deadline - loop.time())
+        
+    async def _request(self, sendto: Callable, address: Tuple[str, int], timeout: float,
+                       change: int = 0) -> Optional[dict]:
+        """
+        Запрос с повторами до timeout
+        
+        Возвращает атрибуты ответа ('mapped', 'other', 'origin', 'server'),
+        пустой dict для ответа с ошибкой и None, если ответа нет.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        transaction_id = random.getrandbits(96).to_bytes(12, 'big')
+        future = self._pending[transaction_id] = loop.create_future()
+        stun_request = self._create_binding_request(transaction_id, change)
+        delay = RETRANSMIT_INTERVAL
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                sendto(stun_request, address)
+                try:
+                    response = await asyncio.wait_for(asyncio.shield(future), min(delay, remaining))
+                except asyncio.TimeoutError:
+                    delay *= 2
+                    continue
+                if response:
+                    response['server'] = address
+                return response
+        finally:
+            self._pending.pop(transaction_id, None)
             
-            sock.close()
-            return external_addr
+    def handle_response(self, data: bytes) -> bool:
+        """
+        Разбор ответа на текущий запрос; False - датаграмма не наша
+        """
+        if not is_stun_message(data):
+            return False
+        future = self._pending.get(data[8:20])
+        if future is None:
+            return False
+        if not future.done():
+            future.set_result(self._parse_attributes(data) or {})
+        return True
+        
+    def _read_cache(self) -> Optional[dict]:
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+            if time.time() - cache['updated'] > self.cache_ttl:
+                return None
+            return cache
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
             
-        except Exception as e:
-            print(f"STUN query failed: {e}")
+    def load_cache(self) -> Optional[Tuple[Tuple[str, int], int]]:
+        """
+        Последнее отображение ((ip, port), local_port), если оно еще действительно
+        """
+        cache = self._read_cache()
+        if not cache:
+            return None
+        try:
+            return tuple(cache['address']), cache['local_port']
+        except (KeyError, TypeError):
             return None
             
-    def _create_binding_request(self, transaction_id: bytes) -> bytes:
+    def load_cached_nat_type(self) -> Optional[str]:
         """
-        Создание STUN Binding Request
+        Последний определенный тип NAT, если запись еще действительна
         """
-        # STUN message type: Binding Request (0x0001)
-        message_type = 0x0001
-        # Message length: 0 (no attributes)
-        message_length = 0
-        # Magic cookie
-        magic_cookie = 0x2112A442
+        cache = self._read_cache()
+        return cache.get('nat_type') if cache else None
         
+    def save_cache(self, address: Tuple[str, int], local_port: int, nat_type: Optional[str] = None):
+        """
+        Запись отображения локального порта local_port во внешний адрес
+        """
+        if not self.cache_path:
+            return
+        cache = {'address': list(address), 'local_port': local_port, 'updated': time.time()}
+        if nat_type is None:
+            # Тип NAT не зависит от порта - сохраняем прежний
+            nat_type = self.load_cached_nat_type()
+        if nat_type:
+            cache['nat_type'] = nat_type
+        try:
+            with open(self.cache_path, 'w') as f:
+                json.dump(cache, f)
+        except OSError as e:
+            print(f"Could not save STUN cache: {e}")
+            
+    def _create_binding_request(self, transaction_id: bytes, change: int = 0) -> bytes:
+        """
+        Создание STUN Binding Request (change - флаги CHANGE-REQUEST)
+        """
+        attributes = b''
+        if change:
+            attributes = struct.pack('!HHI', CHANGE_REQUEST, 4, change)
+            
         # Pack header
-        stun_header = struct.pack('!HHI12s', 
-                                 message_type, 
-                                 message_length, 
-                                 magic_cookie, 
+        stun_header = struct.pack('!HHI12s',
+                                 BINDING_REQUEST,
+                                 len(attributes),
+                                 MAGIC_COOKIE,
                                  transaction_id)
-        return stun_header
+        return stun_header + attributes
         
     def _parse_binding_response(self, response: bytes, expected_tid: bytes) -> Optional[Tuple[str, int]]:
         """
-        Парсинг STUN Binding Response
+        Парсинг STUN Binding Response: внешний адрес или None
+        """
+        if response[8:20] != expected_tid:
+            return None
+        attributes = self._parse_attributes(response)
+        return attributes.get('mapped') if attributes else None
+        
+    def _parse_attributes(self, response: bytes) -> Optional[dict]:
+        """
+        Адреса из успешного ответа; None - ошибка или не ответ
         """
         try:
             # Parse header
             message_type, message_length, magic_cookie, transaction_id = struct.unpack('!HHI12s', response[:20])
             
-            # Check if it's our response
-            if transaction_id != expected_tid:
-                return None
-                
             # Check if it's success response (0x0101)
-            if message_type != 0x0101:
+            if message_type != BINDING_RESPONSE:
                 return None
                 
-            # Parse attributes to find XOR-MAPPED-ADDRESS
+            attributes = {}
             offset = 20
             while offset < len(response):
                 if offset + 4 > len(response):
@@ -112,42 +418,61 @@ class STUNClient:
                     break
                     
                 attr_value = response[offset:offset+attr_length]
-                offset += attr_length
+                # Атрибуты выровнены по 4 байта
+                offset += attr_length + (-attr_length % 4)
                 
-                # XOR-MAPPED-ADDRESS (0x0020)
-                if attr_type == 0x0020 and len(attr_value) >= 8:
-                    # Parse address family and port
-                    family = struct.unpack('!H', attr_value[2:4])[0]
-                    if family == 0x01:  # IPv4
-                        xor_port = struct.unpack('!H', attr_value[4:6])[0]
-                        port = xor_port ^ (magic_cookie >> 16)
-                        
-                        # Parse IP
-                        xor_ip = struct.unpack('!I', attr_value[6:10])[0]
-                        ip = xor_ip ^ magic_cookie
-                        
-                        ip_str = socket.inet_ntoa(struct.pack('!I', ip))
-                        return (ip_str, port)
-                        
-            return None
+                if attr_type == XOR_MAPPED_ADDRESS:
+                    address = self._parse_address(attr_value, xor=True)
+                    if address:
+                        attributes['mapped'] = address
+                elif attr_type == MAPPED_ADDRESS and 'mapped' not in attributes:
+                    # Старые серверы (RFC 3489) отвечают без XOR
+                    address = self._parse_address(attr_value)
+                    if address:
+                        attributes['mapped'] = address
+                elif attr_type == OTHER_ADDRESS:
+                    attributes['other'] = self._parse_address(attr_value)
+                elif attr_type == RESPONSE_ORIGIN:
+                    attributes['origin'] = self._parse_address(attr_value)
+                    
+            return attributes if 'mapped' in attributes else None
             
         except Exception as e:
             print(f"Error parsing STUN response: {e}")
             return None
+            
+    def _parse_address(self, value: bytes, xor: bool = False) -> Optional[Tuple[str, int]]:
+        """
+        Адрес IPv4 из атрибута: reserved, family, port, address
+        """
+        if len(value) < 8 or value[1] != 0x01:
+            return None
+        port, ip = struct.unpack('!HI', value[2:8])
+        if xor:
+            port ^= MAGIC_COOKIE >> 16
+            ip ^= MAGIC_COOKIE
+        return socket.inet_ntoa(struct.pack('!I', ip)), port
 
 # Удобная функция для использования
-def get_public_address() -> Optional[Tuple[str, int]]:
+def get_public_address(use_cache: bool = True) -> Optional[Tuple[str, int]]:
     """
-    Получение публичного адреса текущего устройства
+    Получение публичного адреса текущего устройства (из кэша, если он свежий)
     """
     stun_client = STUNClient()
+    if use_cache:
+        cached = stun_client.load_cache()
+        if cached:
+            return cached[0]
     return stun_client.get_external_address()
 
 if __name__ == "__main__":
     # Тест STUN клиента
     print("Getting public address via STUN...")
-    addr = get_public_address()
+    addr = get_public_address(use_cache=False)
     if addr:
         print(f"Public address: {addr[0]}:{addr[1]}")
     else:
-        print("Failed to get public address")
\ No newline at end of file
+        print("Failed to get public address")
+    behavior = STUNClient().get_nat_behavior()
+    print(f"NAT type: {behavior.nat_type} (mapping: {behavior.mapping}, "
+          f"filtering: {behavior.filtering})")
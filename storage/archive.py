@@ -0,0 +1,137 @@
+"""
+Архив старой истории сообщений
+
+Архив - это append-only сегменты в ARCHIVE_DIR. Каждый сегмент состоит из
+блоков, блок - одна пачка сообщений одного пира:
+
+    magic 'SMAB' | длина сжатых данных (4) | crc32 (4) | zlib(NDJSON строк)
+
+Расположение блоков (сегмент, смещение, длина) хранится в таблице
+archive_blocks базы данных, чтение идет через mmap сегмента.
+"""
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+from config.settings import ARCHIVE_DIR, ARCHIVE_SEGMENT_SIZE
+
+BLOCK_MAGIC = b'SMAB'
+BLOCK_HEADER = struct.Struct('!4sII')
+
+SEGMENT_PATTERN = re.compile(r'^segment-(\d{6})\.arc$')
+
+# Сообщение из архива; поля совпадают с Message, поэтому подходит для истории
+ArchivedMessage = namedtuple('ArchivedMessage',
+                             'id peer_id content timestamp direction message_id',
+                             defaults=(None,))
+
+
+class ArchiveError(Exception):
+    """Поврежденный блок архива"""
+
+
+def _segment_name(number: int) -> str:
+    return f"segment-{number:06d}.arc"
+
+
+class MessageArchive:
+    def __init__(self, archive_dir=ARCHIVE_DIR, segment_size: int = ARCHIVE_SEGMENT_SIZE):
+        self.archive_dir = Path(archive_dir)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._maps = {}  # сегмент -> (mmap, размер на момент отображения)
+
+        numbers = [int(match.group(1)) for match in
+                   (SEGMENT_PATTERN.match(path.name) for path in self.archive_dir.iterdir())
+                   if match]
+        self._segment_number = max(numbers, default=1)
+
+    def append(self, messages) -> Tuple[str, int, int]:
+        """
+        Дописывание блока сообщений одного пира
+        Возвращает (сегмент, смещение, длина) для archive_blocks
+        """
+        lines = [json.dumps({
+            'id': message.id,
+            'peer_id': message.peer_id,
+            'content': message.content,
+            'timestamp': message.timestamp.isoformat(),
+            'direction': message.direction,
+            'message_id': message.message_id
+        }, ensure_ascii=False) for message in messages]
+        compressed = zlib.compress('\n'.join(lines).encode('utf-8'), 6)
+        block = BLOCK_HEADER.pack(BLOCK_MAGIC, len(compressed), zlib.crc32(compressed)) + compressed
+
+        with self._lock:
+            segment = _segment_name(self._segment_number)
+            path = self.archive_dir / segment
+            offset = path.stat().st_size if path.exists() else 0
+            if offset and offset + len(block) > self.segment_size:
+                self._segment_number += 1
+                segment = _segment_name(self._segment_number)
+                path = self.archive_dir / segment
+                offset = 0
+
+            with open(path, 'ab') as f:
+                f.write(block)
+                f.flush()
+                # Блок должен быть на диске до удаления сообщений из БД
+                os.fsync(f.fileno())
+        return segment, offset, len(block)
+
+    def read_block(self, segment: str, offset: int, length: int) -> List[ArchivedMessage]:
+        """
+        Чтение блока по его расположению (старые сообщения первыми)
+        """
+        if not SEGMENT_PATTERN.match(segment):
+            raise ArchiveError(f"Bad segment name: {segment}")
+        block = self._read(segment, offset, length)
+        if len(block) < BLOCK_HEADER.size:
+            raise ArchiveError(f"Bad block length in {segment} at {offset}")
+        magic, compressed_length, checksum = BLOCK_HEADER.unpack_from(block)
+        compressed = block[BLOCK_HEADER.size:]
+        if magic != BLOCK_MAGIC or len(compressed) != compressed_length:
+            raise ArchiveError(f"Bad block header in {segment} at {offset}")
+        if zlib.crc32(compressed) != checksum:
+            raise ArchiveError(f"Checksum mismatch in {segment} at {offset}")
+
+        messages = []
+        for line in zlib.decompress(compressed).decode('utf-8').split('\n'):
+            record = json.loads(line)
+            messages.append(ArchivedMessage(
+                record['id'], record['peer_id'], record['content'],
+                datetime.fromisoformat(record['timestamp']), record['direction'],
+                record.get('message_id')
+            ))
+        return messages
+
+    def _read(self, segment: str, offset: int, length: int) -> bytes:
+        with self._lock:
+            mapped = self._maps.get(segment)
+            if mapped is None or mapped[1] < offset + length:
+                # Сегмент дописан после отображения - отображаем заново
+                if mapped is not None:
+                    del self._maps[segment]
+                    mapped[0].close()
+                with open(self.archive_dir / segment, 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if size < offset + length:
+                        raise ArchiveError(f"Segment {segment} is truncated")
+                    mapped = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), size)
+                self._maps[segment] = mapped
+            # Срез mmap - копия, отображение можно закрыть в любой момент
+            return mapped[0][offset:offset + length]
+
+    def close(self):
+        with self._lock:
+            for mapped, _ in self._maps.values():
+                mapped.close()
+            self._maps = {}
@@ -0,0 +1,309 @@
+"""
+Резервное копирование истории и ключей в сжатый NDJSON
+
+Копия - gzip поток строк JSON, по одной записи на строку:
+
+    {"type": "backup", "version": 1, "created": ...}
+    {"type": "peer", "peer_id": ..., "public_key": ..., "created_at": ...}
+    {"type": "retention", "peer_id": ..., "days": ...}
+    {"type": "message", "peer_id": ..., "content": ..., "timestamp": ..., "direction": ...,
+     "message_id": ...}
+    {"type": "key", "name": "private_key.pem", "data": ...}
+
+С паролем gzip поток шифруется фрагментами StreamCipher ключом из scrypt:
+
+    magic 'SMBK' | version (1) | соль (16) | nonce_prefix (7) | chunk_size (4) |
+    (длина фрагмента (4) | шифротекст)*
+
+Ключи (приватный в том числе) попадают в копию только при шифровании.
+Запись и чтение идут через генераторы, память не зависит от размера истории.
+"""
+import gzip
+import io
+import json
+import os
+import struct
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from crypto.encryption import StreamCipher
+from crypto.envelope import STREAM_NONCE_PREFIX_SIZE
+from storage.database import DatabaseManager
+
+BACKUP_VERSION = 1
+
+ENCRYPTED_MAGIC = b'SMBK'
+ENCRYPTED_HEADER = struct.Struct(f'!4sB16s{STREAM_NONCE_PREFIX_SIZE}sI')
+CHUNK_LENGTH = struct.Struct('!I')
+
+# Фрагмент шифрования копии и размер пачки при импорте
+BACKUP_CHUNK_SIZE = 1024 * 1024
+IMPORT_BATCH_SIZE = 5000
+
+# Файлы ключей, которые переносятся вместе с историей
+KEY_FILES = ('private_key.pem', 'public_key.pem')
+
+# Параметры scrypt: ~32 МБ памяти и доли секунды на вывод ключа
+SCRYPT_N = 2 ** 15
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+class BackupError(Exception):
+    """Поврежденная копия или неверный пароль"""
+
+
+def _derive_key(passphrase: str, salt: bytes) -> bytes:
+    kdf = Scrypt(salt=salt, length=32, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return kdf.derive(passphrase.encode('utf-8'))
+
+
+class _EncryptedWriter(io.RawIOBase):
+    """
+    Файловый объект для записи: шифрует данные фрагментами StreamCipher
+    """
+
+    def __init__(self, fileobj, passphrase: str, chunk_size: int = BACKUP_CHUNK_SIZE):
+        salt = os.urandom(16)
+        self.fileobj = fileobj
+        self.cipher = StreamCipher(_derive_key(passphrase, salt), chunk_size=chunk_size)
+        self.index = 0
+        self.buffer = bytearray()
+        fileobj.write(ENCRYPTED_HEADER.pack(ENCRYPTED_MAGIC, BACKUP_VERSION, salt,
+                                            self.cipher.nonce_prefix, chunk_size))
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self.buffer += data
+        chunk_size = self.cipher.chunk_size
+        # Последний фрагмент шифруется при закрытии с флагом final
+        while len(self.buffer) > chunk_size:
+            self._write_chunk(bytes(self.buffer[:chunk_size]), False)
+            del self.buffer[:chunk_size]
+        return len(data)
+
+    def _write_chunk(self, data: bytes, final: bool):
+        encrypted = self.cipher.encrypt_chunk(self.index, data, final)
+        self.fileobj.write(CHUNK_LENGTH.pack(len(encrypted)) + encrypted)
+        self.index += 1
+
+    def close(self):
+        if not self.closed:
+            self._write_chunk(bytes(self.buffer), True)
+            self.buffer = bytearray()
+        super().close()
+
+
+class _EncryptedReader(io.RawIOBase):
+    """
+    Файловый объект для чтения зашифрованной копии
+    """
+
+    def __init__(self, fileobj, passphrase: str):
+        header = fileobj.read(ENCRYPTED_HEADER.size)
+        if len(header) != ENCRYPTED_HEADER.size:
+            raise BackupError("Backup is truncated")
+        magic, version, salt, nonce_prefix, chunk_size = ENCRYPTED_HEADER.unpack(header)
+        if magic != ENCRYPTED_MAGIC or version != BACKUP_VERSION:
+            raise BackupError("Not an encrypted backup")
+        self.fileobj = fileobj
+        self.cipher = StreamCipher(_derive_key(passphrase, salt), nonce_prefix, chunk_size)
+        self.index = 0
+        self.buffer = b''
+        self.finished = False
+        self.next_chunk = self._read_raw_chunk()
+
+    def readable(self):
+        return True
+
+    def _read_raw_chunk(self) -> Optional[bytes]:
+        header = self.fileobj.read(CHUNK_LENGTH.size)
+        if not header:
+            return None
+        if len(header) != CHUNK_LENGTH.size:
+            raise BackupError("Backup is truncated")
+        (length,) = CHUNK_LENGTH.unpack(header)
+        if length > self.cipher.chunk_size + 16:
+            raise BackupError("Bad chunk length")
+        data = self.fileobj.read(length)
+        if len(data) != length:
+            raise BackupError("Backup is truncated")
+        return data
+
+    def _decrypt_next(self):
+        current = self.next_chunk
+        if current is None:
+            # Поток оборвался до фрагмента с флагом final
+            raise BackupError("Backup is truncated")
+        # Читаем на фрагмент вперед, чтобы знать, последний ли текущий
+        self.next_chunk = self._read_raw_chunk()
+        final = self.next_chunk is None
+        try:
+            self.buffer = self.cipher.decrypt_chunk(self.index, current, final)
+        except InvalidTag:
+            raise BackupError("Wrong passphrase or corrupted backup") from None
+        self.index += 1
+        self.finished = final
+
+    def readinto(self, target) -> int:
+        while not self.buffer and not self.finished:
+            self._decrypt_next()
+        length = min(len(target), len(self.buffer))
+        target[:length] = self.buffer[:length]
+        self.buffer = self.buffer[length:]
+        return length
+
+
+def _timestamp(value) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def iter_records(db_manager: DatabaseManager, keys_dir=None) -> Iterable[dict]:
+    """
+    Генератор записей копии; keys_dir - добавить файлы ключей
+    """
+    yield {'type': 'backup', 'version': BACKUP_VERSION,
+           'created': datetime.utcnow().isoformat()}
+    for peer in db_manager.get_all_peers():
+        yield {'type': 'peer', 'peer_id': peer.peer_id, 'public_key': peer.public_key,
+               'created_at': _timestamp(peer.created_at)}
+    for peer_id, days in db_manager.get_retention_policies().items():
+        yield {'type': 'retention', 'peer_id': peer_id, 'days': days}
+    for message in db_manager.iter_messages():
+        yield {'type': 'message', 'peer_id': message.peer_id, 'content': message.content,
+               'timestamp': _timestamp(message.timestamp), 'direction': message.direction,
+               'message_id': message.message_id}
+    if keys_dir:
+        for name in KEY_FILES:
+            path = Path(keys_dir) / name
+            if path.exists():
+                yield {'type': 'key', 'name': name, 'data': path.read_text()}
+
+
+def export_backup(db_manager: DatabaseManager, path, passphrase: str = None,
+                  keys_dir=None, progress: Callable = None) -> int:
+    """
+    Запись копии в файл; ключи добавляются только вместе с паролем
+    progress(записей, байт) вызывается каждые IMPORT_BATCH_SIZE записей
+    Возвращает число записанных сообщений
+    """
+    if keys_dir and not passphrase:
+        raise BackupError("Keys can only be exported into an encrypted backup")
+
+    messages = 0
+    count = 0
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as raw:
+        target = _EncryptedWriter(raw, passphrase) if passphrase else raw
+        try:
+            with gzip.GzipFile(fileobj=target, mode='wb', compresslevel=6) as archive:
+                for count, record in enumerate(iter_records(db_manager, keys_dir), 1):
+                    archive.write(json.dumps(record, ensure_ascii=False).encode('utf-8'))
+                    archive.write(b'\n')
+                    if record['type'] == 'message':
+                        messages += 1
+                    if progress and count % IMPORT_BATCH_SIZE == 0:
+                        progress(count, raw.tell())
+        finally:
+            if target is not raw:
+                target.close()
+        if progress:
+            progress(count, raw.tell())
+    # Неполная копия не должна занять место предыдущей
+    os.replace(tmp_path, path)
+    return messages
+
+
+def read_records(path, passphrase: str = None, progress: Callable = None) -> Iterable[dict]:
+    """
+    Генератор записей копии; progress(записей, прочитано байт, размер файла)
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as raw:
+        encrypted = raw.read(len(ENCRYPTED_MAGIC)) == ENCRYPTED_MAGIC
+        raw.seek(0)
+        if encrypted and not passphrase:
+            raise BackupError("Backup is encrypted, a passphrase is required")
+        source = io.BufferedReader(_EncryptedReader(raw, passphrase)) if encrypted else raw
+
+        with gzip.GzipFile(fileobj=source, mode='rb') as archive:
+            header = json.loads(archive.readline() or 'null')
+            if not isinstance(header, dict) or header.get('type') != 'backup':
+                raise BackupError("Not a messenger backup")
+            if header.get('version') != BACKUP_VERSION:
+                raise BackupError(f"Unsupported backup version: {header.get('version')}")
+            count = 0
+            for count, line in enumerate(archive, 1):
+                yield json.loads(line)
+                if progress and count % IMPORT_BATCH_SIZE == 0:
+                    progress(count, raw.tell(), size)
+        if progress:
+            progress(count, size, size)
+
+
+def import_backup(db_manager: DatabaseManager, path, passphrase: str = None,
+                  keys_dir=None, replace_keys: bool = False,
+                  batch_size: int = IMPORT_BATCH_SIZE, progress: Callable = None) -> dict:
+    """
+    Загрузка копии в БД пачками по batch_size сообщений на транзакцию
+
+    Ключи пишутся в keys_dir, только если своих ключей там нет или
+    replace_keys=True. Сообщения с message_id, уже сохраненные в БД,
+    пропускаются. Возвращает счетчики импортированных записей.
+    """
+    stats = {'peers': 0, 'messages': 0, 'keys': 0}
+    peers = []
+    batch = []
+    for record in read_records(path, passphrase, progress):
+        kind = record.get('type')
+        if kind == 'message':
+            if peers:
+                # Пиры идут в копии перед сообщениями
+                stats['peers'] += db_manager.import_peers(peers)
+                peers = []
+            batch.append({
+                'peer_id': record['peer_id'],
+                'content': record['content'],
+                'timestamp': _parse_timestamp(record['timestamp']),
+                'direction': record['direction'],
+                'message_id': record.get('message_id')
+            })
+            if len(batch) >= batch_size:
+                stats['messages'] += db_manager.import_messages(batch)
+                batch = []
+        elif kind == 'peer':
+            peers.append({
+                'peer_id': record['peer_id'],
+                'public_key': record['public_key'],
+                'created_at': _parse_timestamp(record.get('created_at'))
+            })
+        elif kind == 'retention':
+            db_manager.set_retention_policy(record['peer_id'], record['days'])
+        elif kind == 'key' and keys_dir and record.get('name') in KEY_FILES:
+            stats['keys'] += _restore_key(Path(keys_dir), record, replace_keys)
+
+    if peers:
+        stats['peers'] += db_manager.import_peers(peers)
+    if batch:
+        stats['messages'] += db_manager.import_messages(batch)
+    return stats
+
+
+def _restore_key(keys_dir: Path, record: dict, replace_keys: bool) -> int:
+    path = keys_dir / record['name']
+    if path.exists() and not replace_keys:
+        print(f"Keeping existing {record['name']}")
+        return 0
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(record['data'])
+    os.replace(tmp_path, path)
+    return 1
@@ -1,11 +1,23 @@
 """
 Модуль работы с базой данных для Secure Messenger
 """
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import (create_engine, event, inspect, insert, select, update, text, bindparam, tuple_, Column, Integer,
+                        String, Text, DateTime, ForeignKey, Index)
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from pathlib import Path
 import os
+import re
+import threading
+import time
+from config.settings import (DB_WRITE_BATCH_SIZE, DB_WRITE_FLUSH_INTERVAL, DB_WRITE_RETRIES,
+                             DB_WRITE_RETRY_DELAY, DB_CACHE_SIZE_KB, DB_MMAP_SIZE, RETENTION_DAYS, COMPACTION_INTERVAL,
+                             COMPACTION_BATCH_SIZE, VACUUM_PAGES)
+from storage.archive import MessageArchive
 
 Base = declarative_base()
 
@@ -25,49 +37,900 @@ class Message(Base):
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
     direction = Column(String, nullable=False)  # 'sent' or 'received'
+    # Идентификатор из заголовка сообщения; NULL у старых сообщений
+    message_id = Column(String)
     
     peer = relationship("Peer")
+    
+    __table_args__ = (
+        # История с пиром: фильтр по peer_id, сортировка по времени
+        Index('ix_messages_peer_id_timestamp', 'peer_id', 'timestamp'),
+        # Повторно доставленное сообщение не сохраняется второй раз
+        Index('ix_messages_peer_id_message_id', 'peer_id', 'message_id', unique=True),
+    )
+
+class Conversation(Base):
+    """Сводка диалога с пиром для списка контактов"""
+    __tablename__ = 'conversations'
+    
+    peer_id = Column(String, ForeignKey('peers.peer_id'), primary_key=True)
+    last_message_id = Column(Integer)
+    preview = Column(Text)
+    last_timestamp = Column(DateTime, index=True)
+    unread_count = Column(Integer, default=0, nullable=False)
+
+class RetentionPolicy(Base):
+    """Срок хранения истории пира в БД; days=0 - хранить всегда"""
+    __tablename__ = 'retention_policies'
+    
+    peer_id = Column(String, ForeignKey('peers.peer_id'), primary_key=True)
+    days = Column(Integer, nullable=False)
+
+class ArchiveBlock(Base):
+    """Расположение блока архива с сообщениями одного пира"""
+    __tablename__ = 'archive_blocks'
+    
+    id = Column(Integer, primary_key=True)
+    peer_id = Column(String, nullable=False)
+    segment = Column(String, nullable=False)
+    offset = Column(Integer, nullable=False)
+    length = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+    first_timestamp = Column(DateTime, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    
+    __table_args__ = (
+        Index('ix_archive_blocks_peer_id_first_timestamp', 'peer_id', 'first_timestamp'),
+    )
+
+# Длина превью последнего сообщения в conversations
+PREVIEW_LENGTH = 100
+
+# Ключей (peer_id, timestamp) в одном запросе поиска импортируемых повторов
+IMPORT_LOOKUP_BATCH = 400
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Настройка каждого нового соединения SQLite"""
+    cursor = dbapi_connection.cursor()
+    # Действует только для новой БД; существующую переводит DatabaseManager при запуске
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL: читатели не блокируют писателя, commit без полного fsync
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+class WriteBehindQueue:
+    """
+    Фоновая пакетная запись сообщений
+    
+    Сообщения копятся в памяти и записываются одной транзакцией, когда их
+    набирается batch_size или проходит flush_interval секунд с первого.
+    Пачка, которую не удалось записать, возвращается в очередь и пишется
+    снова после паузы; после DB_WRITE_RETRIES ошибок подряд строки пишутся
+    по одной, и теряются только те, что не записываются сами по себе.
+    """
+    def __init__(self, engine, batch_size: int = DB_WRITE_BATCH_SIZE,
+                 flush_interval: float = DB_WRITE_FLUSH_INTERVAL, write_lock=None):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        # Пиры, диалоги которых прочитаны, пока их сообщения ждут записи
+        self._read_peers = set()
+        self._condition = threading.Condition()
+        # Общий с DatabaseManager замок: в SQLite одновременно пишет один
+        self._write_lock = write_lock or threading.RLock()
+        self._running = True
+        self._flush_requested = False
+        self._failures = 0
+        self._retry_at = 0.0
+        self._thread = threading.Thread(target=self._writer_loop, name="db-write-behind")
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def put(self, row: dict):
+        """Постановка строки messages в очередь записи"""
+        with self._condition:
+            self._pending.append(row)
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._condition.notify()
+                
+    def pending_count(self) -> int:
+        """Количество строк, ожидающих записи"""
+        with self._condition:
+            return len(self._pending)
+            
+    def pending_rows(self, peer_id: str = None) -> list:
+        """Копия строк, ожидающих записи (всех или одного пира), от старых к новым"""
+        with self._condition:
+            return [dict(row) for row in self._pending
+                    if peer_id is None or row['peer_id'] == peer_id]
+            
+    def mark_read(self, peer_id: str):
+        """
+        Сброс непрочитанных пира после записи его сообщений из очереди
+        Вызывается под замком записи, пока очередь не пишется
+        """
+        with self._condition:
+            if any(row['peer_id'] == peer_id and row['direction'] == 'received'
+                   for row in self._pending):
+                self._read_peers.add(peer_id)
+                
+    def request_flush(self):
+        """
+        Просьба фоновому потоку записать очередь, не дожидаясь полной пачки
+        Не блокирует вызывающего: сама запись идет в потоке db-write-behind
+        """
+        with self._condition:
+            if self._pending:
+                self._flush_requested = True
+                self._condition.notify()
+            
+    def flush(self):
+        """Немедленная запись всего, что накопилось"""
+        with self._write_lock:
+            with self._condition:
+                rows, self._pending = self._pending, []
+                read_peers, self._read_peers = self._read_peers, set()
+            if not rows:
+                return
+            try:
+                self._write(rows, read_peers)
+                self._failures = 0
+            except Exception as e:
+                self._failures += 1
+                if self._failures >= DB_WRITE_RETRIES:
+                    print(f"Failed to write {len(rows)} messages: {e}, writing one by one")
+                    self._failures = 0
+                    self._write_each(rows, read_peers)
+                    return
+                delay = DB_WRITE_RETRY_DELAY * 2 ** (self._failures - 1)
+                print(f"Failed to write {len(rows)} messages: {e}, retrying in {delay:g} s")
+                with self._condition:
+                    # Строки возвращаются в начало очереди, порядок сохраняется
+                    self._pending[:0] = rows
+                    self._read_peers |= read_peers
+                    self._retry_at = time.monotonic() + delay
+                    
+    def close(self):
+        """Запись остатка (с повторами) и остановка фонового потока"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        while self.pending_count():
+            time.sleep(max(0.0, self._retry_at - time.monotonic()))
+            self.flush()
+        
+    def _writer_loop(self):
+        while True:
+            with self._condition:
+                while self._running and not self._pending:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                # Ждем полной пачки, но не дольше flush_interval
+                if len(self._pending) < self.batch_size and not self._flush_requested:
+                    self._condition.wait(self.flush_interval)
+                self._flush_requested = False
+                # После ошибки записи - пауза перед повтором
+                while self._running and time.monotonic() < self._retry_at:
+                    self._condition.wait(self._retry_at - time.monotonic())
+                if not self._running:
+                    return
+            self.flush()
+            
+    def _write(self, rows, read_peers=()):
+        with self.engine.begin() as connection:
+            # Дубликаты по (peer_id, message_id) пропускаются без ошибки
+            if rows:
+                connection.execute(insert(Message.__table__).prefix_with('OR IGNORE'), rows)
+            if read_peers:
+                connection.execute(
+                    update(Conversation.__table__)
+                    .where(Conversation.peer_id.in_(read_peers))
+                    .values(unread_count=0)
+                )
+                
+    def _write_each(self, rows, read_peers):
+        """Запись по одной строке: теряются только строки с собственной ошибкой"""
+        lost = []
+        for row in rows:
+            try:
+                self._write([row])
+            except Exception as e:
+                lost.append(row)
+                print(f"Failed to write message {row.get('message_id')} "
+                      f"from {row['peer_id']}: {e}")
+        if read_peers:
+            try:
+                self._write([], read_peers)
+            except Exception as e:
+                print(f"Failed to reset unread counters: {e}")
+        if lost:
+            print(f"Lost {len(lost)} messages: "
+                  f"{', '.join(str(row.get('message_id')) for row in lost)}")
+
+# Полнотекстовый индекс messages_fts синхронизируется с messages триггерами
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE messages_fts USING fts5(
+        content, content='messages', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+]
+
+# conversations обновляется триггером в той же транзакции, что и вставка
+# сообщения, поэтому одинаково работает для save_message и пакетной записи.
+# Более старое сообщение (импорт истории) не заменяет превью более нового.
+CONVERSATION_TRIGGER = f"""
+    CREATE TRIGGER IF NOT EXISTS conversations_on_message AFTER INSERT ON messages BEGIN
+        INSERT INTO conversations(peer_id, last_message_id, preview, last_timestamp, unread_count)
+        VALUES (new.peer_id, new.id, substr(new.content, 1, {PREVIEW_LENGTH}), new.timestamp,
+                new.direction = 'received')
+        ON CONFLICT(peer_id) DO UPDATE SET
+            unread_count = unread_count + excluded.unread_count,
+            last_message_id = CASE WHEN last_timestamp IS NULL
+                OR excluded.last_timestamp >= last_timestamp
+                THEN excluded.last_message_id ELSE last_message_id END,
+            preview = CASE WHEN last_timestamp IS NULL
+                OR excluded.last_timestamp >= last_timestamp
+                THEN excluded.preview ELSE preview END,
+            last_timestamp = max(coalesce(last_timestamp, ''), excluded.last_timestamp);
+    END
+"""
+
+# Заполнение conversations по уже существующей истории (без непрочитанных)
+CONVERSATION_BACKFILL = f"""
+    INSERT OR IGNORE INTO conversations(peer_id, last_message_id, preview, last_timestamp,
+                                        unread_count)
+    SELECT p.peer_id, m.id, substr(m.content, 1, {PREVIEW_LENGTH}), m.timestamp, 0
+    FROM peers p LEFT JOIN messages m ON m.id = (
+        SELECT id FROM messages WHERE peer_id = p.peer_id
+        ORDER BY timestamp DESC, id DESC LIMIT 1
+    )
+"""
+
+# Результат поиска: snippet - фрагмент текста с найденными словами в [скобках]
+SearchResult = namedtuple('SearchResult', 'id peer_id timestamp direction snippet rank')
+
+def _fts_query(query: str) -> str:
+    """Пользовательский запрос -> запрос FTS5: все слова, каждое как префикс"""
+    words = re.findall(r'\w+', query)
+    return ' '.join(f'"{word}"*' for word in words)
+
+def message_cursor(message):
+    """Курсор постраничной истории для сообщения: (timestamp, id)"""
+    return (message.timestamp, message.id)
 
 class DatabaseManager:
-    def __init__(self, db_path):
+    """
+    Доступ к базе из нескольких потоков (GUI, прием relay и P2P, конвейер)
+    
+    Каждый поток получает свою сессию (scoped_session) и свое соединение из
+    пула на время одной операции. Записи идут по одной под общим замком, а
+    чтения в режиме WAL выполняются параллельно и не ждут пишущих.
+    
+    Сообщения старше срока хранения переносятся compact() в архив рядом с БД
+    (archive_dir, по умолчанию <каталог БД>/archive); история читает архив,
+    когда сообщения в БД заканчиваются.
+    """
+    def __init__(self, db_path, write_behind: bool = False, archive_dir=None):
         self.db_path = db_path
+        self.archive = MessageArchive(archive_dir or Path(db_path).parent / 'archive')
+        self.retention_days = RETENTION_DAYS
+        self._compaction_lock = threading.Lock()
+        self._compaction_thread = None
+        self._compaction_stop = threading.Event()
         self.engine = create_engine(f'sqlite:///{db_path}')
+        event.listen(self.engine, 'connect', _set_sqlite_pragmas)
+        conversations_exist = inspect(self.engine).has_table(Conversation.__tablename__)
         Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        self._add_missing_columns()
+        # create_all не добавляет индексы к уже существующим таблицам
+        for index in Message.__table__.indexes:
+            index.create(self.engine, checkfirst=True)
+        # Объекты остаются загруженными после commit и закрытия сессии
+        self.Session = scoped_session(sessionmaker(bind=self.engine, expire_on_commit=False))
+        self._write_lock = threading.RLock()
+        self.key_change_callback = None
+        self._enable_incremental_vacuum()
+        self.write_queue = (WriteBehindQueue(self.engine, write_lock=self._write_lock)
+                            if write_behind else None)
+        self.fts_enabled = self._create_fts()
+        with self.engine.begin() as connection:
+            connection.execute(text(CONVERSATION_TRIGGER))
+            if not conversations_exist:
+                connection.execute(text(CONVERSATION_BACKFILL))
+        
+    def _add_missing_columns(self):
+        """Добавление столбцов, появившихся после создания таблицы messages"""
+        with self.engine.begin() as connection:
+            existing = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(messages)")}
+            if 'message_id' not in existing:
+                connection.exec_driver_sql("ALTER TABLE messages ADD COLUMN message_id VARCHAR")
+                
+    def _enable_incremental_vacuum(self):
+        """
+        Однократный перевод старой БД в режим auto_vacuum=INCREMENTAL
+        Полный VACUUM переписывает весь файл, поэтому выполняется только при
+        запуске, до фоновой записи, а не в периодическом compact()
+        """
+        with self.engine.connect() as connection:
+            if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2:
+                return
+            print("Converting database to incremental vacuum, this may take a while")
+            connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            connection.exec_driver_sql("VACUUM")
+            
+    def _create_fts(self) -> bool:
+        """Создание полнотекстового индекса; False если SQLite собран без FTS5"""
+        try:
+            with self.engine.begin() as connection:
+                exists = connection.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'"
+                )).first()
+                if not exists:
+                    connection.execute(text(FTS_SCHEMA[0]))
+                for statement in FTS_SCHEMA[1:]:
+                    connection.execute(text(statement))
+                if not exists:
+                    # Индексируем сообщения, сохраненные до появления индекса
+                    connection.execute(text(
+                        "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"
+                    ))
+            return True
+        except OperationalError as e:
+            print(f"Full-text search unavailable: {e}")
+            return False
+        
+    @contextmanager
+    def _session(self, write: bool = False):
+        """
+        Сессия текущего потока на одну операцию
+        write=True - под замком записи, с commit в конце
+        """
+        with self._write_lock if write else nullcontext():
+            session = self.Session()
+            try:
+                yield session
+                if write:
+                    session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                # Возвращаем соединение в пул, не удерживая снимок чтения
+                self.Session.remove()
+                
+    def _flush_pending(self):
+        """Запись очереди перед изменением, только если в ней что-то есть"""
+        if self.write_queue and self.write_queue.pending_count():
+            self.write_queue.flush()
+            
+    def _request_flush(self):
+        """
+        Чтения не пишут очередь сами и не ждут замка записи: только просят
+        фоновый поток записать ее сейчас. Еще не записанные строки история
+        и get_recent_message_ids добавляют к результату из памяти.
+        """
+        if self.write_queue:
+            self.write_queue.request_flush()
+            
+    def _pending_messages(self, peer_id: str = None):
+        """Еще не записанные сообщения как объекты Message (без id), от старых к новым"""
+        if not self.write_queue:
+            return []
+        return [Message(**row) for row in self.write_queue.pending_rows(peer_id)]
+            
+    def set_key_change_callback(self, callback):
+        """
+        Установка callback, вызываемого при смене ключа пира
+        callback(peer_id, old_public_key)
+        """
+        self.key_change_callback = callback
         
     def add_peer(self, peer_id: str, public_key: str):
-        """Добавление нового пира"""
-        peer = self.session.query(Peer).filter_by(peer_id=peer_id).first()
-        if not peer:
-            peer = Peer(peer_id=peer_id, public_key=public_key)
-            self.session.add(peer)
-            self.session.commit()
+        """Добавление нового пира или обновление его ключа"""
+        old_public_key = None
+        with self._session(write=True) as session:
+            peer = session.query(Peer).filter_by(peer_id=peer_id).first()
+            if not peer:
+                peer = Peer(peer_id=peer_id, public_key=public_key)
+                session.add(peer)
+                # Пустой диалог, чтобы пир сразу был в списке контактов
+                session.merge(Conversation(peer_id=peer_id, unread_count=0))
+            elif peer.public_key != public_key:
+                old_public_key = peer.public_key
+                peer.public_key = public_key
+        # callback вызывается вне замка записи
+        if old_public_key is not None and self.key_change_callback:
+            self.key_change_callback(peer_id, old_public_key)
         return peer
         
     def get_peer(self, peer_id: str):
         """Получение пира по ID"""
-        return self.session.query(Peer).filter_by(peer_id=peer_id).first()
+        with self._session() as session:
+            return session.query(Peer).filter_by(peer_id=peer_id).first()
         
-    def save_message(self, peer_id: str, content: str, direction: str):
-        """Сохранение сообщения"""
+    def save_message(self, peer_id: str, content: str, direction: str, message_id: str = None):
+        """
+        Сохранение сообщения
+        При включенной фоновой записи возвращает None: строка будет записана
+        в ближайшей пачке. Без фоновой записи None означает, что сообщение
+        с таким message_id от этого пира уже сохранено.
+        """
+        if self.write_queue:
+            self.write_queue.put({
+                'peer_id': peer_id,
+                'content': content,
+                'direction': direction,
+                'timestamp': datetime.utcnow(),
+                'message_id': message_id
+            })
+            return None
+            
         message = Message(
             peer_id=peer_id,
             content=content,
-            direction=direction
+            direction=direction,
+            message_id=message_id
         )
-        self.session.add(message)
-        self.session.commit()
+        try:
+            with self._session(write=True) as session:
+                session.add(message)
+        except IntegrityError:
+            return None
         return message
         
-    def get_message_history(self, peer_id: str, limit: int = 50):
-        """Получение истории сообщений с пиром"""
-        return self.session.query(Message)\
-            .filter_by(peer_id=peer_id)\
-            .order_by(Message.timestamp.desc())\
-            .limit(limit)\
-            .all()
+    def get_recent_message_ids(self, since: datetime):
+        """
+        (peer_id, message_id, timestamp) принятых с момента since - для
+        заполнения фильтра дубликатов после запуска; от старых к новым, как
+        их вытесняет фильтр
+        """
+        # Снимок очереди до чтения БД: строка, записанная между ними, попадет
+        # в оба списка, но не пропадет; повторы фильтр дубликатов не смущают
+        pending = [(m.peer_id, m.message_id, m.timestamp) for m in self._pending_messages()
+                   if m.direction == 'received' and m.timestamp >= since
+                   and m.message_id is not None]
+        self._request_flush()
+        messages = Message.__table__
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select(messages.c.peer_id, messages.c.message_id, messages.c.timestamp)
+                .where(messages.c.direction == 'received',
+                       messages.c.timestamp >= since,
+                       messages.c.message_id.isnot(None))
+                .order_by(messages.c.timestamp, messages.c.id)
+            ).all()
+        stored = {(row.peer_id, row.message_id) for row in rows}
+        return list(rows) + [row for row in pending if row[:2] not in stored]
+        
+    def get_message_history(self, peer_id: str, limit: int = 50, before=None, after=None):
+        """
+        Получение страницы истории сообщений с пиром (новые первыми)
+        
+        before=(timestamp, id) - сообщения старше курсора,
+        after=(timestamp, id) - ближайшие сообщения новее курсора.
+        Курсор сравнивается по индексу (peer_id, timestamp), без OFFSET.
+        Первая страница включает еще не записанные сообщения очереди.
+        """
+        pending = self._pending_messages(peer_id) if before is None and after is None else []
+        self._request_flush()
+        with self._session() as session:
+            query = session.query(Message).filter_by(peer_id=peer_id)
+            cursor_key = tuple_(Message.timestamp, Message.id)
+            
+            if after is not None:
+                # Архив старше БД: сначала архив, затем БД по возрастанию
+                page = self._archive_history(session, peer_id, limit, after=after)
+                if len(page) < limit:
+                    start = message_cursor(page[-1]) if page else after
+                    page += query.filter(cursor_key > tuple_(*start))\
+                        .order_by(Message.timestamp.asc(), Message.id.asc())\
+                        .limit(limit - len(page))\
+                        .all()
+                page.reverse()
+                return page
+                
+            if before is not None:
+                query = query.filter(cursor_key < tuple_(*before))
+            page = query.order_by(Message.timestamp.desc(), Message.id.desc())\
+                .limit(limit)\
+                .all()
+            # Архив продолжает историю от последней строки БД: у незаписанных
+            # строк очереди нет id для курсора
+            start = message_cursor(page[-1]) if page else before
+            if pending:
+                page = self._merge_pending(page, pending, limit)
+            if len(page) < limit:
+                # Сообщения в БД закончились - продолжаем из архива
+                page += self._archive_history(session, peer_id, limit - len(page), before=start)
+            return page
+            
+    @staticmethod
+    def _merge_pending(page, pending, limit: int):
+        """
+        Первая страница истории вместе с очередью записи (новые первыми)
+        Строка, записанная уже после снимка очереди, берется из БД.
+        """
+        def row_key(message):
+            return (message.timestamp, message.direction, message.content, message.message_id)
+        stored = {row_key(message) for message in page}
+        page = page + [message for message in pending if row_key(message) not in stored]
+        # У незаписанных строк еще нет id: при равном времени они новее
+        page.sort(key=lambda message: (message.timestamp, message.id or float('inf')),
+                  reverse=True)
+        return page[:limit]
+        
+    def _archive_history(self, session, peer_id: str, limit: int, before=None, after=None):
+        """
+        Страница истории из архива: before - новые первыми, after - старые первыми
+        """
+        query = session.query(ArchiveBlock).filter_by(peer_id=peer_id)
+        if after is not None:
+            query = query.filter(ArchiveBlock.last_timestamp >= after[0])\
+                .order_by(ArchiveBlock.first_timestamp.asc(), ArchiveBlock.id.asc())
+        else:
+            if before is not None:
+                query = query.filter(ArchiveBlock.first_timestamp <= before[0])
+            query = query.order_by(ArchiveBlock.first_timestamp.desc(), ArchiveBlock.id.desc())
+            
+        page = []
+        for block in query.yield_per(16):
+            messages = self.archive.read_block(block.segment, block.offset, block.length)
+            if after is not None:
+                page += [m for m in messages if message_cursor(m) > tuple(after)]
+            else:
+                messages.reverse()
+                if before is not None:
+                    messages = [m for m in messages if message_cursor(m) < tuple(before)]
+                page += messages
+            if len(page) >= limit:
+                break
+        return page[:limit]
+            
+    def search_messages(self, query: str, peer_id: str = None, since: datetime = None,
+                        until: datetime = None, limit: int = 50):
+        """
+        Полнотекстовый поиск по истории (лучшие совпадения первыми)
+        Возвращает список SearchResult; сообщения из очереди записи
+        находятся после ее записи (не позже flush_interval)
+        """
+        self._request_flush()
+        fts_query = _fts_query(query)
+        if not fts_query:
+            return []
+            
+        filters = []
+        params = {'limit': limit}
+        if peer_id:
+            filters.append("m.peer_id = :peer_id")
+            params['peer_id'] = peer_id
+        if since:
+            filters.append("m.timestamp >= :since")
+            params['since'] = since
+        if until:
+            filters.append("m.timestamp < :until")
+            params['until'] = until
+        where = ''.join(f" AND {condition}" for condition in filters)
+        
+        if self.fts_enabled:
+            params['query'] = fts_query
+            sql = f"""
+                SELECT m.id, m.peer_id, m.timestamp, m.direction,
+                       snippet(messages_fts, 0, '[', ']', '...', 12) AS snippet,
+                       bm25(messages_fts) AS rank
+                FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                WHERE messages_fts MATCH :query{where}
+                ORDER BY rank
+                LIMIT :limit
+            """
+        else:
+            # Без FTS5: медленный просмотр всей таблицы
+            params['query'] = f"%{query}%"
+            sql = f"""
+                SELECT m.id, m.peer_id, m.timestamp, m.direction,
+                       substr(m.content, 1, 80) AS snippet, 0 AS rank
+                FROM messages m
+                WHERE m.content LIKE :query{where}
+                ORDER BY m.timestamp DESC
+                LIMIT :limit
+            """
+            
+        statement = text(sql).columns(timestamp=DateTime())
+        for name in ('since', 'until'):
+            if name in params:
+                statement = statement.bindparams(bindparam(name, type_=DateTime()))
+        with self.engine.connect() as connection:
+            rows = connection.execute(statement, params).fetchall()
+        return [SearchResult(*row) for row in rows]
+        
+    def get_conversations(self):
+        """
+        Список диалогов для контактов: последние по времени первыми,
+        пиры без сообщений - в конце
+        Превью и счетчики учитывают очередь записи после ее записи
+        """
+        self._request_flush()
+        with self._session() as session:
+            return session.query(Conversation)\
+                .order_by(Conversation.last_timestamp.desc())\
+                .all()
+                
+    def mark_read(self, peer_id: str):
+        """Сброс счетчика непрочитанных сообщений диалога"""
+        with self._session(write=True) as session:
+            session.query(Conversation)\
+                .filter(Conversation.peer_id == peer_id, Conversation.unread_count > 0)\
+                .update({Conversation.unread_count: 0}, synchronize_session=False)
+            # Сообщения пира из очереди сбросят счетчик при своей записи
+            if self.write_queue:
+                self.write_queue.mark_read(peer_id)
+                
+    def iter_messages(self, batch_size: int = 5000):
+        """
+        Все сообщения, включая архив, для резервной копии (постоянная память)
+        Сначала архив по блокам, затем БД пачками по id, затем еще не
+        записанные сообщения очереди
+        """
+        def row_key(message):
+            return (message.peer_id, message.timestamp, message.direction,
+                    message.content, message.message_id)
+        # Снимок очереди до чтения БД; записанные за время копии строки
+        # встретятся в БД и второй раз не выводятся
+        pending = {row_key(message): message for message in self._pending_messages()}
+        self._request_flush()
+        last_block_id = 0
+        while True:
+            with self._session() as session:
+                blocks = session.query(ArchiveBlock)\
+                    .filter(ArchiveBlock.id > last_block_id)\
+                    .order_by(ArchiveBlock.id.asc())\
+                    .limit(64)\
+                    .all()
+            if not blocks:
+                break
+            for block in blocks:
+                yield from self.archive.read_block(block.segment, block.offset, block.length)
+            last_block_id = blocks[-1].id
             
+        # Строки Core вместо ORM объектов: в несколько раз быстрее на больших историях
+        messages = Message.__table__
+        last_id = 0
+        while True:
+            with self.engine.connect() as connection:
+                batch = connection.execute(
+                    select(messages)
+                    .where(messages.c.id > last_id)
+                    .order_by(messages.c.id.asc())
+                    .limit(batch_size)
+                ).all()
+            if not batch:
+                break
+            yield from batch
+            if pending:
+                for message in batch:
+                    pending.pop(row_key(message), None)
+            last_id = batch[-1].id
+        yield from pending.values()
+            
+    def import_peers(self, peers) -> int:
+        """
+        Добавление пиров из резервной копии (peer_id, public_key, created_at)
+        Ключи уже известных пиров не меняются; возвращает число добавленных
+        """
+        with self._write_lock, self.engine.begin() as connection:
+            result = connection.execute(
+                insert(Peer.__table__).prefix_with('OR IGNORE'), list(peers)
+            )
+            connection.execute(text(CONVERSATION_BACKFILL))
+        return result.rowcount
+        
+    def import_messages(self, rows) -> int:
+        """
+        Пакетная вставка сообщений одной транзакцией (импорт истории)
+        Импортированные сообщения не считаются непрочитанными, уже
+        сохраненные (тот же message_id) пропускаются; возвращает число вставленных
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+        peer_ids = list({row['peer_id'] for row in rows})
+        with self._write_lock, self.engine.begin() as connection:
+            unread_before = dict(connection.execute(
+                select(Conversation.peer_id, Conversation.unread_count)
+                .where(Conversation.peer_id.in_(peer_ids))
+            ).all())
+            rows = self._skip_imported_without_id(connection, rows)
+            inserted = connection.execute(
+                insert(Message.__table__).prefix_with('OR IGNORE'), rows
+            ).rowcount if rows else 0
+            connection.execute(
+                update(Conversation.__table__)
+                .where(Conversation.peer_id == bindparam('target_peer_id'))
+                .values(unread_count=bindparam('unread_count')),
+                [{'target_peer_id': peer_id, 'unread_count': unread_before.get(peer_id, 0)}
+                 for peer_id in peer_ids]
+            )
+        return inserted
+        
+    def _skip_imported_without_id(self, connection, rows):
+        """
+        Отсев сообщений без message_id, которые уже есть в БД или в пачке
+
+        Уникальный индекс не сравнивает NULL, поэтому повтор старого сообщения
+        узнается по пиру, времени, направлению и тексту.
+        """
+        unidentified = {(row['peer_id'], row['timestamp'])
+                        for row in rows if row.get('message_id') is None}
+        if not unidentified:
+            return rows
+        messages = Message.__table__
+        keys = list(unidentified)
+        existing = set()
+        for start in range(0, len(keys), IMPORT_LOOKUP_BATCH):
+            existing.update(connection.execute(
+                select(messages.c.peer_id, messages.c.timestamp,
+                       messages.c.direction, messages.c.content)
+                .where(messages.c.message_id.is_(None),
+                       tuple_(messages.c.peer_id, messages.c.timestamp)
+                       .in_(keys[start:start + IMPORT_LOOKUP_BATCH]))
+            ).all())
+        
+        new_rows = []
+        for row in rows:
+            if row.get('message_id') is None:
+                key = (row['peer_id'], row['timestamp'], row['direction'], row['content'])
+                if key in existing:
+                    continue
+                existing.add(key)
+            new_rows.append(row)
+        return new_rows
+        
+    def set_retention_policy(self, peer_id: str, days):
+        """
+        Срок хранения истории пира в днях: 0 - хранить всегда,
+        None - общий срок retention_days
+        """
+        with self._session(write=True) as session:
+            if days is None:
+                session.query(RetentionPolicy).filter_by(peer_id=peer_id).delete()
+            else:
+                session.merge(RetentionPolicy(peer_id=peer_id, days=days))
+                
+    def get_retention_policies(self) -> dict:
+        """Сроки хранения, заданные для отдельных пиров: peer_id -> дни"""
+        with self._session() as session:
+            return dict(session.query(RetentionPolicy.peer_id, RetentionPolicy.days).all())
+            
+    def compact(self, batch_size: int = COMPACTION_BATCH_SIZE,
+                vacuum_pages: int = VACUUM_PAGES) -> int:
+        """
+        Перенос сообщений старше срока хранения в архив и освобождение места
+        
+        Каждая пачка - отдельная транзакция, поэтому запись новых сообщений
+        ждет не дольше одной пачки. Возвращает число архивированных сообщений.
+        """
+        with self._compaction_lock:
+            self._flush_pending()
+            policies = self.get_retention_policies()
+            with self._session() as session:
+                peer_ids = [row[0] for row in session.query(Conversation.peer_id).all()]
+                
+            archived = 0
+            now = datetime.utcnow()
+            for peer_id in peer_ids:
+                days = policies.get(peer_id, self.retention_days)
+                if not days:
+                    continue
+                cutoff = now - timedelta(days=days)
+                while not self._compaction_stop.is_set():
+                    count = self._archive_batch(peer_id, cutoff, batch_size)
+                    archived += count
+                    if count < batch_size:
+                        break
+                        
+            if archived:
+                self._vacuum(vacuum_pages)
+            return archived
+            
+    def _archive_batch(self, peer_id: str, cutoff: datetime, batch_size: int) -> int:
+        with self._session() as session:
+            batch = session.query(Message)\
+                .filter(Message.peer_id == peer_id, Message.timestamp < cutoff)\
+                .order_by(Message.timestamp.asc(), Message.id.asc())\
+                .limit(batch_size)\
+                .all()
+        if not batch:
+            return 0
+            
+        # Блок записан на диск до удаления: при сбое остается лишний блок, а не потеря
+        segment, offset, length = self.archive.append(batch)
+        with self._session(write=True) as session:
+            session.add(ArchiveBlock(
+                peer_id=peer_id, segment=segment, offset=offset, length=length,
+                count=len(batch), first_timestamp=batch[0].timestamp,
+                last_timestamp=batch[-1].timestamp
+            ))
+            session.query(Message)\
+                .filter(Message.id.in_([message.id for message in batch]))\
+                .delete(synchronize_session=False)
+        return len(batch)
+        
+    def _vacuum(self, pages: int):
+        """
+        Возврат свободных страниц файлу БД порциями по pages страниц;
+        между порциями замок записи отпускается
+        """
+        while not self._compaction_stop.is_set():
+            with self._write_lock, self.engine.connect() as connection:
+                # Старая БД без INCREMENTAL переводится только при запуске
+                if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+                    break
+                if not connection.exec_driver_sql("PRAGMA freelist_count").scalar():
+                    break
+                # execute() модуля sqlite3 делает один шаг прагмы (одну
+                # страницу), executescript выполняет ее до конца
+                connection.connection.driver_connection.executescript(
+                    f"PRAGMA incremental_vacuum({int(pages)});"
+                )
+        with self._write_lock, self.engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+                
+    def start_compaction(self, interval: float = COMPACTION_INTERVAL):
+        """Запуск фоновой архивации раз в interval секунд"""
+        if self._compaction_thread:
+            return
+        self._compaction_stop.clear()
+        self._compaction_thread = threading.Thread(
+            target=self._compaction_loop, args=(interval,), name="db-compaction"
+        )
+        self._compaction_thread.daemon = True
+        self._compaction_thread.start()
+        
+    def _compaction_loop(self, interval: float):
+        while not self._compaction_stop.wait(interval):
+            try:
+                archived = self.compact()
+                if archived:
+                    print(f"Archived {archived} old messages")
+            except Exception as e:
+                print(f"History compaction failed: {e}")
+                
     def get_all_peers(self):
         """Получение всех пиров"""
-        return self.session.query(Peer).all()
\ No newline at end of file
+        with self._session() as session:
+            return session.query(Peer).all()
+        
+    def flush(self):
+        """Запись сообщений, ожидающих в очереди фоновой записи"""
+        if self.write_queue:
+            self.write_queue.flush()
+            
+    def close(self):
+        """Запись очереди и закрытие соединений"""
+        if self._compaction_thread:
+            self._compaction_stop.set()
+            self._compaction_thread.join()
+            self._compaction_thread = None
+        if self.write_queue:
+            self.write_queue.close()
+            self.write_queue = None
+        self.Session.remove()
+        self.engine.dispose()
+        self.archive.close()
@@ -0,0 +1,24 @@
+"""
+Общие фикстуры тестов
+"""
+import pytest
+
+
+class FakeClock:
+    """
+    Подмена модуля time для кода, который читает только time.monotonic()
+    """
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,99 @@
+"""
+Разбор бинарного конверта: границы полей и обрезанные буферы
+"""
+import os
+
+import pytest
+
+from crypto.envelope import (
+    ENVELOPE_HEADER, KEY_LENGTH, KIND_HYBRID, KIND_SESSION, MAGIC, VERSION, EnvelopeError,
+    decode_envelope, decode_stream_header, encode_envelope, encode_stream_header,
+    envelope_from_dict, envelope_to_dict,
+)
+
+SESSION_FIELDS = {
+    'session_id': os.urandom(16),
+    'encrypted_key': os.urandom(256),
+    'nonce': os.urandom(12),
+    'encrypted_message': b'ciphertext',
+}
+HYBRID_FIELDS = {
+    'encrypted_key': os.urandom(256),
+    'iv': os.urandom(16),
+    'encrypted_message': b'ciphertext',
+}
+
+
+@pytest.mark.parametrize('kind, fields', [
+    (KIND_SESSION, SESSION_FIELDS),
+    (KIND_HYBRID, HYBRID_FIELDS),
+])
+def test_round_trip(kind, fields):
+    data = encode_envelope(kind, fields)
+    decoded_kind, decoded = decode_envelope(data)
+    assert decoded_kind == kind
+    assert {name: bytes(value) for name, value in decoded.items()} == fields
+    assert envelope_from_dict(envelope_to_dict(data)) == data
+
+
+def test_fields_are_views_of_buffer():
+    data = encode_envelope(KIND_SESSION, SESSION_FIELDS)
+    _, fields = decode_envelope(data)
+    assert all(isinstance(value, memoryview) for value in fields.values())
+    assert fields['encrypted_message'].obj is data
+
+
+def test_empty_message_is_allowed():
+    data = encode_envelope(KIND_HYBRID, dict(HYBRID_FIELDS, encrypted_message=b''))
+    _, fields = decode_envelope(data)
+    assert bytes(fields['encrypted_message']) == b''
+
+
+@pytest.mark.parametrize('kind, fields', [
+    (KIND_SESSION, SESSION_FIELDS),
+    (KIND_HYBRID, HYBRID_FIELDS),
+])
+def test_every_truncation_before_message_is_rejected(kind, fields):
+    data = encode_envelope(kind, fields)
+    message_start = len(data) - len(fields['encrypted_message'])
+    for length in range(message_start):
+        with pytest.raises(EnvelopeError):
+            decode_envelope(data[:length])
+
+
+def test_key_length_beyond_buffer():
+    header = ENVELOPE_HEADER.pack(MAGIC, VERSION, KIND_HYBRID)
+    data = header + KEY_LENGTH.pack(0xFFFF) + os.urandom(300)
+    with pytest.raises(EnvelopeError, match='truncated'):
+        decode_envelope(data)
+
+
+@pytest.mark.parametrize('data, message', [
+    (b'XX' + bytes([VERSION, KIND_HYBRID]) + bytes(20), 'magic'),
+    (MAGIC + bytes([VERSION + 1, KIND_HYBRID]) + bytes(20), 'version'),
+    (MAGIC + bytes([VERSION, 99]) + bytes(20), 'kind'),
+])
+def test_bad_header(data, message):
+    with pytest.raises(EnvelopeError, match=message):
+        decode_envelope(data)
+
+
+def test_unknown_kind_is_not_encoded():
+    with pytest.raises(EnvelopeError):
+        encode_envelope(99, HYBRID_FIELDS)
+
+
+def test_stream_header_round_trip():
+    encrypted_key = os.urandom(256)
+    header = encode_stream_header(encrypted_key, b'7 bytes', 65536)
+    key, nonce_prefix, chunk_size = decode_stream_header(header)
+    assert (bytes(key), bytes(nonce_prefix), chunk_size) == (encrypted_key, b'7 bytes', 65536)
+
+
+def test_stream_header_bounds():
+    header = encode_stream_header(os.urandom(256), b'7 bytes', 65536)
+    for length in range(len(header)):
+        with pytest.raises(EnvelopeError):
+            decode_stream_header(header[:length])
+    with pytest.raises(EnvelopeError, match='trailing'):
+        decode_stream_header(header + b'\0')
@@ -0,0 +1,105 @@
+"""
+Сборка сообщений из фрагментов: сброс незаконченных и продолжение после сброса
+"""
+import pytest
+
+from network import fragmentation
+from network.fragmentation import MESSAGE_LOST, Reassembler, fragment
+
+SENDER = ('192.0.2.1', 4000)
+
+
+def feed_message(reassembler, key, chunks):
+    """Все фрагменты сообщения по порядку; результат последнего feed"""
+    result = None
+    for index, chunk in enumerate(chunks):
+        result = reassembler.feed(key, chunk, more=index < len(chunks) - 1, first=index == 0)
+    return result
+
+
+def test_fragment_sizes():
+    payload = bytes(range(256)) * 10
+    chunks = fragment(payload, 1000)
+    assert [len(chunk) for chunk in chunks] == [1000, 1000, 560]
+    assert b''.join(chunks) == payload
+    assert fragment(b'', 1000) == [b'']
+
+
+def test_single_datagram_is_returned_as_is():
+    reassembler = Reassembler()
+    chunk = b'whole message'
+    assert reassembler.feed(SENDER, chunk, more=False) is chunk
+    assert len(reassembler) == 0
+
+
+def test_reassembly():
+    reassembler = Reassembler()
+    payload = b'x' * 2500
+    assert feed_message(reassembler, SENDER, fragment(payload, 1000)) == payload
+    assert len(reassembler) == 0
+    assert reassembler.memory_used == 0
+
+
+def test_senders_are_independent():
+    reassembler = Reassembler()
+    other = ('192.0.2.2', 4000)
+    assert reassembler.feed(SENDER, b'a1', more=True) is None
+    assert reassembler.feed(other, b'b1', more=True) is None
+    assert reassembler.feed(SENDER, b'a2', more=False, first=False) == b'a1a2'
+    assert reassembler.feed(other, b'b2', more=False, first=False) == b'b1b2'
+
+
+def test_oversized_message_is_discarded_and_tail_reported_lost():
+    reassembler = Reassembler(max_message_size=1500)
+    assert reassembler.feed(SENDER, b'x' * 1000, more=True) is None
+    assert reassembler.feed(SENDER, b'x' * 1000, more=True, first=False) is None
+    assert reassembler.dropped == 1
+    assert len(reassembler) == 0
+    # Оставшиеся фрагменты сброшенного сообщения не собираются в обрезок
+    assert reassembler.feed(SENDER, b'x' * 1000, more=True, first=False) is None
+    assert reassembler.feed(SENDER, b'end', more=False, first=False) is MESSAGE_LOST
+    assert reassembler.orphaned == 2
+
+
+def test_next_message_after_discard_is_delivered():
+    reassembler = Reassembler(max_message_size=1500)
+    feed_message(reassembler, SENDER, [b'x' * 1000] * 3)
+    assert feed_message(reassembler, SENDER, [b'ok', b'!']) == b'ok!'
+
+
+def test_first_fragment_restarts_unfinished_message():
+    reassembler = Reassembler()
+    assert reassembler.feed(SENDER, b'stale', more=True) is None
+    assert reassembler.feed(SENDER, b'fresh', more=True) is None
+    assert reassembler.dropped == 1
+    assert reassembler.feed(SENDER, b'-end', more=False, first=False) == b'fresh-end'
+
+
+def test_memory_limit_drops_oldest():
+    reassembler = Reassembler(memory_limit=2500)
+    first, second = ('192.0.2.1', 1), ('192.0.2.2', 2)
+    reassembler.feed(first, b'x' * 1000, more=True)
+    reassembler.feed(second, b'y' * 1000, more=True)
+    reassembler.feed(second, b'y' * 1000, more=True, first=False)
+    assert len(reassembler) == 1
+    assert reassembler.memory_used == 2000
+    assert reassembler.feed(first, b'tail', more=False, first=False) is MESSAGE_LOST
+    assert reassembler.feed(second, b'tail', more=False, first=False) == b'y' * 2000 + b'tail'
+
+
+def test_expire(monkeypatch, clock):
+    monkeypatch.setattr(fragmentation, 'time', clock)
+    reassembler = Reassembler(timeout=30.0)
+    reassembler.feed(SENDER, b'part', more=True)
+    assert reassembler.next_expiry() == clock.now + 30.0
+    clock.advance(29.0)
+    assert reassembler.expire() == 0
+    clock.advance(2.0)
+    assert reassembler.expire() == 1
+    assert reassembler.next_expiry() is None
+    assert reassembler.feed(SENDER, b'tail', more=False, first=False) is MESSAGE_LOST
+
+
+def test_too_large_message_is_not_fragmented():
+    with pytest.raises(ValueError):
+        fragment(b'x' * (fragmentation.MAX_MESSAGE_SIZE + 1), 1200)
@@ -0,0 +1,103 @@
+"""
+Определение типа NAT по RFC 5780 против FakeSTUNServer
+"""
+import itertools
+
+import pytest
+
+from network.fake_stun_server import DEFAULT_PUBLIC_IP, FakeSTUNServer
+from network.stun_client import (
+    ADDRESS_AND_PORT_DEPENDENT, ADDRESS_DEPENDENT, ENDPOINT_DEPENDENT, ENDPOINT_INDEPENDENT,
+    NAT_BLOCKED, NAT_CONE, NAT_FULL_CONE, NAT_OPEN, NAT_PORT_RESTRICTED_CONE, NAT_RESTRICTED_CONE,
+    NAT_SYMMETRIC, NAT_UNKNOWN, STUNClient, punching_possible,
+)
+
+# Ответ, который NAT не пропускает, ждется весь timeout
+TIMEOUT = 0.3
+
+BEHAVIORS = [ENDPOINT_INDEPENDENT, ADDRESS_DEPENDENT, ADDRESS_AND_PORT_DEPENDENT]
+
+EXPECTED_TYPES = {
+    (ENDPOINT_INDEPENDENT, ENDPOINT_INDEPENDENT): NAT_FULL_CONE,
+    (ENDPOINT_INDEPENDENT, ADDRESS_DEPENDENT): NAT_RESTRICTED_CONE,
+    (ENDPOINT_INDEPENDENT, ADDRESS_AND_PORT_DEPENDENT): NAT_PORT_RESTRICTED_CONE,
+}
+
+
+@pytest.fixture
+def stun_server():
+    """Фабрика запущенных серверов; все останавливаются после теста"""
+    servers = []
+
+    def start(**kwargs):
+        server = FakeSTUNServer(**kwargs)
+        try:
+            server.start()
+        except OSError as e:
+            server.stop()
+            pytest.skip(f"Cannot bind fake STUN server: {e}")
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def classify(servers):
+    return STUNClient(servers, cache_path=None).get_nat_behavior(timeout=TIMEOUT)
+
+
+@pytest.mark.parametrize('mapping, filtering', list(itertools.product(BEHAVIORS, BEHAVIORS)))
+def test_mapping_and_filtering_matrix(stun_server, mapping, filtering):
+    server = stun_server(mapping=mapping, filtering=filtering)
+    behavior = classify(server.servers)
+    assert (behavior.mapping, behavior.filtering) == (mapping, filtering)
+    assert behavior.nat_type == EXPECTED_TYPES.get((mapping, filtering), NAT_SYMMETRIC)
+    assert behavior.mapped_address[0] == server.public_ip
+
+
+def test_no_nat(stun_server):
+    server = stun_server(public_ip=None)
+    behavior = classify(server.servers)
+    assert behavior.nat_type == NAT_OPEN
+    assert behavior.mapped_address[0] == server.host
+
+
+@pytest.mark.parametrize('second_public_ip, mapping, nat_type', [
+    (DEFAULT_PUBLIC_IP, ENDPOINT_INDEPENDENT, NAT_CONE),
+    ('198.51.100.2', ENDPOINT_DEPENDENT, NAT_SYMMETRIC),
+])
+def test_legacy_servers_compare_mappings(stun_server, second_public_ip, mapping, nat_type):
+    """
+    Без RFC 5780 отображение сравнивается по ответам серверов с разными IP;
+    каждый сервер имитирует свой NAT, и оба выдают первый внешний порт
+    одинаковым, так что отображения различает только внешний IP
+    """
+    first = stun_server(rfc5780=False)
+    second = stun_server(host='127.0.0.3', alt_host='127.0.0.4', rfc5780=False,
+                         public_ip=second_public_ip)
+    behavior = classify(first.servers + second.servers)
+    assert behavior.mapping == mapping
+    assert behavior.nat_type == nat_type
+
+
+def test_silent_servers_are_not_blocked():
+    # Порт 9 (discard) не отвечает: тип неизвестен, но не "blocked"
+    behavior = classify(['127.0.0.1:9'])
+    assert behavior.nat_type == NAT_UNKNOWN
+    assert behavior.mapped_address is None
+
+
+@pytest.mark.parametrize('local, peer, possible', [
+    (NAT_FULL_CONE, NAT_PORT_RESTRICTED_CONE, True),
+    (NAT_SYMMETRIC, NAT_FULL_CONE, True),
+    (NAT_SYMMETRIC, NAT_RESTRICTED_CONE, True),
+    (NAT_SYMMETRIC, NAT_PORT_RESTRICTED_CONE, False),
+    (NAT_PORT_RESTRICTED_CONE, NAT_SYMMETRIC, False),
+    (NAT_SYMMETRIC, None, False),
+    (NAT_FULL_CONE, None, True),
+    (NAT_BLOCKED, NAT_OPEN, False),
+])
+def test_punching_possible(local, peer, possible):
+    assert punching_possible(local, peer) == possible
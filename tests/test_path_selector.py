@@ -0,0 +1,111 @@
+"""
+Выбор пути доставки: гистерезис, отказ пути и забывание пиров
+"""
+import pytest
+
+from network import path_selector
+from network.path_selector import (
+    MAX_CONSECUTIVE_FAILURES, MIN_SWITCH_GAIN, PATH_P2P, PATH_RELAY, PathSelector,
+)
+
+PEER = 'bob'
+BOTH = [PATH_P2P, PATH_RELAY]
+
+
+@pytest.fixture
+def selector(monkeypatch, clock):
+    monkeypatch.setattr(path_selector, 'time', clock)
+    return PathSelector(hysteresis=0.2, probe_timeout=2.0)
+
+
+def measure(selector, clock, path, rtt, times=1):
+    """Проба пути с ответом через rtt секунд"""
+    for _ in range(times):
+        probe_id = selector.start_probe(PEER, path)
+        clock.advance(rtt)
+        assert selector.complete_probe(probe_id, PEER, path) == pytest.approx(rtt)
+
+
+def test_unmeasured_paths_prefer_direct(selector):
+    assert selector.select(PEER, BOTH) == PATH_P2P
+    assert selector.select(PEER, [PATH_RELAY]) == PATH_RELAY
+    assert selector.select(PEER, []) is None
+
+
+def test_measured_faster_path_wins(selector, clock):
+    measure(selector, clock, PATH_P2P, 0.200)
+    measure(selector, clock, PATH_RELAY, 0.050)
+    assert selector.select(PEER, BOTH) == PATH_RELAY
+
+
+def test_small_gain_does_not_switch_route(selector, clock):
+    measure(selector, clock, PATH_P2P, 0.100)
+    measure(selector, clock, PATH_RELAY, 0.120)
+    assert selector.select(PEER, BOTH) == PATH_P2P
+    # Relay стал лучше примерно на 10% - меньше гистерезиса 20%
+    measure(selector, clock, PATH_RELAY, 0.090, times=40)
+    relay = selector.get_route(PEER)['paths'][PATH_RELAY]['score']
+    assert 0.090 < relay < 0.095
+    assert selector.select(PEER, BOTH) == PATH_P2P
+    assert selector.switches == 0
+
+
+def test_large_gain_switches_route_once(selector, clock):
+    measure(selector, clock, PATH_P2P, 0.100)
+    measure(selector, clock, PATH_RELAY, 0.120)
+    assert selector.select(PEER, BOTH) == PATH_P2P
+    measure(selector, clock, PATH_RELAY, 0.050, times=30)
+    assert selector.select(PEER, BOTH) == PATH_RELAY
+    assert selector.select(PEER, BOTH) == PATH_RELAY
+    assert selector.switches == 1
+
+
+def test_min_switch_gain_on_fast_paths(selector, clock):
+    # 20% от 10 мс меньше MIN_SWITCH_GAIN: выигрыш 4 мс маршрут не меняет
+    measure(selector, clock, PATH_P2P, 0.010)
+    assert selector.select(PEER, BOTH) == PATH_P2P
+    measure(selector, clock, PATH_RELAY, 0.010 - MIN_SWITCH_GAIN * 0.8)
+    assert selector.select(PEER, BOTH) == PATH_P2P
+
+
+def test_failed_path_is_left_without_hysteresis(selector, clock):
+    measure(selector, clock, PATH_P2P, 0.010)
+    measure(selector, clock, PATH_RELAY, 0.200)
+    assert selector.select(PEER, BOTH) == PATH_P2P
+    for _ in range(MAX_CONSECUTIVE_FAILURES):
+        selector.record_loss(PEER, PATH_P2P)
+    assert selector.select(PEER, BOTH) == PATH_RELAY
+    # Успешная доставка снимает отказ, но RTT не меняет
+    selector.record_success(PEER, PATH_P2P)
+    stats = selector.get_route(PEER)['paths'][PATH_P2P]
+    assert not stats['failed']
+    assert stats['rtt'] == pytest.approx(0.010)
+
+
+def test_unanswered_probes_count_as_losses(selector, clock):
+    for _ in range(MAX_CONSECUTIVE_FAILURES):
+        selector.start_probe(PEER, PATH_P2P)
+    clock.advance(1.0)
+    assert selector.expire_probes() == 0
+    clock.advance(1.5)
+    assert selector.expire_probes() == MAX_CONSECUTIVE_FAILURES
+    assert selector.get_route(PEER)['paths'][PATH_P2P]['failed']
+
+
+def test_late_or_foreign_probe_answer_is_ignored(selector, clock):
+    probe_id = selector.start_probe(PEER, PATH_P2P)
+    assert selector.complete_probe(probe_id, 'mallory', PATH_P2P) is None
+    assert selector.complete_probe(probe_id, PEER, PATH_RELAY) is None
+    clock.advance(3.0)
+    selector.expire_probes()
+    assert selector.complete_probe(probe_id, PEER, PATH_P2P) is None
+
+
+def test_forget_inactive(selector, clock):
+    selector.select('alice', BOTH)
+    clock.advance(50)
+    selector.select(PEER, BOTH)
+    clock.advance(50)
+    assert selector.forget_inactive(ttl=60) == 1
+    assert selector.get_route('alice')['path'] is None
+    assert selector.get_route(PEER)['path'] == PATH_P2P
@@ -0,0 +1,117 @@
+"""
+Таблица пиров: время жизни, вытеснение давних записей и закрепление
+"""
+import pytest
+
+from network import peer_table
+from network.peer_table import EVICT_EXPIRED, EVICT_OVERFLOW, PeerRegistry
+
+
+@pytest.fixture
+def evicted():
+    return []
+
+
+@pytest.fixture
+def registry(monkeypatch, clock, evicted):
+    monkeypatch.setattr(peer_table, 'time', clock)
+    return PeerRegistry(max_size=3, ttl=60.0,
+                        on_evict=lambda entry, reason: evicted.append((entry.peer_id, reason)))
+
+
+def address(number: int):
+    return ('192.0.2.1', 5000 + number)
+
+
+def test_entry_expires_after_ttl(registry, clock, evicted):
+    registry.add('alice', address(1))
+    clock.advance(59)
+    assert 'alice' in registry
+    clock.advance(2)
+    assert registry.get('alice') is None
+    assert registry.expire() == 1
+    assert evicted == [('alice', EVICT_EXPIRED)]
+    assert registry.peer_for_address(address(1)) is None
+
+
+def test_touch_extends_ttl(registry, clock):
+    registry.add('alice', address(1))
+    clock.advance(50)
+    assert registry.touch('alice')
+    clock.advance(50)
+    assert 'alice' in registry
+    assert not registry.touch('bob')
+
+
+def test_touch_address(registry, clock):
+    registry.add('alice', address(1))
+    clock.advance(50)
+    assert registry.touch_address(address(1)) == 'alice'
+    clock.advance(50)
+    assert 'alice' in registry
+    assert registry.touch_address(address(2)) is None
+
+
+def test_touch_address_does_not_revive_expired_entry(registry, clock):
+    registry.add('alice', address(1))
+    clock.advance(61)
+    assert registry.touch_address(address(1)) is None
+    assert registry.get('alice') is None
+
+
+def test_add_expires_stale_entries(registry, clock, evicted):
+    registry.add('alice', address(1))
+    clock.advance(61)
+    registry.add('bob', address(2))
+    assert evicted == [('alice', EVICT_EXPIRED)]
+    assert len(registry) == 1
+
+
+def test_overflow_evicts_least_recently_used(registry, clock, evicted):
+    for number, peer_id in enumerate(('alice', 'bob', 'carol')):
+        registry.add(peer_id, address(number))
+        clock.advance(1)
+    registry.touch('alice')
+    registry.add('dave', address(3))
+    assert evicted == [('bob', EVICT_OVERFLOW)]
+    assert [peer_id for peer_id, _ in registry.items()] == ['carol', 'alice', 'dave']
+
+
+def test_pinned_entries_outlive_flood(registry, evicted):
+    registry.add('alice', address(0), pinned=True)
+    for number in range(1, 100):
+        registry.add(f"spoofed-{number}", address(number))
+    assert len(registry) == 3
+    assert 'alice' in registry
+    assert ('alice', EVICT_OVERFLOW) not in evicted
+    # Обновление без pinned не снимает закрепление
+    registry.add('alice', address(0))
+    assert registry.get('alice').pinned
+
+
+def test_pinned_entries_still_expire(registry, clock):
+    registry.add('alice', address(0), pinned=True)
+    clock.advance(61)
+    assert registry.expire() == 1
+
+
+def test_address_moves_to_new_peer(registry):
+    registry.add('alice', address(1))
+    registry.add('bob', address(1))
+    assert registry.peer_for_address(address(1)) == 'bob'
+    assert registry.get('alice') is None
+    assert registry.stats['removed'] == 1
+
+
+def test_peer_changes_address(registry):
+    registry.add('alice', address(1))
+    registry.add('alice', address(2))
+    assert registry.peer_for_address(address(1)) is None
+    assert registry.peer_for_address(address(2)) == 'alice'
+
+
+def test_remove_does_not_notify(registry, evicted):
+    registry.add('alice', address(1))
+    assert registry.remove('alice').peer_id == 'alice'
+    assert registry.remove('alice') is None
+    assert evicted == []
@@ -0,0 +1,119 @@
+"""
+Сеансовые ключи: кэш входящих сеансов, отсев повторов и подмена ключа
+"""
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from crypto import encryption
+from crypto.encryption import OAEP_PADDING, CryptoManager, ReplayError
+from crypto.envelope import KIND_SESSION, decode_envelope, encode_envelope
+
+
+@pytest.fixture(scope='module')
+def managers(tmp_path_factory):
+    """Отправитель и получатель с собственными парами ключей"""
+    result = []
+    for name in ('sender', 'recipient'):
+        manager = CryptoManager(tmp_path_factory.mktemp(name))
+        manager.generate_keys()
+        result.append(manager)
+    return result
+
+
+@pytest.fixture
+def sender(managers):
+    managers[0].reset_sessions()
+    return managers[0]
+
+
+@pytest.fixture
+def recipient(managers):
+    managers[1].reset_sessions()
+    return managers[1]
+
+
+def encrypt(sender, recipient, text):
+    return sender.encrypt_session_message(text, recipient.get_public_key_pem(), binary=True)
+
+
+def test_session_key_is_unwrapped_once(sender, recipient, monkeypatch):
+    envelopes = [encrypt(sender, recipient, f"message {i}") for i in range(3)]
+    unwraps = []
+    original = recipient.private_key.decrypt
+
+    class CountingKey:
+        def decrypt(self, *args):
+            unwraps.append(args)
+            return original(*args)
+
+    monkeypatch.setattr(recipient, 'private_key', CountingKey())
+    assert [recipient.decrypt_message(e) for e in envelopes] == [f"message {i}" for i in range(3)]
+    assert len(unwraps) == 1
+
+
+def test_out_of_order_delivery(sender, recipient):
+    envelopes = [encrypt(sender, recipient, str(i)) for i in range(5)]
+    for index in (3, 0, 4, 1, 2):
+        assert recipient.decrypt_message(envelopes[index]) == str(index)
+
+
+def test_replay_is_rejected(sender, recipient):
+    envelope = encrypt(sender, recipient, "once")
+    assert recipient.decrypt_message(envelope) == "once"
+    with pytest.raises(ReplayError):
+        recipient.decrypt_message(envelope)
+
+
+def test_nonce_older_than_window_is_rejected(sender, recipient, monkeypatch):
+    monkeypatch.setattr(encryption, 'SESSION_REPLAY_WINDOW', 4)
+    envelopes = [encrypt(sender, recipient, str(i)) for i in range(6)]
+    recipient.decrypt_message(envelopes[5])
+    recipient.decrypt_message(envelopes[2])
+    with pytest.raises(ReplayError):
+        recipient.decrypt_message(envelopes[1])
+
+
+def test_forged_key_does_not_poison_session(sender, recipient):
+    """
+    Конверт с чужим session_id, но своим ключом (подписывать его не нужно -
+    публичный ключ получателя известен всем) расшифровывается, но не
+    подменяет ключ настоящего сеанса
+    """
+    genuine = [encrypt(sender, recipient, str(i)) for i in range(2)]
+    _, fields = decode_envelope(genuine[1])
+    session_id = bytes(fields['session_id'])
+
+    key = AESGCM.generate_key(bit_length=256)
+    recipient_key = recipient.load_recipient_public_key(recipient.get_public_key_pem())
+    nonce = (0).to_bytes(12, 'big')
+    forged = encode_envelope(KIND_SESSION, {
+        'session_id': session_id,
+        'encrypted_key': recipient_key.encrypt(key, OAEP_PADDING),
+        'nonce': nonce,
+        'encrypted_message': AESGCM(key).encrypt(nonce, b"forged", session_id),
+    })
+    assert recipient.decrypt_message(forged) == "forged"
+
+    # Тот же nonce настоящего сеанса - не повтор, ключ сеанса не подменен
+    assert recipient.decrypt_message(genuine[0]) == "0"
+    assert recipient.decrypt_message(genuine[1]) == "1"
+
+
+def test_failed_decryption_is_not_cached(sender, recipient):
+    envelope = bytearray(encrypt(sender, recipient, "tampered"))
+    envelope[-1] ^= 1
+    with pytest.raises(InvalidTag):
+        recipient.decrypt_message(bytes(envelope))
+    assert len(recipient._incoming_sessions) == 0
+    # Номер испорченного сообщения не засчитан: подлинное принимается
+    envelope[-1] ^= 1
+    assert recipient.decrypt_message(bytes(envelope)) == "tampered"
+
+
+def test_cache_size_is_bounded(sender, recipient, monkeypatch):
+    monkeypatch.setattr(encryption, 'SESSION_CACHE_SIZE', 2)
+    for i in range(4):
+        sender.reset_sessions()
+        assert recipient.decrypt_message(encrypt(sender, recipient, str(i))) == str(i)
+    assert len(recipient._incoming_sessions) == 2
@@ -0,0 +1,70 @@
+"""
+Фильтр повторно доставленных сообщений
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+
+class DedupFilter:
+    """
+    Множество недавно принятых идентификаторов с окном по времени
+
+    Одно сообщение может прийти дважды: по P2P и через relay, или при повторной
+    отправке. Идентификатор помнится window секунд, но не больше max_entries
+    последних (LRU); более старые повторы отсекает уникальный индекс в БД.
+    """
+
+    def __init__(self, window: float = 600.0, max_entries: int = 100000):
+        self.window = window
+        self.max_entries = max_entries
+        self._seen = OrderedDict()  # ключ -> время приема, старые первыми
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def seen(self, key: Hashable) -> bool:
+        """
+        Проверка и запоминание ключа: True, если он уже был в окне
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._seen:
+                self.duplicates += 1
+                return True
+            self._seen[key] = now
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            return False
+
+    def add(self, key: Hashable, age: float = 0.0):
+        """
+        Запоминание ключа, принятого age секунд назад (заполнение после запуска)
+        """
+        if age >= self.window:
+            return
+        with self._lock:
+            self._seen[key] = time.monotonic() - age
+            self._seen.move_to_end(key)
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+
+    def discard(self, key: Hashable):
+        """
+        Забыть ключ: сообщение не было обработано, повтор нужно принять
+        """
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def _expire(self, now: float):
+        deadline = now - self.window
+        while self._seen:
+            key, received = next(iter(self._seen.items()))
+            if received >= deadline:
+                break
+            self._seen.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._seen)
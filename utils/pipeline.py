@@ -0,0 +1,179 @@
+"""
+Конвейер обработки с пулом потоков и сохранением порядка по ключу
+"""
+import queue
+import threading
+import time
+from typing import Callable, Hashable, Optional
+
+# Пропуск элемента, который не удалось поставить в очередь
+_DROPPED = object()
+
+
+class OrderedPipeline:
+    """
+    Пул потоков для тяжелой обработки (расшифровка) с последовательной выдачей
+
+    Элементы одного ключа (отправителя) обрабатываются параллельно, но
+    передаются в deliver строго в порядке submit. deliver вызывается из одного
+    потока доставки, поэтому запись в БД не конкурирует сама с собой.
+    """
+
+    def __init__(self, process: Callable, deliver: Callable, workers: int = 4,
+                 max_pending: int = 1000, submit_timeout: float = 1.0):
+        self.process = process
+        self.deliver = deliver
+        self.workers = workers
+        self.submit_timeout = submit_timeout
+        self._tasks = queue.Queue(maxsize=max_pending)
+        self._deliveries = queue.Queue()
+        self._lock = threading.Lock()
+        self._next_seq = {}  # ключ -> номер следующего элемента
+        self._next_release = {}  # ключ -> номер следующего к выдаче
+        self._reorder = {}  # ключ -> {номер: результат}
+        self._threads = []
+        self._running = False
+        self._stats = {
+            'submitted': 0,
+            'dropped': 0,
+            'processed': 0,
+            'failed': 0,
+            'delivered': 0,
+            'max_queue_depth': 0,
+            'process_time': 0.0,
+        }
+
+    def start(self):
+        """
+        Запуск потоков обработки и доставки
+        """
+        if self._running:
+            return
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"pipeline-worker-{i}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._delivery_loop, name="pipeline-delivery")
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self, drain: bool = True):
+        """
+        Остановка конвейера; при drain=True ждет обработки уже принятых элементов
+        """
+        if not self._running:
+            return
+        if drain:
+            self._tasks.join()
+            self._deliveries.join()
+        self._running = False
+        for _ in range(self.workers):
+            self._tasks.put(None)
+        self._deliveries.put(None)
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+        self._threads = []
+
+    def submit(self, key: Hashable, item, timeout: Optional[float] = None) -> bool:
+        """
+        Постановка элемента в очередь
+
+        Если очередь заполнена, вызывающий поток ждет до timeout секунд
+        (None - submit_timeout, 0 - не ждать), после чего элемент отбрасывается
+        и возвращается False.
+        """
+        with self._lock:
+            seq = self._next_seq.get(key, 0)
+            self._next_seq[key] = seq + 1
+            self._next_release.setdefault(key, seq)
+            self._stats['submitted'] += 1
+
+        try:
+            self._tasks.put((key, seq, item),
+                            timeout=self.submit_timeout if timeout is None else timeout)
+        except queue.Full:
+            with self._lock:
+                self._stats['dropped'] += 1
+            # Занимаем номер пустышкой, чтобы не блокировать следующие элементы
+            self._complete(key, seq, item, _DROPPED, None)
+            return False
+
+        depth = self._tasks.qsize()
+        with self._lock:
+            if depth > self._stats['max_queue_depth']:
+                self._stats['max_queue_depth'] = depth
+        return True
+
+    def stats(self) -> dict:
+        """
+        Метрики конвейера
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['reorder_buffered'] = sum(len(buffer) for buffer in self._reorder.values())
+        stats['queue_depth'] = self._tasks.qsize()
+        processed = stats['processed'] + stats['failed']
+        stats['avg_process_ms'] = stats.pop('process_time') * 1000 / processed if processed else 0.0
+        return stats
+
+    def _worker_loop(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                self._tasks.task_done()
+                break
+            key, seq, item = task
+            started = time.perf_counter()
+            result, error = None, None
+            try:
+                result = self.process(item)
+            except Exception as e:
+                error = e
+            elapsed = time.perf_counter() - started
+
+            with self._lock:
+                self._stats['process_time'] += elapsed
+                self._stats['failed' if error else 'processed'] += 1
+            self._complete(key, seq, item, result, error)
+            self._tasks.task_done()
+
+    def _complete(self, key, seq, item, result, error):
+        """
+        Сохранение результата и выдача готовой последовательности элементов
+        """
+        with self._lock:
+            buffer = self._reorder.setdefault(key, {})
+            buffer[seq] = (item, result, error)
+
+            # Выдаем непрерывную последовательность, начиная с ожидаемого номера
+            release = self._next_release[key]
+            while release in buffer:
+                ready_item, ready_result, ready_error = buffer.pop(release)
+                if ready_result is not _DROPPED:
+                    self._deliveries.put((key, ready_item, ready_result, ready_error))
+                release += 1
+            self._next_release[key] = release
+
+            # Освобождаем состояние ключа, когда по нему ничего не ожидается
+            if not buffer and release == self._next_seq[key]:
+                del self._reorder[key]
+                del self._next_release[key]
+                del self._next_seq[key]
+
+    def _delivery_loop(self):
+        while True:
+            delivery = self._deliveries.get()
+            if delivery is None:
+                self._deliveries.task_done()
+                break
+            key, item, result, error = delivery
+            try:
+                self.deliver(key, item, result, error)
+            except Exception as e:
+                print(f"Error delivering pipeline result: {e}")
+            with self._lock:
+                self._stats['delivered'] += 1
+            self._deliveries.task_done()